@@ -27,7 +27,16 @@ class BaseTaskWrapper:
         prefix = f"[{self.__class__.__name__} | {self._submission_id}]"
         getattr(logger, level)(f"{prefix} {message}")
 
-    def _status_update(self, submission, text):
+    def _status_update(self, submission, text, progress=None):
+        """
+        move to the status `text`. `progress` (a percentage) can be given to report
+        progress within a status; repeating the current status with a new progress
+        only updates the progress.
+        """
+        submission.progress = '' if progress is None else progress
+        if progress is not None and submission.status == text:
+            return
+
         this_timestamp = time()
         timestamps_ = json.loads(submission.timestamps)
 
@@ -1,18 +1,31 @@
 from collections import OrderedDict
 import datetime
+import io
 import itertools
 import json
 import logging
 import os
+import tempfile
 import zipstream
-from sqlalchemy.orm import joinedload
+
+import numpy as np
+import pandas as pd
 
 from .query import (
     SampleOTU,
     SampleQuery,
-    OntologyInfo)
-from .util import val_or_empty, make_timestamp, empty_to_none
-from .otu import SampleContext, Taxonomy, taxonomy_keys
+    OntologyInfo,
+    copy_csv_chunks,
+    stream_row_batches,
+    stream_rows)
+from .util import make_timestamp, empty_to_none
+from .otu import (
+    OTU,
+    OTUAmplicon,
+    SampleContext,
+    Taxonomy,
+    taxonomy_key_id_names,
+    taxonomy_ontology_classes)
 
 logger = logging.getLogger('bpaotu')
 
@@ -34,20 +47,111 @@ def generate_biom_file(query, comment):
         wrap('"data": [', abundance_table, ']}\n'))
 
 
-def biom_zip_file_generator(params, timestamp):
+def generate_biom_hdf5_file(query, filename):
+    """
+    write a BIOM 2.1 (HDF5) file. the abundance table is fetched with COPY and
+    assembled into CSR/CSC arrays with numpy, rather than row by row.
+
+    see http://biom-format.org/documentation/format_versions/biom-2.1.html
+    """
+    # h5py comes with biom-format, so only import it when needed
+    import h5py
+
+    otu_ids, otu_codes, amplicons, taxonomy = otu_metadata(query)
+
+    samples = query.matching_samples()
+    sample_ids = ['102.100.100/%s' % sample.id for sample in samples]
+    titles, sample_metadata = sample_metadata_columns(samples)
+
+    abundance = abundance_frame(query)
+    rows = index_of(otu_ids, abundance['otu_id'].values)
+    cols = pd.Categorical(abundance['sample_id'], categories=[sample.id for sample in samples]).codes
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError("abundance table refers to an OTU or sample not in the query results")
+    counts = abundance['count'].values.astype(np.float64)
+    shape = (len(otu_ids), len(sample_ids))
+
+    def compressed(major, minor, n_major):
+        order = np.lexsort((minor, major))
+        indptr = np.zeros(n_major + 1, dtype=np.int32)
+        np.cumsum(np.bincount(major, minlength=n_major), out=indptr[1:])
+        return counts[order], minor[order].astype(np.int32), indptr
+
+    str_dtype = h5py.special_dtype(vlen=str)
+
+    def write_strings(group, name, values):
+        group.create_dataset(
+            name, data=np.array(values, dtype=object), dtype=str_dtype,
+            chunks=True if len(values) else None, compression='gzip' if len(values) else None)
+
+    def write_matrix(group, data, indices, indptr):
+        matrix = group.create_group('matrix')
+        for name, values in (('data', data), ('indices', indices), ('indptr', indptr)):
+            matrix.create_dataset(
+                name, data=values,
+                chunks=True if len(values) else None, compression='gzip' if len(values) else None)
+
+    with h5py.File(filename, 'w') as f:
+        f.attrs['id'] = ''
+        f.attrs['type'] = 'OTU table'
+        f.attrs['format-url'] = 'http://biom-format.org'
+        f.attrs['format-version'] = (2, 1)
+        f.attrs['generated-by'] = 'Bioplatforms Australia'
+        f.attrs['creation-date'] = datetime.datetime.now().replace(microsecond=0).isoformat()
+        f.attrs['shape'] = shape
+        f.attrs['nnz'] = len(counts)
+
+        observation = f.create_group('observation')
+        write_strings(observation, 'ids', otu_codes)
+        write_matrix(observation, *compressed(rows, cols, shape[0]))
+        metadata = observation.create_group('metadata')
+        write_strings(metadata, 'amplicon', amplicons)
+        write_strings(metadata, 'taxonomy', taxonomy)
+        observation.create_group('group-metadata')
+
+        sample = f.create_group('sample')
+        write_strings(sample, 'ids', sample_ids)
+        write_matrix(sample, *compressed(cols, rows, shape[1]))
+        metadata = sample.create_group('metadata')
+        for field, values in sample_metadata.items():
+            write_strings(metadata, titles[field], values)
+        sample.create_group('group-metadata')
+
+
+def _hdf5_file_chunks(query, chunk_size=1 << 20):
+    # HDF5 can't be written to a stream, so go via a temporary file
+    fd, filename = tempfile.mkstemp(suffix='.biom')
+    os.close(fd)
+    try:
+        generate_biom_hdf5_file(query, filename)
+        with open(filename, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        os.unlink(filename)
+
+
+BIOM_FORMATS = ('json', 'hdf5')
+
+
+def biom_zip_file_generator(params, timestamp, biom_format='json'):
+    if biom_format not in BIOM_FORMATS:
+        raise ValueError("unknown BIOM format: {}".format(biom_format))
     zf = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
     with SampleQuery(params) as query:
-        zf.write_iter(
-            params.filename(timestamp, '.biom'),
-            (s.encode('utf8') for s in generate_biom_file(query, params.describe())))
+        if biom_format == 'hdf5':
+            contents = _hdf5_file_chunks(query)
+        else:
+            contents = (s.encode('utf8') for s in generate_biom_file(query, params.describe()))
+        zf.write_iter(params.filename(timestamp, '.biom'), contents)
     return zf
 
 
-def save_biom_zip_file(params, dir='/data'):
+def save_biom_zip_file(params, dir='/data', biom_format='json'):
     timestamp = make_timestamp()
 
     filename = os.path.join(dir, params.filename(timestamp, '.biom.zip'))
-    zf = biom_zip_file_generator(params, timestamp)
+    zf = biom_zip_file_generator(params, timestamp, biom_format)
     with open(filename, 'wb') as f:
         for data in zf:
             f.write(data)
@@ -76,96 +180,163 @@ def biom_header(comment):
     yield biom_header
 
 
-def otu_rows(query, otu_to_row):
-    taxonomy_fields = taxonomy_keys[1:]
-    taxonomy_lookups = [joinedload(getattr(Taxonomy, rel))
-                        for rel in (taxonomy_fields + ['amplicon'])]
-    q = query.matching_otus_biom().add_entity(Taxonomy).options(taxonomy_lookups)
-
-    for idx, row in enumerate(q.yield_per(50)):
-        def get_value(obj, attr):
-            return val_or_empty(getattr(obj, attr))
-
-        otu_to_row[row.OTU.id] = idx
-        taxonomy_array = [get_value(row.Taxonomy, f) for f in taxonomy_fields]
-        yield '{"id": "%s","metadata": {%s,%s}}' % (
-            row.OTU.code,
-            k_v('amplicon', get_value(row.Taxonomy, 'amplicon')),
-            k_v('taxonomy', taxonomy_array))
+def index_of(sorted_ids, ids):
+    """
+    the index of each of `ids` in the sorted array `sorted_ids`, or -1 if not present
+    """
+    idx = np.searchsorted(sorted_ids, ids)
+    found = idx < len(sorted_ids)
+    found[found] = sorted_ids[idx[found]] == ids[found]
+    return np.where(found, idx, -1)
 
 
-def sample_columns(query, sample_to_column):
+def sample_metadata_columns(samples):
+    """
+    returns (titles, {field: [value, ...]}) for the given samples, with one column
+    of string values per field, for BIOM sample metadata
+    """
+    titles = {}
+    columns = OrderedDict()
     with OntologyInfo() as info:
-        def make_ontology_export(ontology_cls):
-            values = dict(info.get_values(ontology_cls))
-
-            def _ontology_lookup(x):
-                if x is None:
-                    return None
-                return values[x]
-            return _ontology_lookup
-
-        ontology_fns = {}
-        titles = {}
-        for column in SampleContext.__table__.columns:
+        for column in sorted(SampleContext.__table__.columns, key=lambda c: c.name):
+            if column.name == 'id':
+                continue
             title = column.name
             if title.endswith('_id'):
                 title = title[:-3]
+            titles[column.name] = title
+
+            values = [getattr(sample, column.name) for sample in samples]
             if hasattr(column, 'ontology_class'):
-                fn = make_ontology_export(column.ontology_class)
+                lookup = info.id_to_value_map(column.ontology_class)
+                values = [None if v is None else lookup[v] for v in values]
             else:
-                fn = empty_to_none
-            ontology_fns[column.name] = fn
-            titles[column.name] = title
+                values = [empty_to_none(v) for v in values]
+
+            # Phinch (http://phinch.org/) and Krona don't handle the full
+            # range of JS types in metadata.
+            #
+            # These workarounds draw upon the behaviour of this online BIOM
+            # converter: https://biomcs.iimog.org
+            #
+            # None values and non-string values are not handled by
+            # external tools, so everything is sent as a string
+            columns[column.name] = ['null' if v is None else str(v) for v in values]
+    return titles, columns
+
+
+def otu_metadata(query):
+    """
+    returns (otu_ids, codes, amplicons, taxonomy) for the matching OTUs, ordered by
+    OTU id. taxonomy is a list of [r1, r2, ...] names for each OTU.
+    """
+    taxonomy_fields = taxonomy_key_id_names[1:]
+    q = query.matching_otus_biom().with_entities(
+        OTU.id, OTU.code, Taxonomy.amplicon_id, *(getattr(Taxonomy, f) for f in taxonomy_fields))
 
-    def get_context_value(sample, field):
-        val = ontology_fns[field](getattr(sample, field))
+    with OntologyInfo() as info:
+        amplicon_values = info.id_to_value_map(OTUAmplicon)
+        taxonomy_values = [info.id_to_value_map(cls) for cls in taxonomy_ontology_classes[1:]]
+
+    def get_value(values, _id):
+        if _id is None:
+            return ''
+        return values[_id]
+
+    otu_ids, codes, amplicons, taxonomy = [], [], [], []
+    for otu_id, otu_code, amplicon_id, *taxonomy_ids in stream_rows(q, 'BIOM OTU metadata'):
+        otu_ids.append(otu_id)
+        codes.append(otu_code)
+        amplicons.append(get_value(amplicon_values, amplicon_id))
+        taxonomy.append([get_value(values, _id) for values, _id in zip(taxonomy_values, taxonomy_ids)])
+    return np.array(otu_ids, dtype=np.int64), codes, amplicons, taxonomy
+
+
+def abundance_frame(query):
+    """
+    the (otu_id, sample_id, count) abundance table as a DataFrame, fetched with COPY
+    """
+    q = query.matching_sample_otus(SampleOTU.otu_id, SampleOTU.sample_id, SampleOTU.count)
+    buf = io.BytesIO()
+    for chunk in copy_csv_chunks(q, 'BIOM abundance table'):
+        buf.write(chunk)
+    if buf.tell() == 0:
+        return pd.DataFrame({
+            'otu_id': np.array([], dtype=np.int64),
+            'sample_id': np.array([], dtype=object),
+            'count': np.array([], dtype=np.int64)})
+    buf.seek(0)
+    return pd.read_csv(
+        buf, header=None, names=['otu_id', 'sample_id', 'count'],
+        dtype={'otu_id': np.int64, 'sample_id': str, 'count': np.int64})
 
-        # Phinch (http://phinch.org/) and Krona don't handle the full
-        # range of JS types in metadata.
-        #
-        # These workarounds draw upon the behaviour of this online BIOM
-        # converter: https://biomcs.iimog.org
 
-        # workaround: None values not handled by external tools
-        if val is None:
-            val = 'null'
+def otu_rows(query, otu_to_row):
+    taxonomy_fields = taxonomy_key_id_names[1:]
+    q = query.matching_otus_biom().with_entities(
+        OTU.id, OTU.code, Taxonomy.amplicon_id, *(getattr(Taxonomy, f) for f in taxonomy_fields))
 
-        # workaround: non-string values not handled by external tools
-        val = str(val)
+    with OntologyInfo() as info:
+        amplicon_values = info.id_to_value_map(OTUAmplicon)
+        taxonomy_values = [info.id_to_value_map(cls) for cls in taxonomy_ontology_classes[1:]]
 
-        return val
+    def get_value(values, _id):
+        if _id is None:
+            return ''
+        return values[_id]
 
-    all_fields = [k.name for k in SampleContext.__table__.columns if k.name != 'id']
+    for idx, (otu_id, otu_code, amplicon_id, *taxonomy_ids) in enumerate(stream_rows(q, 'BIOM OTU rows')):
+        otu_to_row[otu_id] = idx
+        taxonomy_array = [get_value(values, _id) for values, _id in zip(taxonomy_values, taxonomy_ids)]
+        yield '{"id": "%s","metadata": {%s,%s}}' % (
+            otu_code,
+            k_v('amplicon', get_value(amplicon_values, amplicon_id)),
+            k_v('taxonomy', taxonomy_array))
 
-    non_empty = set(
-        field
-        for sample in query.matching_samples()
-        for field in all_fields
-        if get_context_value(sample, field) is not None)
-    fields = sorted(list(non_empty))
 
+def sample_columns(query, sample_to_column):
     # This is a cached query so all results are returned. Just iterate through without chunking.
-    for idx, sample in enumerate(s for s in query.matching_samples() if s.id not in sample_to_column):
-        sample_to_column[sample.id] = idx
-        metadata = ','.join(k_v(titles[f], get_context_value(sample, f)) for f in fields)
+    samples = query.matching_samples()
+    titles, columns = sample_metadata_columns(samples)
+
+    # encode the metadata a column at a time, then stitch each sample together
+    encoded = [
+        [k_v(titles[field], value) for value in values]
+        for field, values in columns.items()]
+
+    for idx, sample in enumerate(samples):
+        if sample.id in sample_to_column:
+            continue
+        sample_to_column[sample.id] = len(sample_to_column)
+        metadata = ','.join(column[idx] for column in encoded)
         sample_data = '{"id": "102.100.100/%s","metadata": {%s}}' % (sample.id, metadata)
 
         yield sample_data
 
 
 def abundance_tbl(query, otu_to_row, sample_to_column):
+    """
+    yields the "data" entries of the BIOM file, each yield being a whole batch of
+    rows from the database. ids are mapped to matrix indices with numpy, and each
+    batch is formatted with a single join.
+    """
+    otu_ids = np.fromiter(otu_to_row.keys(), dtype=np.int64, count=len(otu_to_row))
+    row_of_otu = np.fromiter(otu_to_row.values(), dtype=np.int64, count=len(otu_to_row))
+    order = np.argsort(otu_ids)
+    otu_ids, row_of_otu = otu_ids[order], row_of_otu[order]
+    sample_index = pd.Index(list(sample_to_column.keys()))
+    column_of_sample = np.fromiter(sample_to_column.values(), dtype=np.int64, count=len(sample_to_column))
+
     q = query.matching_sample_otus(SampleOTU.otu_id, SampleOTU.sample_id, SampleOTU.count)
-    for otu_id, sample_id, count in q.yield_per(50):
-        # a little messy, but this is our busiest bit of code in the
-        # entire BIOM output process
-        yield '[' + \
-            str(otu_to_row[otu_id]) + \
-            ',' + \
-            str(sample_to_column[sample_id]) + \
-            ',' + \
-            str(count) + \
-            ']'
+    for batch in stream_row_batches(q, 'BIOM abundance table'):
+        otu_id, sample_id, count = zip(*batch)
+        row_idx = index_of(otu_ids, np.array(otu_id, dtype=np.int64))
+        col_idx = sample_index.get_indexer(sample_id)
+        if (row_idx < 0).any() or (col_idx < 0).any():
+            raise ValueError("abundance table refers to an OTU or sample not in the BIOM file")
+        yield ','.join(
+            '[%d,%d,%d]' % t
+            for t in zip(row_of_otu[row_idx].tolist(), column_of_sample[col_idx].tolist(), count))
 
 
 def k_v(k, v):
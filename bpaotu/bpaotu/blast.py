@@ -1,23 +1,241 @@
+import ctypes
 import io
 import os
 import csv
 import json
+import logging
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
+from glob import glob
 import zipstream
 import base64
 
 from django.conf import settings
 from contextlib import suppress
 
+from bpaotu.celery import app
 from .base_task_wrapper import BaseTaskWrapper
+from .kmer_index import K, W, KmerIndex, KmerIndexBuilder, approximate_search, shortlist
+from .otu import OTU, Sequence, Taxonomy, taxonomy_otu
 from .params import param_to_filters
-from .query import SampleQuery
+from .query import SampleQuery, import_uuid, make_cache_key, stream_row_batches
 from .submission import Submission
 from .util import format_sample_id
 
 import pandas as pd
 import numpy as np
 
+logger = logging.getLogger('bpaotu')
+
+
+BLAST_DATABASE_MANIFEST = 'databases.json'
+
+PR_SET_PDEATHSIG = 1
+
+
+def _kill_with_parent():
+    # (run in the child) a cancel kills the worker process with SIGKILL, which
+    # would otherwise leave blastn running on its own
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+
+
+def blast_database_directory(uuid):
+    return os.path.join(settings.BLAST_DATABASE_PATH, uuid)
+
+
+def build_blast_databases(session, uuid, reuse=None):
+    """
+    build a BLAST database of the OTU sequences of each amplicon, for the import
+    with the given `uuid`. BLAST searches then only need to list the OTUs which
+    match their filters (see BlastWrapper._make_database). a minimizer index of
+    the sequences (see kmer_index) is built alongside each database.
+
+    the databases are built alongside, and moved into place once complete;
+    databases for any other import are removed. `reuse` ({amplicon id: path}, as
+    from blast_databases) gives databases of a previous import which are still
+    valid, and are linked in rather than rebuilt.
+    """
+    directory = blast_database_directory(uuid)
+    build_directory = directory + '.building'
+    shutil.rmtree(build_directory, ignore_errors=True)
+    os.makedirs(build_directory)
+
+    manifest = {}
+    amplicon_ids = [amplicon_id for (amplicon_id,) in session.query(Taxonomy.amplicon_id).distinct()]
+    for amplicon_id in sorted(amplicon_ids):
+        name = 'amplicon_{}'.format(amplicon_id)
+        if reuse and amplicon_id in reuse:
+            for path in glob(reuse[amplicon_id] + '.*'):
+                os.link(path, os.path.join(build_directory, name + path[len(reuse[amplicon_id]):]))
+            manifest[amplicon_id] = name
+            logger.info("Reused BLAST database %s", name)
+            continue
+
+        fasta_path = os.path.join(build_directory, name + '.fasta')
+        amplicon_otu_ids = session.query(taxonomy_otu.c.otu_id)\
+            .join(Taxonomy, Taxonomy.id == taxonomy_otu.c.taxonomy_id)\
+            .filter(Taxonomy.amplicon_id == amplicon_id)
+        q = session.query(OTU.id, Sequence.seq)\
+            .join(Sequence, Sequence.id == OTU.id)\
+            .filter(OTU.id.in_(amplicon_otu_ids.subquery()))
+
+        kmer_index = KmerIndexBuilder()
+        with open(fasta_path, 'w') as fd:
+            # the fasta id matches that used by BlastWrapper, i.e. id_<otu id>
+            for rows in stream_row_batches(q, 'BLAST database sequences ({})'.format(name)):
+                fd.writelines('>id_{}\n{}\n'.format(otu_id, seq) for otu_id, seq in rows)
+                otu_ids, seqs = zip(*rows)
+                kmer_index.add(otu_ids, seqs)
+        kmer_index.save(os.path.join(build_directory, name + '.kmer'))
+
+        subprocess.run([
+            'makeblastdb',
+            '-in', name + '.fasta',
+            '-dbtype', 'nucl',
+            '-parse_seqids',
+            '-out', name,
+        ], check=True, cwd=build_directory, stdout=subprocess.DEVNULL)
+        os.remove(fasta_path)
+        manifest[amplicon_id] = name
+        logger.info("Built BLAST database %s", name)
+
+    with open(os.path.join(build_directory, BLAST_DATABASE_MANIFEST), 'w') as fd:
+        json.dump(manifest, fd)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(build_directory, directory)
+
+    for other in os.listdir(settings.BLAST_DATABASE_PATH):
+        if other != uuid:
+            shutil.rmtree(os.path.join(settings.BLAST_DATABASE_PATH, other), ignore_errors=True)
+
+
+def kmer_indexes(databases):
+    """
+    the KmerIndex of each of the BLAST `databases`, or None if any weren't built
+    """
+    paths = [database + '.kmer' for database in databases]
+    if not all(os.path.exists(path + '.keys.npy') for path in paths):
+        return None
+    return [KmerIndex(path) for path in paths]
+
+
+def blast_databases(uuid):
+    """
+    {amplicon id: path} of the BLAST databases built for the import with the given
+    `uuid`, or None if they haven't been built
+    """
+    directory = blast_database_directory(uuid)
+    try:
+        with open(os.path.join(directory, BLAST_DATABASE_MANIFEST)) as fd:
+            manifest = json.load(fd)
+    except FileNotFoundError:
+        return None
+    return {int(amplicon_id): os.path.join(directory, name) for amplicon_id, name in manifest.items()}
+
+
+def normalise_sequence(search_string):
+    """
+    the sequence in `search_string`, without any FASTA header, whitespace or case
+    """
+    lines = [line for line in search_string.splitlines() if not line.startswith('>')]
+    return ''.join(''.join(lines).split()).upper()
+
+
+class BlastResultCache:
+    """
+    BLAST results shared between users on the /data volume, so that an identical
+    search (same sequence, parameters, filters and import) isn't run again.
+
+    each entry is a directory holding the results.out and command.txt of the
+    search. the least recently used entries are removed to keep the cache within
+    `max_size_mb`.
+    """
+    FILES = ('results.out', 'command.txt')
+    TMP_PREFIX = '.tmp-'
+    TMP_MAX_AGE = 3600 # seconds before an unfinished entry is considered abandoned
+
+    def __init__(self, path=None, max_size_mb=None):
+        self._path = path or settings.BLAST_CACHE_PATH
+        self._max_bytes = (settings.BLAST_CACHE_MAX_SIZE_MB if max_size_mb is None else max_size_mb) * 1024 * 1024
+
+    def key(self, search_string, perc_identity, qcov_hsp_perc, params, mode='blast'):
+        # (make_cache_key includes the import UUID)
+        return make_cache_key(
+            'BlastResultCache',
+            normalise_sequence(search_string),
+            float(perc_identity),
+            float(qcov_hsp_perc),
+            params.state_key,
+            mode)
+
+    def get(self, key, directory):
+        """
+        copy the cached results for `key` into `directory`, returning whether
+        there were any
+        """
+        if self._max_bytes <= 0:
+            return False
+        entry = os.path.join(self._path, key)
+        # copied alongside first: a results.out in `directory` is taken as the
+        # complete results, so must only appear once everything has been copied
+        tmp_directory = tempfile.mkdtemp(dir=directory, prefix=self.TMP_PREFIX)
+        try:
+            for name in self.FILES:
+                shutil.copyfile(os.path.join(entry, name), os.path.join(tmp_directory, name))
+            # mark as recently used
+            os.utime(entry)
+            for name in reversed(self.FILES):
+                os.rename(os.path.join(tmp_directory, name), os.path.join(directory, name))
+        except FileNotFoundError:
+            # not cached, or evicted while being copied
+            return False
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        return True
+
+    def put(self, key, directory):
+        """
+        cache the results in `directory` under `key`
+        """
+        if self._max_bytes <= 0:
+            return
+        os.makedirs(self._path, exist_ok=True)
+        entry = os.path.join(self._path, key)
+        tmp_entry = tempfile.mkdtemp(dir=self._path, prefix=self.TMP_PREFIX)
+        for name in self.FILES:
+            shutil.copyfile(os.path.join(directory, name), os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # the same search was cached by another worker in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self._path):
+            entry = os.path.join(self._path, name)
+            with suppress(FileNotFoundError):
+                mtime = os.path.getmtime(entry)
+                if name.startswith(self.TMP_PREFIX) and time.time() - mtime < self.TMP_MAX_AGE:
+                    # still being written by another worker
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, t)) for t in os.listdir(entry))
+                entries.append((mtime, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
 class BlastWrapper(BaseTaskWrapper):
     BLAST_COLUMNS = ['qlen', 'slen', 'length', 'pident', 'evalue', 'bitscore']
 
@@ -29,21 +247,82 @@ class BlastWrapper(BaseTaskWrapper):
         blast_params = json.loads(blast_params_string)
         self._param_qcov_hsp_perc = blast_params['qcov_hsp_perc']
         self._param_perc_identity = blast_params['perc_identity']
+        # 'blast', or 'approximate' to estimate matches from the minimizer index without alignment
+        self._param_mode = blast_params.get('mode', 'blast')
+
+        self._result_cache = BlastResultCache()
 
     def _run_cmd(self, args):
         self._log('debug', f"Running command: {' '.join(args)}")
-        subprocess.run(args, check=True, cwd=self._submission_dir)
+        subprocess.run(args, check=True, cwd=self._submission_dir, preexec_fn=_kill_with_parent)
 
     def _setup(self):
         super()._setup()
 
+        if self._result_cache.get(self._result_cache_key(), self._submission_dir):
+            self._log('info', 'Using cached results of an identical BLAST search')
+            return
+
         self._make_database()
         self._write_query()
 
     def _run(self):
-        self._execute_blast()
+        # (the results are already there if they were cached)
+        if not os.path.exists(self._in('results.out')):
+            if self._approximate():
+                self._execute_approximate_search()
+            else:
+                self._execute_blast()
+            self._cache_results()
         return self._write_output()
 
+    def start_shards(self):
+        """
+        the shards to run with run_shard (each in its own task) then finish_shards,
+        rather than run; empty if the search isn't sharded
+        """
+        n_shards = self._shard_info()['shards']
+        if n_shards <= 1 or os.path.exists(self._in('results.out')) or self._approximate():
+            return []
+        self._status_update(Submission(self._submission_id), 'execute_blast', 0)
+        return list(range(n_shards))
+
+    def run_shard(self, shard):
+        self._log('debug', f"Starting shard {shard}")
+        self._execute_blast_shard(shard)
+        self._log('debug', f"Finished shard {shard}")
+
+    def finish_shards(self):
+        self._log('debug', "Merging shards")
+        self._merge_shard_results()
+        self._cache_results()
+        return self._write_output()
+
+    def _cancel(self):
+        # the shards (and the merge) of a sharded search are separate tasks, which may
+        # be running or still queued on any of the workers
+        submission = Submission(self._submission_id)
+        shard_task_ids = json.loads(submission.shard_task_ids or '[]')
+        if shard_task_ids:
+            app.control.revoke(shard_task_ids, terminate=True, signal='SIGKILL')
+            self._log('info', f"Shard tasks cancelled (task_ids={shard_task_ids})")
+        result = super()._cancel()
+        if shard_task_ids and submission.status != 'cancelled':
+            self._status_update(submission, 'cancelled')
+        return result
+
+    def _cache_results(self):
+        try:
+            self._result_cache.put(self._result_cache_key(), self._submission_dir)
+        except OSError as e:
+            # the search itself has succeeded
+            self._log('warning', f"Could not cache BLAST results: {e}")
+
+    def _result_cache_key(self):
+        return self._result_cache.key(
+            self._search_string, self._param_perc_identity, self._param_qcov_hsp_perc, self._params,
+            self._param_mode)
+
     def _make_database(self):
         """
         First we find all otu ids needed in the fasta file
@@ -52,41 +331,166 @@ class BlastWrapper(BaseTaskWrapper):
         for the otu_ids, and if we join to Sequence table and use the distinct
         clause it takes ages because the DB has to check all sequences
 
-        Note: this should be improved to use a temporary table
-        instead of a huge array of otu_ids
+        The otu ids are kept in a temporary table in the database, rather
+        than being pulled back here
+
+        If the per-amplicon databases were built at import, the search is
+        restricted to the needed otu ids with a seqidlist instead
         """
 
         submission = Submission(self._submission_id)
         self._status_update(submission, 'fetch')
 
-        self._log('debug', 'Finding all needed otu ids')
-        otu_ids = []
         with SampleQuery(self._params) as query:
-            for row in query.matching_otu_ids().yield_per(1000):
-                otu_ids.append(row[0])
-        self._log('debug', f'Found all needed otu ids: {len(otu_ids)}')
-
-        self._status_update(submission, 'making_db_fasta')
-        with open(self._in('db.fasta'), 'w') as fd:
-            # write out the OTU database in FASTA format,
-            # retain the otu id in the fasta id to use to get sample info later
-            with SampleQuery(self._params) as query:
-                for otu_id, otu_code, seq in query.matching_otus(otu_ids).yield_per(1000):
-                    fd.write('>id_{}\n{}\n'.format(otu_id, seq))
+            self._log('debug', 'Finding all needed otu ids')
+            otu_id_set = query.otu_id_set()
+            self._log('debug', 'Found all needed otu ids')
+
+            databases = blast_databases(import_uuid())
+            amplicon_ids = query.otu_id_set_amplicon_ids(otu_id_set) if databases else []
+            if databases and all(amplicon_id in databases for amplicon_id in amplicon_ids):
+                self._status_update(submission, 'making_db_seqidlist')
+                prebuilt = [databases[amplicon_id] for amplicon_id in amplicon_ids]
+                candidate_set = self._kmer_candidate_set(query, prebuilt)
+                with open(self._in('db.seqidlist'), 'w') as fd:
+                    query.copy_otu_id_set(otu_id_set, fd, prefix='id_', within=candidate_set)
+                with open(self._in('db.json'), 'w') as fd:
+                    json.dump({'databases': prebuilt}, fd)
+                if not self._approximate():
+                    self._split_seqidlist(prebuilt)
+                return
+
+            if databases:
+                self._log('warning', 'Prebuilt BLAST databases are missing amplicons; making database')
+
+            self._status_update(submission, 'making_db_fasta')
+            n_shards = settings.BLAST_SHARDS
+            fasta_names = ['db.fasta'] if n_shards <= 1 else [f'db.{shard}.fasta' for shard in range(n_shards)]
+            dbsize = 0
+            fds = [open(self._in(name), 'w') for name in fasta_names]
+            try:
+                # write out the OTU database in FASTA format, dealt out between the shards;
+                # retain the otu id in the fasta id to use to get sample info later
+                q = query.matching_otus(otu_id_set).yield_per(1000)
+                for i, (otu_id, otu_code, seq) in enumerate(q):
+                    fds[i % len(fds)].write('>id_{}\n{}\n'.format(otu_id, seq))
+                    dbsize += len(seq)
+            finally:
+                for fd in fds:
+                    fd.close()
+
+        if n_shards > 1:
+            self._write_shard_info(n_shards, dbsize)
 
         self._status_update(submission, 'makeblastdb')
-        self._run_cmd([
-            'makeblastdb',
-            '-in', 'db.fasta',
-            '-dbtype', 'nucl',
-            '-parse_seqids'
-        ])
+        for name in fasta_names:
+            self._run_cmd([
+                'makeblastdb',
+                '-in', name,
+                '-dbtype', 'nucl',
+                '-parse_seqids'
+            ])
+
+    def _split_seqidlist(self, databases):
+        """
+        deal the OTUs in db.seqidlist out between the shards, if the search is sharded
+        """
+        n_shards = settings.BLAST_SHARDS
+        if n_shards <= 1:
+            return
 
-    def _max_target_seqs(self):
-        command = ['grep', '-c', '>', self._in('db.fasta')]
+        fds = [open(self._in(f'db.{shard}.seqidlist'), 'w') for shard in range(n_shards)]
+        try:
+            with open(self._in('db.seqidlist')) as fd:
+                for i, line in enumerate(fd):
+                    fds[i % n_shards].write(line)
+        finally:
+            for fd in fds:
+                fd.close()
+
+        # the shards must be searched as if they were the whole database, so that
+        # the evalues are comparable: the total length of the sequences searched
+        result = subprocess.run([
+            'blastdbcmd',
+            '-db', ' '.join(databases),
+            '-entry_batch', self._in('db.seqidlist'),
+            '-outfmt', '%l',
+        ], stdout=subprocess.PIPE, text=True, check=True)
+        dbsize = sum(int(length) for length in result.stdout.split())
+        self._write_shard_info(n_shards, dbsize)
+
+    def _write_shard_info(self, n_shards, dbsize):
+        with open(self._in('shards.json'), 'w') as fd:
+            json.dump({'shards': n_shards, 'dbsize': dbsize}, fd)
+
+    def _shard_info(self):
+        """
+        {'shards': the number of shards, 'dbsize': their total length}; a single
+        shard if the search isn't sharded
+        """
+        with suppress(FileNotFoundError), open(self._in('shards.json')) as fd:
+            return json.load(fd)
+        return {'shards': 1, 'dbsize': None}
+
+    def _kmer_candidate_set(self, query, databases):
+        """
+        a temporary table of the OTUs which the minimizer index shortlists for the
+        search, or None to search all the matching OTUs
+        """
+        indexes = kmer_indexes(databases)
+        if indexes is None:
+            return None
+        candidates = shortlist(
+            indexes, normalise_sequence(self._search_string), self._param_perc_identity, self._param_qcov_hsp_perc)
+        if candidates is None:
+            self._log('info', 'Minimizer index cannot shortlist this query; searching all matching OTUs')
+            return None
+        self._log('info', f"Minimizer index shortlisted {len(candidates)} OTUs")
+        return query.otu_id_set(candidates.tolist())
+
+    def _approximate(self):
+        # (an approximate search needs the minimizer indexes; otherwise BLAST is used)
+        return self._param_mode == 'approximate' and self._prebuilt_kmer_indexes() is not None
+
+    def _prebuilt_kmer_indexes(self):
+        databases = self._prebuilt_databases()
+        return kmer_indexes(databases) if databases is not None else None
+
+    def _prebuilt_databases(self):
+        """
+        the paths of the prebuilt databases chosen by _make_database, or None if
+        a database was made for this submission
+        """
+        with suppress(FileNotFoundError), open(self._in('db.json')) as fd:
+            return json.load(fd)['databases']
+        return None
+
+    def _max_target_seqs(self, shard=None):
+        if self._prebuilt_databases() is not None:
+            command = ['wc', '-l', self._in(self._shard_file('db.seqidlist', shard))]
+            result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+            return result.stdout.split()[0]
+
+        command = ['grep', '-c', '>', self._in(self._shard_file('db.fasta', shard))]
         result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
         return result.stdout.strip() # use strip() to remove trailing \n
 
+    def _database_args(self, shard=None):
+        databases = self._prebuilt_databases()
+        if databases is not None:
+            return ['-db', ' '.join(databases), '-seqidlist', self._shard_file('db.seqidlist', shard)]
+        return ['-db', self._shard_file('db.fasta', shard)]
+
+    @staticmethod
+    def _shard_file(name, shard):
+        """
+        the name of the file `name` (e.g. db.fasta) for `shard`, or for the whole search if None
+        """
+        if shard is None:
+            return name
+        base, ext = os.path.splitext(name)
+        return f'{base}.{shard}{ext}'
+
     def _write_query(self):
         submission = Submission(self._submission_id)
         self._status_update(submission, 'write_query')
@@ -94,29 +498,106 @@ class BlastWrapper(BaseTaskWrapper):
         with open(self._in('query.fasta'), 'w') as fd:
             fd.write('>user_provided_search_string\n{}\n'.format(self._search_string))
 
-    def _blast_command(self):
-        return [
+    def _blast_command(self, shard=None, out='results.out'):
+        command = [
             'blastn',
-            '-num_threads', '32',
-            '-db', 'db.fasta',
+            '-num_threads', str(settings.BLAST_NUM_THREADS),
+            *self._database_args(shard),
             '-query', 'query.fasta',
-            '-out', 'results.out',
+            '-out', out,
             '-outfmt', f"6 sseqid {' '.join(self.BLAST_COLUMNS)}",
             '-perc_identity', str(self._param_perc_identity),
             '-strand', 'plus',
             '-qcov_hsp_perc', str(self._param_qcov_hsp_perc),
-            '-max_target_seqs', self._max_target_seqs()
+            '-max_target_seqs', self._max_target_seqs(shard)
         ]
+        if shard is not None:
+            command += ['-dbsize', str(self._shard_info()['dbsize'])]
+        return command
+
+    def _execute_approximate_search(self):
+        submission = Submission(self._submission_id)
+        self._status_update(submission, 'execute_approximate_search')
+
+        sequence = normalise_sequence(self._search_string)
+        with open(self._in('db.seqidlist')) as fd:
+            otu_ids = np.array([int(line[len('id_'):]) for line in fd], dtype=np.int64)
+
+        with open(self._in('command.txt'), 'w') as fd:
+            fd.write(
+                f"approximate search by shared minimizers (k={K}, w={W}): "
+                f"-perc_identity {self._param_perc_identity} -qcov_hsp_perc {self._param_qcov_hsp_perc}")
+
+        # in the same format as the blastn output (there is no evalue or bitscore)
+        with open(self._in('results.out'), 'w') as fd:
+            for index in self._prebuilt_kmer_indexes():
+                matches = approximate_search(
+                    index, sequence, self._param_perc_identity, self._param_qcov_hsp_perc, otu_ids)
+                otu_match_ids, qlen, slen, length, pident = matches
+                for otu_id, s, l, p in zip(otu_match_ids.tolist(), slen.tolist(), length.tolist(), pident.tolist()):
+                    fd.write(f"id_{otu_id}\t{qlen}\t{s}\t{l}\t{p:.3f}\t\t\n")
 
     def _execute_blast(self):
         submission = Submission(self._submission_id)
         self._status_update(submission, 'execute_blast')
+        command = self._blast_command()
+        with open(self._in('command.txt'), 'w') as fd:
+            fd.write(' '.join(command))
+        if self._prebuilt_databases() is not None and self._max_target_seqs() == '0':
+            # nothing to search (blastn rejects an empty seqidlist)
+            open(self._in('results.out'), 'w').close()
+            return
         try:
-            self._run_cmd(self._blast_command())
+            self._run_cmd(command)
         except subprocess.CalledProcessError as e:
             self._log('exception', f"BLAST command failed: {e}")
             raise
 
+    def _execute_blast_shard(self, shard):
+        """
+        search `shard`, leaving its results in results.<shard>.out once complete
+        """
+        submission = Submission(self._submission_id)
+        n_shards = self._shard_info()['shards']
+        results = self._in(self._shard_file('results.out', shard))
+        partial = results + '.partial'
+
+        if self._max_target_seqs(shard) == '0':
+            # nothing to search (blastn rejects an empty seqidlist or database)
+            open(partial, 'w').close()
+        else:
+            try:
+                self._run_cmd(self._blast_command(shard, out=os.path.basename(partial)))
+            except subprocess.CalledProcessError as e:
+                self._log('exception', f"BLAST command failed for shard {shard}: {e}")
+                raise
+        os.rename(partial, results)
+
+        # the shards run in any order, on any worker
+        n_done = sum(os.path.exists(self._in(self._shard_file('results.out', s))) for s in range(n_shards))
+        self._status_update(submission, 'execute_blast', int(100 * n_done / n_shards))
+
+    def _merge_shard_results(self):
+        """
+        merge the results of the shards into results.out, best hits first as blastn orders them
+        """
+        n_shards = self._shard_info()['shards']
+        rows = []
+        for shard in range(n_shards):
+            with open(self._in(self._shard_file('results.out', shard))) as fd:
+                rows.extend(csv.reader(fd, dialect='excel-tab'))
+
+        evalue = 1 + self.BLAST_COLUMNS.index('evalue')
+        bitscore = 1 + self.BLAST_COLUMNS.index('bitscore')
+        rows.sort(key=lambda row: (float(row[evalue]), -float(row[bitscore])))
+        with open(self._in('results.out'), 'w', newline='') as fd:
+            csv.writer(fd, dialect='excel-tab').writerows(rows)
+
+        with open(self._in('command.txt'), 'w') as fd:
+            fd.write('\n'.join(
+                ' '.join(self._blast_command(shard, out=self._shard_file('results.out', shard)))
+                for shard in range(n_shards)))
+
     def _blast_results(self):
         self._log('debug', 'Retrieving blast results')
         results = {}
@@ -156,14 +637,13 @@ class BlastWrapper(BaseTaskWrapper):
         self._log('info', 'Adding sample data to blast results')
 
         blast_rows = self._blast_results()
-        otu_ids = blast_rows.keys()
 
         with open(blast_sample_results_file, 'w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
             writer.writerow(['OTU Code', 'OTU', 'sample_id', 'abundance', 'latitude', 'longitude'] + self.BLAST_COLUMNS)
             
             with SampleQuery(self._params) as query:
-                q = query.matching_sample_otus_blast(otu_ids)
+                q = query.matching_sample_otus_blast(query.otu_id_set(blast_rows.keys()))
 
                 for OTU_id, OTU_code, OTU_seq, SampleOTU_count, SampleContext_id, SampleContext_latitude, SampleContext_longitude in q.yield_per(50):
                     blast_row = blast_rows[OTU_id]
@@ -304,6 +784,10 @@ class BlastWrapper(BaseTaskWrapper):
             return MAX_SIZE - (MIN_RANGE * (range_lon - MIN_RANGE) / (MAX_RANGE - MIN_RANGE))
 
 
+    def _command_line(self):
+        with open(self._in('command.txt')) as fd:
+            return fd.read()
+
     def _info_text(self, params):
         return """\
 Australian Microbiome OTU Database - BLAST query results
@@ -326,4 +810,4 @@ https://www.australianmicrobiome.com/protocols/data-policy/
 
 Code to make figure:
 https://github.com/AusMicrobiome/Maps
-""".format(self._search_string, ' '.join(self._blast_command()), params.describe()).encode('utf8')
+""".format(self._search_string, self._command_line(), params.describe()).encode('utf8')
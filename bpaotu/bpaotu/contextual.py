@@ -116,4 +116,4 @@ def contextual_schema_definition_query():
 
 def make_environment_lookup():
     with OntologyInfo() as info:
-        return dict(info.get_values(Environment))
+        return dict(info.id_to_value_map(Environment))
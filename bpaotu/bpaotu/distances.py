@@ -0,0 +1,213 @@
+"""
+Pairwise distances between the rows (samples) of a sparse abundance matrix.
+
+The n x n result is computed a block of rows at a time, with the blocks spread
+over a thread pool: the kernels are compiled with numba and release the GIL.
+Only the upper triangle is computed, and mirrored into the lower. Beyond the
+float32 result, each worker needs at most one dense row of the abundance matrix.
+
+For comparisons too large for an n x n matrix, nearest_neighbours finds just the
+k nearest neighbours of each sample with an approximate nearest neighbour index.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import scipy.sparse
+from numba import njit
+
+
+METRICS = ('braycurtis', 'jaccard')
+
+
+@njit(nogil=True)
+def _braycurtis_rows(start, end, indptr, indices, data, totals, dense, out):
+    n = out.shape[0]
+    for i in range(start, end):
+        for p in range(indptr[i], indptr[i + 1]):
+            dense[indices[p]] = data[p]
+        for j in range(i + 1, n):
+            # sum of min(u, v): only the non-zeros of row j can contribute
+            shared = 0.0
+            for p in range(indptr[j], indptr[j + 1]):
+                a = dense[indices[p]]
+                b = data[p]
+                shared += a if a < b else b
+            denominator = totals[i] + totals[j]
+            d = 1.0 - 2.0 * shared / denominator if denominator > 0 else 0.0
+            out[i, j] = d
+            out[j, i] = d
+        for p in range(indptr[i], indptr[i + 1]):
+            dense[indices[p]] = 0.0
+
+
+@njit(nogil=True)
+def _pack_presence(indptr, indices, bits):
+    for i in range(bits.shape[0]):
+        for p in range(indptr[i], indptr[i + 1]):
+            k = indices[p]
+            bits[i, k >> 6] |= np.uint64(1) << np.uint64(k & 63)
+
+
+@njit(nogil=True)
+def _popcount(x):
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+@njit(nogil=True)
+def _jaccard_rows(start, end, bits, counts, out):
+    n = out.shape[0]
+    words = bits.shape[1]
+    for i in range(start, end):
+        for j in range(i + 1, n):
+            shared = 0
+            for w in range(words):
+                shared += _popcount(bits[i, w] & bits[j, w])
+            union = counts[i] + counts[j] - shared
+            d = 1.0 - shared / union if union > 0 else 0.0
+            out[i, j] = d
+            out[j, i] = d
+
+
+def _row_blocks(n, n_blocks):
+    """
+    split rows [0, n) into blocks with roughly equal amounts of work; row i
+    is compared against the n - i - 1 rows after it
+    """
+    work = np.cumsum(np.arange(n, 0, -1, dtype=np.float64))
+    targets = np.linspace(0, work[-1], n_blocks + 1)[1:-1] if n else []
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(work, targets), [n])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def pairwise_distances(matrix, metric, n_workers=None, progress=None):
+    """
+    returns the n x n float32 distance matrix between the rows of the sparse
+    `matrix` (samples x OTUs).
+
+    `metric` is 'braycurtis' (on abundances) or 'jaccard' (on presence/absence).
+    `progress(done, total)` is called from this thread as each block of rows completes.
+    """
+    if metric not in METRICS:
+        raise ValueError("unknown metric: {}".format(metric))
+    if not n_workers:
+        n_workers = os.cpu_count() or 1
+
+    matrix = scipy.sparse.csr_matrix(matrix)
+    n, n_cols = matrix.shape
+    indptr = matrix.indptr.astype(np.int64)
+    indices = matrix.indices.astype(np.int64)
+    out = np.zeros((n, n), dtype=np.float32)
+
+    if metric == 'braycurtis':
+        data = matrix.data.astype(np.float64)
+        totals = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+
+        def run_block(start, end):
+            dense = np.zeros(n_cols, dtype=np.float64)
+            _braycurtis_rows(start, end, indptr, indices, data, totals, dense, out)
+    else:
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        indptr = matrix.indptr.astype(np.int64)
+        indices = matrix.indices.astype(np.int64)
+        bits = np.zeros((n, (n_cols + 63) // 64), dtype=np.uint64)
+        _pack_presence(indptr, indices, bits)
+        counts = np.diff(indptr)
+
+        def run_block(start, end):
+            _jaccard_rows(start, end, bits, counts, out)
+
+    # many more blocks than workers, so that progress is reported smoothly
+    blocks = _row_blocks(n, n_workers * 16)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(run_block, start, end) for start, end in blocks]
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress is not None:
+                progress(done, len(futures))
+
+    return out
+
+
+def nearest_neighbours(matrix, metric, n_neighbors, n_workers=None):
+    """
+    returns (indices, distances), both n x `n_neighbors`: the approximate nearest
+    neighbours of each row of the sparse `matrix` (samples x OTUs), nearest first.
+    each row is its own nearest neighbour, as UMAP expects.
+
+    `metric` is as for pairwise_distances.
+    """
+    from pynndescent import NNDescent
+
+    if metric not in METRICS:
+        raise ValueError("unknown metric: {}".format(metric))
+
+    matrix = scipy.sparse.csr_matrix(matrix, dtype=np.float32)
+    if metric == 'jaccard':
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+
+    index = NNDescent(
+        matrix,
+        metric=metric,
+        n_neighbors=min(n_neighbors, matrix.shape[0]),
+        n_jobs=n_workers or -1,
+        low_memory=True,
+    )
+    indices, distances = index.neighbor_graph
+    return indices, distances.astype(np.float32)
+
+
+def _double_centred_product(dist_matrix, x, block_size):
+    """
+    returns B @ x, where B = -1/2 J D^2 J is the double-centred matrix of squared
+    distances (J being the centring matrix), without forming B or D^2
+    """
+    x = x - x.mean(axis=0)
+    y = np.empty((dist_matrix.shape[0], x.shape[1]), dtype=np.float64)
+    for start in range(0, dist_matrix.shape[0], block_size):
+        block = np.asarray(dist_matrix[start:start + block_size], dtype=np.float64)
+        y[start:start + block_size] = np.square(block) @ x
+    return -0.5 * (y - y.mean(axis=0))
+
+
+def pcoa(dist_matrix, n_components=2, n_oversamples=10, n_iter=4, random_state=0, block_size=1024):
+    """
+    classical principal coordinates analysis of the n x n `dist_matrix`, using a
+    randomized truncated eigendecomposition (Halko et al. 2011): only the largest
+    `n_components` eigenpairs are found, in a handful of passes over the matrix.
+
+    returns (coordinates, proportion_explained): the n x `n_components` coordinates,
+    and the proportion of the total variance along each axis
+    """
+    n = dist_matrix.shape[0]
+    k = min(n_components + n_oversamples, n)
+    rng = np.random.RandomState(random_state)
+
+    # range finder, with power iterations to sharpen the spectrum
+    q, _ = np.linalg.qr(_double_centred_product(dist_matrix, rng.standard_normal((n, k)), block_size))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(_double_centred_product(dist_matrix, q, block_size))
+
+    # Rayleigh-Ritz: the eigenpairs of B restricted to that range
+    eigvals, eigvecs = np.linalg.eigh(q.T @ _double_centred_product(dist_matrix, q, block_size))
+    order = np.argsort(eigvals)[::-1][:n_components]
+    eigvals = eigvals[order]
+    coordinates = (q @ eigvecs[:, order]) * np.sqrt(np.maximum(eigvals, 0))
+
+    # trace(B) is the total variance, and is just the sum of squared distances / 2n
+    total = sum(
+        np.square(np.asarray(dist_matrix[start:start + block_size], dtype=np.float64)).sum()
+        for start in range(0, n, block_size)) / (2 * n)
+    proportion_explained = np.maximum(eigvals, 0) / total if total > 0 else np.zeros_like(eigvals)
+
+    if coordinates.shape[1] < n_components:
+        coordinates = np.hstack((coordinates, np.zeros((n, n_components - coordinates.shape[1]))))
+        proportion_explained = np.concatenate((proportion_explained, np.zeros(n_components - len(proportion_explained))))
+
+    return coordinates, proportion_explained
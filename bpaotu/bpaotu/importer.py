@@ -1,17 +1,19 @@
 import csv
 import datetime
 import gzip
+import io
 import logging
+import multiprocessing
 import os
 import re
-import tempfile
 import traceback
 import uuid
 import time
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-from hashlib import md5
-from itertools import zip_longest
+from hashlib import md5, sha256
+from itertools import islice, zip_longest
 from ._version import __version__
 
 from django.conf import settings
@@ -30,8 +32,7 @@ from sqlalchemy.sql.expression import text
 
 from sqlalchemy_utils import refresh_materialized_view
 
-from Bio import SeqIO
-
+from .blast import blast_databases, build_blast_databases
 from .mail import send_email
 from .otu import (OTU, SCHEMA, Base, Environment, ExcludedSamples,
                   ImportedFile, ImportMetadata, OntologyErrors, OTUAmplicon,
@@ -93,30 +94,196 @@ def otu_hash(code, amplicon_id):
     return md5('{},{}'.format(code, amplicon_id).encode('ascii')).digest()
 
 
-from contextlib import contextmanager
-@contextmanager
-def tmp_csv_file():
-    with tempfile.NamedTemporaryFile(mode='w+',
-                                     dir=settings.BPAOTU_TMP_DIR,
-                                     prefix='bpaotu-') as temp_fd:
-        fname = temp_fd.name
-        os.chmod(fname, 0o644)
-        w = csv.writer(temp_fd)
-        yield w, temp_fd
-        temp_fd.close() # delete now, rather than waiting for garbage collection
+def file_hash(filename, chunk_size=1 << 20):
+    digest = sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CSVRowsReader:
+    """
+    file-like object for copy_expert (COPY ... FROM STDIN CSV), which writes the
+    iterable `rows` out as CSV only as the COPY reads it: at most one batch of
+    rows is buffered beyond the read
+    """
+
+    def __init__(self, rows, name='<rows>', batch_size=1000):
+        self.name = name
+        self._rows = iter(rows)
+        self._batch_size = batch_size
+        self._buf = io.StringIO()
+        self._writer = csv.writer(self._buf)
+        self._data = ''
+        self._pos = 0
+
+    def _fill(self):
+        batch = list(islice(self._rows, self._batch_size))
+        if not batch:
+            self._rows = None
+            return
+        self._buf.seek(0)
+        self._buf.truncate(0)
+        self._writer.writerows(batch)
+        self._data = self._data[self._pos:] + self._buf.getvalue()
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._rows is not None and (size < 0 or len(self._data) - self._pos < size):
+            self._fill()
+        end = len(self._data) if size < 0 else self._pos + size
+        chunk = self._data[self._pos:end]
+        self._pos += len(chunk)
+        return chunk
+
+
+# bytes read from a CSVRowsReader at a time by each COPY
+COPY_READ_SIZE = 1 << 16
+
+
+def copy_from_rows(raw_conn, sql_copy_stmt, rows):
+    """
+    run `sql_copy_stmt` (COPY ... FROM STDIN CSV) on the DBAPI connection
+    `raw_conn`, streaming the `rows` to it
+    """
+    with raw_conn.cursor() as cur:
+        cur.copy_expert(sql_copy_stmt, CSVRowsReader(rows, sql_copy_stmt), size=COPY_READ_SIZE)
+
 
 def is_metaxa_otu(code):
     return code.startswith('mxa_')
 
 
+def otu_abundance_rows(fd, amplicon_code, sample_non_integer):
+    """
+    the validated (otu_hash, sample_id, count, count_20k) rows of the abundance file
+    `fd`. rows with non-integer sample ids are skipped, and the ids added to the set
+    `sample_non_integer`.
+    """
+    reader = csv.reader(fd, dialect='excel-tab')
+    header = [name.lower() for name in next(reader)]
+    expected = ["#otu id", "sample_only", "abundance", "abundance_20k"]
+    if header != expected:
+        raise DataImportError(
+            "Expected tab-separated \"{}\" header in {}".format(' '.join(expected), fd.name))
+
+    integer_re = re.compile(r'^[0-9]+$')
+    samn_id_re = re.compile(r"^SAMN(\d+)$")
+
+    for row in reader:
+        otu_hash, sample_id, count, count_20k = ([f.strip() for f in row] + [""])[:4]
+        count_20k = re.sub(r'[.]0*$', '', count_20k) # Should be integer but we can cope with .0
+        float_count = float(count)
+        int_count = int(float_count)
+        # make sure that fractional values don't creep in on a future ingest
+        assert(int_count - float_count == 0)
+        assert(count_20k == "" or integer_re.match(count_20k))
+        if not integer_re.match(sample_id):
+            if not samn_id_re.match(sample_id):
+                if sample_id not in sample_non_integer:
+                    logger.warning('[{}] skipped non-integer sample ID: {}'.format(amplicon_code, sample_id))
+                    sample_non_integer.add(sample_id)
+                continue
+
+        # Note that an unquoted empty string means NULL to psql COPY. See below
+        yield otu_hash, sample_id, int_count, count_20k
+
+
+def stage_otu_abundance(fname, amplicon_code, staging_table, present_sample_ids,
+                        sample_metadata_incomplete, sample_non_integer):
+    """
+    run in a worker process by DataImporter.load_otu_abundance: validate the
+    abundance file `fname`, and load the rows of samples in `present_sample_ids`
+    into `staging_table`, over a database connection of its own.
+
+    returns (rows_imported, rows_skipped, sample_non_integer, sample_not_in_metadata)
+    """
+    sample_non_integer = set(sample_non_integer)
+    sample_not_in_metadata = set()
+    rows = {'imported': 0, 'skipped': 0}
+
+    def _make_sample_otus(fd):
+        for otu_hash, sample_id, count, count_20k in otu_abundance_rows(fd, amplicon_code, sample_non_integer):
+            rows['imported'] += 1
+            if sample_id not in present_sample_ids:
+                if sample_id not in sample_metadata_incomplete and sample_id not in sample_non_integer:
+                    sample_not_in_metadata.add(sample_id)
+                rows['skipped'] += 1
+                continue
+            yield (sample_id, otu_hash, amplicon_code, count, count_20k)
+
+    # (the connections inherited from the parent process mustn't be used)
+    engine = make_engine()
+    try:
+        with gzip.open(fname, 'rt') as fd:
+            logger.info('[{}] loading OTU abundance staging data into {}'.format(amplicon_code, staging_table))
+            raw_conn = engine.raw_connection()
+            try:
+                copy_from_rows(
+                    raw_conn,
+                    "COPY {} (sample_id, otu_hash, amplicon_code, count, count_20k) FROM STDIN CSV".format(
+                        staging_table),
+                    _make_sample_otus(fd))
+                raw_conn.commit()
+            finally:
+                raw_conn.close()
+    finally:
+        engine.dispose()
+
+    return rows['imported'], rows['skipped'], sample_non_integer, sample_not_in_metadata
+
+
+def read_fasta(fd, chunk_size=1 << 20):
+    """
+    the (id, sequence) of each record in the binary file `fd`, as bytes. as with
+    Bio.SeqIO, the id is the header up to the first whitespace, and anything
+    before the first header is ignored.
+
+    the file is read and split into records a large chunk at a time, rather than
+    a line at a time.
+    """
+    buf = fd.read(chunk_size)
+    start = buf.find(b'>')
+    while start < 0 and buf:
+        buf = fd.read(chunk_size)
+        start = buf.find(b'>')
+    if start < 0:
+        return
+    buf = buf[start + 1:]
+
+    while True:
+        chunk = fd.read(chunk_size)
+        if chunk:
+            buf += chunk
+            end = buf.rfind(b'\n>')
+            if end < 0:
+                continue
+            complete, buf = buf[:end], buf[end + 2:]
+        elif buf:
+            complete, buf = buf, b''
+        else:
+            return
+
+        for record in complete.split(b'\n>'):
+            header, _, sequence = record.partition(b'\n')
+            otu_id = header.split(None, 1)[0] if header.strip() else b''
+            yield otu_id, sequence.translate(None, _FASTA_WHITESPACE)
+
+
+_FASTA_WHITESPACE = b' \t\r\n'
+_HEX_DIGITS = b'0123456789abcdefABCDEF'
+_NUCLEOTIDES = b'GATCN'
+
+
 class FastaRowsIterator:
-    hash_re = re.compile(r'^[a-fA-F0-9]{32}$') # md5
-    code_re = re.compile(r'^[GATCN]+$')
+    fasta_file_info = {}
 
     def __init__(self, fasta_files):
         self.fasta_files = tuple(fasta_files)
 
     def __iter__(self):
+        self.fasta_file_info = {}
         for amplicon_code, fname in self.fasta_files:
             logger.info('reading fasta file: {}'.format(fname))
 
@@ -125,27 +292,36 @@ class FastaRowsIterator:
             # be repeated. Just add the first occurrence to otu.otu.
             # otu,otu.id will not be contiguous, but that's OK.
 
-            with gzip.open(fname, 'rt') as fd:
-                for record in SeqIO.parse(fd, "fasta"):
-                    otu_hash = record.id.strip()
-                    sequence = str(record.seq).upper()
+            rows_imported = 0
+            with gzip.open(fname, 'rb') as fd:
+                for otu_hash, sequence in read_fasta(fd):
+                    rows_imported += 1
+                    sequence = sequence.upper()
 
-                    if not self.hash_re.match(otu_hash):
-                        raise DataImportError("Invalid OTU hash {}".format(otu_hash))
+                    # an md5, and only nucleotides: checked by deleting the allowed bytes
+                    if len(otu_hash) != 32 or otu_hash.translate(None, _HEX_DIGITS):
+                        raise DataImportError("Invalid OTU hash {}".format(otu_hash.decode('ascii', 'replace')))
 
-                    if not self.code_re.match(sequence):
-                        raise DataImportError("Invalid OTU sequence {}".format(sequence))
+                    if not sequence or sequence.translate(None, _NUCLEOTIDES):
+                        raise DataImportError("Invalid OTU sequence {}".format(sequence.decode('ascii', 'replace')))
 
                     yield {
-                        'otu_hash': otu_hash,
-                        'sequence': sequence,
+                        'otu_hash': otu_hash.decode('ascii'),
+                        'sequence': sequence.decode('ascii'),
                         'amplicon_code': amplicon_code,
                     }
+            self.fasta_file_info[fname] = {
+                'file_type': 'Sequences',
+                'amplicon_code': amplicon_code,
+                'rows_imported': rows_imported,
+                'rows_skipped': 0
+            }
 
 
 class TaxonomyRowsIterator:
     hierarchy_type_by_source = {}
     taxonomy_file_info = {}
+    amplicon_by_file = {}
     otu_header = '#otu id'
     amplicon_header = 'amplicon'
     traits_header = 'traits'
@@ -157,6 +333,7 @@ class TaxonomyRowsIterator:
     def __iter__(self):
         self.hierarchy_type_by_source = {}
         self.taxonomy_file_info = {}
+        self.amplicon_by_file = {}
         amplicons_by_code = {}
         for amplicon_code, fname in self.taxonomy_files:
             logger.info('reading taxonomy file: {}'.format(fname))
@@ -230,9 +407,60 @@ class TaxonomyRowsIterator:
                     yield obj
             self.taxonomy_file_info[fname] = {
                 'file_type': 'Taxonomy',
+                'amplicon_code': amplicon_code,
                 'rows_imported': idx + 1,
                 'rows_skipped': 0
             }
+            self.amplicon_by_file[fname] = amplicon
+
+class OntologyIds:
+    """
+    assigns ids to the values of the ontologies in `ontology_defn` (field -> class)
+    as they are seen, so that rows can be loaded in a single pass; the new values
+    are then inserted with save(). `mappings` maps each field to its {value: id}.
+
+    as with DataImporter._build_ontology, the blank value only has an id if one
+    was defined at import init; a value for an ontology that has no values at all
+    raises DataImportError, as with DataImporter._load_ontology.
+    """
+
+    def __init__(self, session, ontology_defn):
+        ids_by_class = {}
+        for db_class in set(ontology_defn.values()):
+            ids_by_class[db_class] = dict((t.value, t.id) for t in session.query(db_class).all())
+        self._classes = ids_by_class
+        self._next_id = dict(
+            (db_class, max(ids.values(), default=0) + 1) for db_class, ids in ids_by_class.items())
+        self._new = defaultdict(list)
+        self.mappings = dict(
+            (field, ids_by_class[db_class]) for field, db_class in ontology_defn.items())
+        self._class_by_field = dict(ontology_defn)
+
+    def id(self, field, value):
+        ids = self.mappings[field]
+        _id = ids.get(value)
+        if _id is None:
+            db_class = self._class_by_field[field]
+            if value == '':
+                # blow up if the ontology hasn't worked
+                if not ids:
+                    raise DataImportError("empty ontology: {}".format(db_class))
+                return None
+            _id = ids[value] = self._next_id[db_class]
+            self._next_id[db_class] += 1
+            self._new[db_class].append({'id': _id, 'value': value})
+        return _id
+
+    def save(self, conn):
+        for db_class, rows in self._new.items():
+            table = db_class.__table__
+            conn.execute(table.insert(), rows)
+            # the ids were assigned here, bypassing the id sequence
+            conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{}', 'id'), "
+                "(SELECT COALESCE(MAX(id), 1) FROM {}))".format(table.fullname, table.fullname)))
+        self._new.clear()
+
 
 class DataImporter:
     # note: some files have species, some don't
@@ -258,7 +486,15 @@ class DataImporter:
         ('store_cond', SampleStorageMethod),
     ])
 
-    def __init__(self, import_base, revision_date, has_sql_context=False, force_fetch=True, notify_email=None):
+    # the files of each amplicon directory, by ImportedFile.file_type
+    amplicon_file_patterns = (
+        ('Sequences', '*_seqs_listSET.fasta.gz'),
+        ('Taxonomy', '*.*.*.taxonomy.gz'),
+        ('Abundance', '*.txt.gz'),
+    )
+
+    def __init__(self, import_base, revision_date, has_sql_context=False, force_fetch=True, notify_email=None,
+                 incremental=False):
         self._engine = make_engine()
         self._create_extensions() # does this need to be after sessionmaker?
         self._session = sessionmaker(bind=self._engine)()
@@ -269,6 +505,8 @@ class DataImporter:
         self._has_sql_context = has_sql_context
         self._force_fetch = force_fetch
         self._notify_email = notify_email or getattr(settings, 'INGEST_NOTIFY_EMAIL', None)
+        # known up front, as the BLAST databases are built for this import before it is complete
+        self._import_uuid = str(uuid.uuid4())
 
         # These are used exclusively for reporting back to CSIRO on the state of the ingest
         self.sample_metadata_incomplete = set()
@@ -277,7 +515,24 @@ class DataImporter:
 
         self.otu_invalid = set()
 
-        # We drop the whole schema and recreate it each time
+        # An incremental import only reloads the amplicon directories whose files have
+        # changed since the previous import (see plan_update). These are the amplicon
+        # codes to reload in full, and those to reload only the abundances of; None
+        # means all of them. The contextual metadata is always reloaded.
+        self._reload_amplicons = None
+        self._reload_abundance = None
+        self._loaded_amplicon_ids = set()
+        self._removed_amplicon_ids = set()
+        self._previous_uuid = None
+        self._incremental = incremental and self._has_fingerprints()
+        if incremental and not self._incremental:
+            logger.warning("No fingerprinted previous import to update: running a full import")
+        if self._incremental:
+            # (any tables new since the previous import)
+            self._create_tables()
+            return
+
+        # Otherwise we drop the whole schema and recreate it each time
         # This is much simpler than trying to do an update / diff on the new ingest vs the old one
         # and is not a problem because we are not trying to preserve any existing ingest data
         #
@@ -290,6 +545,10 @@ class DataImporter:
         self._session.execute(CreateSchema(SCHEMA))
         self._session.commit()
 
+        self._create_tables()
+        self.ontology_init()
+
+    def _create_tables(self):
         # Partitioned tables cannot specify default tablespace in PostgreSQL.
         # We temporarily clear the session's default_tablespace during table creation.
         with self._engine.connect() as conn:
@@ -299,7 +558,18 @@ class DataImporter:
             finally:
                 conn.execute("RESET default_tablespace")
 
-        self.ontology_init()
+    def _has_fingerprints(self):
+        """
+        whether there is a previous import with fingerprinted files to update
+        """
+        inspector = sqlalchemy.inspect(self._engine)
+        tables = inspector.get_table_names(schema=SCHEMA)
+        if not {ImportedFile.__tablename__, ImportMetadata.__tablename__, 'otu_hash_lookup'}.issubset(tables):
+            return False
+        columns = set(column['name'] for column in inspector.get_columns(ImportedFile.__tablename__, schema=SCHEMA))
+        if not {'amplicon_code', 'amplicon_id', 'file_mtime', 'file_hash'}.issubset(columns):
+            return False
+        return self._session.query(ImportMetadata).count() == 1
 
     def _run_phase(self, phase_func, phase_name, phase_desc, phase_timings):
         start_time = time.time()
@@ -314,11 +584,16 @@ class DataImporter:
 
         try:
             # Run each phase of the ingest, recording timings for reporting at the end
+            if self._incremental:
+                self._run_phase(self.plan_update, "Update plan", "Comparing files with the previous import", phase_timings)
             self._run_phase(self.load_contextual_metadata, "Contextual metadata", "Loading contextual metadata", phase_timings)
+            if self._incremental:
+                self._run_phase(self.remove_changed_amplicons, "Changed amplicons", "Removing changed amplicons", phase_timings)
             self._run_phase(self.load_taxonomies, "Taxonomies", "Loading taxonomies", phase_timings)
             self._run_phase(self.load_otu_abundance, "OTU abundance tables", "Loading OTU abundance tables", phase_timings)
             self._run_phase(self.load_taxonomy_otu, "taxonomy_otu_export", "Building taxonomy_otu_export", phase_timings)
             self._run_phase(self.refresh_otu_sample_otu, "refresh_materialized_view", "Refreshing OTUSampleOTU", phase_timings)
+            self._run_phase(self.build_blast_databases, "BLAST databases", "Building BLAST databases", phase_timings)
             self._run_phase(self.complete, "Finalising", "Finalising import", phase_timings)
             self._run_phase(self.update_from_ckan, "CKAN update", "Updating from CKAN", phase_timings)
 
@@ -356,6 +631,9 @@ class DataImporter:
     def complete(self):
         logger.info("Writing import metadata and closing session...")
 
+        if self._incremental:
+            self._session.query(ExcludedSamples).delete()
+
         def write_missing(attr):
             instance = ExcludedSamples(
                 reason=attr,
@@ -376,12 +654,14 @@ class DataImporter:
         self._analyze()
 
     def _write_metadata(self):
+        if self._incremental:
+            self._session.query(ImportMetadata).delete()
         self._session.add(ImportMetadata(
             methodology=self._methodology,
             analysis_url=self._analysis_url,
             revision_date=datetime.datetime.strptime(self._revision_date, "%Y-%m-%d").date(),
             imported_at=datetime.date.today(),
-            uuid=str(uuid.uuid4()),
+            uuid=self._import_uuid,
             sampleotu_count=self._session.query(SampleOTU).count(),
             samplecontext_count=self._session.query(SampleContext).count(),
             otu_count=self._session.query(OTU).count()))
@@ -406,9 +686,11 @@ class DataImporter:
         logger.info("Completed ingest: vacuum analyze")
 
     def _build_ontology(self, db_class, vals):
+        # (an incremental import keeps the values already defined)
+        existing = set(value for (value,) in self._session.query(db_class.value))
         for val in sorted(vals):
             # this option is defined at import init
-            if val == '':
+            if val == '' or val in existing:
                 continue
             instance = db_class(value=val)
             self._session.add(instance)
@@ -442,38 +724,162 @@ class DataImporter:
 
         return mappings
 
-    def amplicon_files(self, pattern):
+    def amplicon_files(self, pattern, amplicon_codes=None):
+        """
+        the (amplicon code, file name) of the files matching `pattern` in each
+        amplicon directory, or just in those of `amplicon_codes` if given
+        """
         for fname in glob(self._import_base + '/*/' + pattern):
             amplicon = fname.split('/')[-2]
-            yield amplicon, fname
+            if amplicon_codes is None or amplicon in amplicon_codes:
+                yield amplicon, fname
 
-    def fasta_files(self, pattern):
-        for fname in glob(self._import_base + '/*/' + pattern):
-            amplicon = fname.split('/')[-2]
-            yield amplicon, fname
+    def fasta_files(self, pattern, amplicon_codes=None):
+        return self.amplicon_files(pattern, amplicon_codes)
 
     def make_file_log(self, filename, **attrs):
-        attrs['file_size'] = os.stat(filename).st_size
+        stat = os.stat(filename)
+        attrs['file_size'] = stat.st_size
+        attrs['file_mtime'] = stat.st_mtime
+        attrs['file_hash'] = file_hash(filename)
         attrs['filename'] = os.path.basename(filename)
         instance = ImportedFile(
             **attrs)
         self._session.add(instance)
         self._session.commit()
 
-    def load_from_csv(self, sql_copy_stmt, fd, conn=None):
+    def load_from_rows(self, sql_copy_stmt, rows, conn=None):
+        """
+        stream the `rows` into the database with `sql_copy_stmt` (COPY ... FROM
+        STDIN CSV), on `conn` if given (e.g. for temporary tables), otherwise on a
+        connection of its own
+        """
+        if conn is not None:
+            copy_from_rows(conn.connection, sql_copy_stmt, rows)
+            return
+
+        raw_conn = self._engine.raw_connection()
         try:
-            fd.flush()
-            fd.seek(0)
-            raw_conn = conn.connection if conn else self._engine.raw_connection()
-            cur = raw_conn.cursor()
-            cur.copy_expert(sql_copy_stmt, fd)
-        except:
-            logger.error("Problem loading data from {} with \"{}\".".format(
-                fd.name, sql_copy_stmt),
-                exc_info=True)
-        finally:
+            copy_from_rows(raw_conn, sql_copy_stmt, rows)
             raw_conn.commit()
-            cur.close()
+        finally:
+            raw_conn.close()
+
+    def plan_update(self):
+        """
+        compares the files of each amplicon directory with those logged by the
+        previous import: an amplicon with a new, changed or removed sequence or
+        taxonomy file is reloaded in full, and one with only changed abundance
+        files has just its abundances reloaded
+        """
+        self._previous_uuid = self._session.query(ImportMetadata).one().uuid
+        previous = dict((f.filename, f) for f in self._session.query(ImportedFile))
+
+        self._reload_amplicons = set()
+        self._reload_abundance = set()
+
+        def reload(file_type, amplicon_code):
+            if file_type == 'Abundance':
+                self._reload_abundance.add(amplicon_code)
+            else:
+                self._reload_amplicons.add(amplicon_code)
+
+        for file_type, pattern in self.amplicon_file_patterns:
+            for amplicon_code, fname in self.amplicon_files(pattern):
+                logged = previous.pop(os.path.basename(fname), None)
+                if logged is None or logged.file_type != file_type or not self._file_unchanged(logged, fname):
+                    reload(file_type, amplicon_code)
+
+        # files which have since been removed
+        for logged in previous.values():
+            reload(logged.file_type, logged.amplicon_code)
+
+        # the other directories loading the same amplicons (e.g. metaxa) have to be
+        # reloaded with them, as the amplicons are removed as a whole
+        amplicon_ids = set(
+            amplicon_id for (amplicon_id,) in self._session.query(ImportedFile.amplicon_id).filter(
+                ImportedFile.amplicon_code.in_(self._reload_amplicons),
+                ImportedFile.amplicon_id.isnot(None)))
+        self._reload_amplicons |= set(
+            amplicon_code for (amplicon_code,) in self._session.query(ImportedFile.amplicon_code).filter(
+                ImportedFile.amplicon_id.in_(amplicon_ids)))
+        self._reload_abundance -= self._reload_amplicons
+
+        logger.info("Amplicons to reload: {}".format(", ".join(sorted(self._reload_amplicons)) or "none"))
+        logger.info("Amplicons to reload abundances of: {}".format(
+            ", ".join(sorted(self._reload_abundance)) or "none"))
+
+    def _file_unchanged(self, logged, fname):
+        stat = os.stat(fname)
+        if logged.file_size != stat.st_size:
+            return False
+        if logged.file_mtime == stat.st_mtime:
+            return True
+        # (e.g. copied again, unchanged)
+        return logged.file_hash == file_hash(fname)
+
+    def remove_changed_amplicons(self):
+        """
+        removes the OTUs, taxonomies and abundances of the amplicons to be reloaded,
+        and the abundances of those with only changed abundance files
+        """
+        reload_amplicons = sorted(self._reload_amplicons)
+        reload_abundance = sorted(self._reload_abundance)
+        amplicon_ids = sorted(set(
+            amplicon_id for (amplicon_id,) in self._session.query(ImportedFile.amplicon_id).filter(
+                ImportedFile.amplicon_code.in_(reload_amplicons),
+                ImportedFile.amplicon_id.isnot(None))))
+        self._session.close()
+
+        with self._engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TEMPORARY TABLE tmp_removed_otu ON COMMIT DROP AS "
+                f"SELECT tu.otu_id AS id FROM {SCHEMA}.taxonomy_otu AS tu "
+                f"JOIN {SCHEMA}.taxonomy AS t ON t.id = tu.taxonomy_id "
+                "WHERE t.amplicon_id = ANY(:amplicon_ids) "
+                f"UNION SELECT id FROM {SCHEMA}.otu_hash_lookup "
+                "WHERE amplicon_code = ANY(:amplicon_codes)"
+            ), amplicon_ids=amplicon_ids, amplicon_codes=reload_amplicons)
+            conn.execute(text("ALTER TABLE tmp_removed_otu ADD PRIMARY KEY (id)"))
+
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.sample_otu WHERE otu_id IN (SELECT id FROM tmp_removed_otu)"))
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.taxonomy_otu_export WHERE amplicon_id = ANY(:amplicon_ids)"
+            ), amplicon_ids=amplicon_ids)
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.taxonomy_otu WHERE taxonomy_id IN ("
+                f"SELECT id FROM {SCHEMA}.taxonomy WHERE amplicon_id = ANY(:amplicon_ids))"
+            ), amplicon_ids=amplicon_ids)
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.taxonomy WHERE amplicon_id = ANY(:amplicon_ids)"
+            ), amplicon_ids=amplicon_ids)
+            # (OTUs still with a taxonomy of another amplicon are kept)
+            conn.execute(text(
+                "DELETE FROM tmp_removed_otu WHERE id IN ("
+                f"SELECT otu_id FROM {SCHEMA}.taxonomy_otu)"))
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.sequence WHERE id IN (SELECT id FROM tmp_removed_otu)"))
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.otu WHERE id IN (SELECT id FROM tmp_removed_otu)"))
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.otu_hash_lookup WHERE amplicon_code = ANY(:amplicon_codes)"
+            ), amplicon_codes=reload_amplicons)
+
+            conn.execute(text(
+                f"DELETE FROM {SCHEMA}.sample_otu WHERE otu_id IN ("
+                f"SELECT id FROM {SCHEMA}.otu_hash_lookup WHERE amplicon_code = ANY(:amplicon_codes))"
+            ), amplicon_codes=reload_abundance)
+
+            conn.execute(
+                ImportedFile.__table__.delete().where(
+                    ImportedFile.amplicon_code.in_(reload_amplicons)))
+            conn.execute(
+                ImportedFile.__table__.delete().where(and_(
+                    ImportedFile.amplicon_code.in_(reload_abundance),
+                    ImportedFile.file_type == 'Abundance')))
+
+        self._removed_amplicon_ids = set(amplicon_ids)
 
     def load_taxonomies(self):
         # Use a database staging table for (otu_hash, amplicon_code) -> otu_id mapping.
@@ -486,44 +892,55 @@ class DataImporter:
             (('amplicon', OTUAmplicon),))
 
         fasta_rows_iter = FastaRowsIterator(
-            self.fasta_files('*_seqs_listSET.fasta.gz'))
+            self.fasta_files('*_seqs_listSET.fasta.gz', self._reload_amplicons))
 
         logger.info("loading sequences - importing fasta file")
 
-        with tmp_csv_file() as (w_otu, otu_fd), tmp_csv_file() as (w_seq, seq_fd), tmp_csv_file() as (w_lookup, lookup_fd):
-            logger.info("Writing OTU hashes to temporary CSV file {}".format(otu_fd.name))
-            logger.info("Writing OTU sequences to temporary CSV file {}".format(seq_fd.name))
-            logger.info("Writing OTU lookup to temporary CSV file {}".format(lookup_fd.name))
-
-            # the id for each otu needs to match the id for the sequence
-            # paranoia dictates we do this manually rather than rely on db id sequence values to be in sync
-            for (_id, row) in enumerate(fasta_rows_iter, 1):
-                w_otu.writerow([_id, row['otu_hash']])
-                w_seq.writerow([_id, row['sequence']])
-                w_lookup.writerow([_id, row['otu_hash'], row['amplicon_code']])
-
-            logger.info(f"Loading OTU hash data from {otu_fd.name}")
-            self.load_from_csv("COPY otu.otu (id, code) FROM STDIN CSV", otu_fd)
-
-            logger.info(f"Loading OTU sequences from {seq_fd.name}")
-            self.load_from_csv("COPY sequence (id, seq) FROM STDIN CSV", seq_fd)
-
-            logger.info(f"Loading OTU lookup from {lookup_fd.name}")
-            with self._engine.begin() as conn:
-                conn.execute(text(
-                    f"CREATE TABLE {SCHEMA}.otu_hash_lookup ("
-                    "id integer NOT NULL PRIMARY KEY, "
-                    "code text NOT NULL, "
-                    "amplicon_code text NOT NULL)"
-                ))
-                conn.execute(text(
-                    f"CREATE INDEX ON {SCHEMA}.otu_hash_lookup (code, amplicon_code)"
-                ))
-                self.load_from_csv(
-                    f"COPY {SCHEMA}.otu_hash_lookup (id, code, amplicon_code) FROM STDIN CSV",
-                    lookup_fd, conn)
+        # (kept after the import, so that an incremental import can reload abundances)
+        with self._engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {SCHEMA}.otu_hash_lookup ("
+                "id integer NOT NULL PRIMARY KEY, "
+                "code text NOT NULL, "
+                "amplicon_code text NOT NULL)"
+            ))
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS otu_hash_lookup_code_amplicon_code_idx "
+                f"ON {SCHEMA}.otu_hash_lookup (code, amplicon_code)"
+            ))
 
-        logger.info(f"Dumped OTU lookup to {lookup_fd.name}")
+        # an incremental import adds to the OTUs and taxonomies already there
+        first_otu_id = (self._session.query(func.max(OTU.id)).scalar() or 0) + 1
+        first_taxonomy_id = (self._session.query(func.max(Taxonomy.id)).scalar() or 0) + 1
+
+        # the id for each otu needs to match the id for the sequence
+        # paranoia dictates we do this manually rather than rely on db id sequence values to be in sync
+        logger.info("Loading OTU hashes, sequences and lookup")
+        with self._engine.begin() as conn:
+            # the fasta files are read once, into a staging table; the otu, sequence
+            # and lookup rows are then inserted from it in order, in the same transaction
+            conn.execute(text(
+                "CREATE TEMPORARY TABLE tmp_otu_load ("
+                "id integer NOT NULL, "
+                "code text NOT NULL, "
+                "amplicon_code text NOT NULL, "
+                "seq text NOT NULL) ON COMMIT DROP"
+            ))
+            self.load_from_rows(
+                "COPY tmp_otu_load (id, code, amplicon_code, seq) FROM STDIN CSV",
+                ((_id, row['otu_hash'], row['amplicon_code'], row['sequence'])
+                 for _id, row in enumerate(fasta_rows_iter, first_otu_id)),
+                conn)
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.otu (id, code) SELECT id, code FROM tmp_otu_load"))
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.sequence (id, seq) SELECT id, seq FROM tmp_otu_load"))
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.otu_hash_lookup (id, code, amplicon_code) "
+                "SELECT id, code, amplicon_code FROM tmp_otu_load"))
+
+        for fname, info in fasta_rows_iter.fasta_file_info.items():
+            self.make_file_log(fname, **info)
 
         # metaxa do not have sequences, just a SHA1 string that starts with mxa_
         # these need to be in the OTU table, but won't a corresponding record in the Sequence table
@@ -543,33 +960,24 @@ class DataImporter:
 
 
         taxonomy_rows_iter = TaxonomyRowsIterator(
-            self.amplicon_files('*.*.*.taxonomy.gz'))
-
+            self.amplicon_files('*.*.*.taxonomy.gz', self._reload_amplicons))
 
-        logger.info("loading taxonomies - pass 1, defining ontologies")
-        mappings = self._load_ontology(
-            ontologies,
-            taxonomy_rows_iter)
-        taxonomy_source_id_by_name = mappings['taxonomy_source']
-        for obj in self._session.query(TaxonomySource).all():
-            obj.hierarchy_type = taxonomy_rows_iter.hierarchy_type_by_source[obj.value]
-        self._session.commit()
 
-        with self._engine.begin() as conn:
-            create_partitions(conn,
-                taxonomy_otu_export.name,
-                taxonomy_source_id_by_name.values())
+        # the files are read once: ontology ids are assigned as the values are seen,
+        # and the ontologies are saved once the rows are loaded
+        ontology_ids = OntologyIds(self._session, ontologies)
+        existing_source_ids = set(ontology_ids.mappings['taxonomy_source'].values())
 
         # TODO need nicer taxonomy source names via some kind of lookup (maybe a yaml file)?
-        logger.info("loading taxonomies - pass 2, defining OTUs")
-        with tmp_csv_file() as (w_tax, tax_fd):
-            logger.info("Writing taxonomies to temporary CSV file {}".format(tax_fd.name))
-            for (_id, row) in enumerate(taxonomy_rows_iter, 1):
+        logger.info("loading taxonomies - defining ontologies and OTUs")
+
+        def taxonomy_rows():
+            for (_id, row) in enumerate(taxonomy_rows_iter, first_taxonomy_id):
                 otu_hash = row['otu']
                 amplicon_code = row.get('amplicon_code', '')
 
                 amplicon = row.get('amplicon', '')
-                amplicon_id = mappings.get('amplicon').get(amplicon, "") # should not be NULL (will cause an error)
+                amplicon_id = ontology_ids.id('amplicon', amplicon) # should not be NULL (will cause an error)
 
                 taxonomy_row = [_id,
                                 amplicon_id,
@@ -577,97 +985,117 @@ class DataImporter:
                                 amplicon_code,
                                 "",
                                 row['traits']] + [
-                    mappings.get(field).get(row.get(field, ''), "")
+                    ontology_ids.id(field, row.get(field, ''))
                     for field in taxonomy_keys]
-                w_tax.writerow(taxonomy_row) # Column order must match taxonomy_fields
-
-
-            # Build the OTU-Taxonomy many-to-many relationships by loading the
-            # taxonomy file data into a temporary table, then deriving
-            # Taxonomy() and OTU() from that.
-
-            with self._engine.begin() as conn:
-                # New session to contain temporary table lifetime
-                tmp_metadata = MetaData()
-                rank_columns = [
-                    Column(rank_id, Integer, nullable=False)
-                    for rank_id in taxonomy_key_id_names]
-                temp_table = Table(
-                    "tmp_taxonomy_load", tmp_metadata,
-                    Column("id", Integer, nullable=False, primary_key=True),
-                    Column("amplicon_id", Integer, nullable=False),
-                    Column("otu_hash", String, nullable=False),
-                    Column("amplicon_code", String, nullable=False),
-                    Column("otu_id", Integer),
-                    Column('traits', ARRAY(String)),
-                    *rank_columns,
-                    prefixes=['TEMPORARY']
-                )
-                temp_table.create(conn)
-                logger.info("Reading taxonomy data from {}".format(tax_fd.name))
-                self.load_from_csv("COPY tmp_taxonomy_load (" +
+                yield taxonomy_row # Column order must match taxonomy_fields
+
+        # Build the OTU-Taxonomy many-to-many relationships by loading the
+        # taxonomy file data into a temporary table, then deriving
+        # Taxonomy() and OTU() from that.
+
+        with self._engine.begin() as conn:
+            # New session to contain temporary table lifetime
+            tmp_metadata = MetaData()
+            rank_columns = [
+                Column(rank_id, Integer, nullable=False)
+                for rank_id in taxonomy_key_id_names]
+            temp_table = Table(
+                "tmp_taxonomy_load", tmp_metadata,
+                Column("id", Integer, nullable=False, primary_key=True),
+                Column("amplicon_id", Integer, nullable=False),
+                Column("otu_hash", String, nullable=False),
+                Column("amplicon_code", String, nullable=False),
+                Column("otu_id", Integer),
+                Column('traits', ARRAY(String)),
+                *rank_columns,
+                prefixes=['TEMPORARY']
+            )
+            temp_table.create(conn)
+            logger.info("Loading taxonomy data")
+            self.load_from_rows("COPY tmp_taxonomy_load (" +
                                 ",".join(taxonomy_fields) +
-                                ") FROM STDIN CSV", tax_fd, conn)
-
-                logger.info("Resolving OTU ids in taxonomy staging table")
-                conn.execute(text(
-                    f"UPDATE tmp_taxonomy_load AS t "
-                    f"SET otu_id = l.id "
-                    f"FROM {SCHEMA}.otu_hash_lookup AS l "
-                    f"WHERE t.otu_hash = l.code "
-                    f"AND t.amplicon_code = l.amplicon_code"
-                ))
+                                ") FROM STDIN CSV", taxonomy_rows(), conn)
+
+            logger.info("Saving taxonomy ontologies")
+            ontology_ids.save(conn)
+            taxonomy_source_id_by_name = ontology_ids.mappings['taxonomy_source']
+            for name, hierarchy_type in taxonomy_rows_iter.hierarchy_type_by_source.items():
+                source_id = taxonomy_source_id_by_name.get(name)
+                if source_id is None:
+                    # (only a header in its files, so the source has no rows or id)
+                    continue
+                conn.execute(
+                    TaxonomySource.__table__.update()
+                    .where(TaxonomySource.__table__.c.id == source_id)
+                    .values(hierarchy_type=hierarchy_type))
+            create_partitions(conn,
+                taxonomy_otu_export.name,
+                set(taxonomy_source_id_by_name.values()) - existing_source_ids)
 
-                logger.info("Inserting missing metaxa OTUs")
-                conn.execute(text(
-                    f"INSERT INTO {SCHEMA}.otu (code) "
-                    f"SELECT DISTINCT t.otu_hash "
-                    f"FROM tmp_taxonomy_load t "
-                    f"WHERE t.otu_id IS NULL AND t.otu_hash LIKE 'mxa_%'"
-                ))
+            logger.info("Resolving OTU ids in taxonomy staging table")
+            conn.execute(text(
+                f"UPDATE tmp_taxonomy_load AS t "
+                f"SET otu_id = l.id "
+                f"FROM {SCHEMA}.otu_hash_lookup AS l "
+                f"WHERE t.otu_hash = l.code "
+                f"AND t.amplicon_code = l.amplicon_code"
+            ))
 
-                conn.execute(text(
-                    "UPDATE tmp_taxonomy_load AS t "
-                    f"SET otu_id = o.id "
-                    f"FROM {SCHEMA}.otu AS o "
-                    f"WHERE t.otu_id IS NULL AND t.otu_hash = o.code"
-                ))
+            logger.info("Inserting missing metaxa OTUs")
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.otu (code) "
+                f"SELECT DISTINCT t.otu_hash "
+                f"FROM tmp_taxonomy_load t "
+                f"WHERE t.otu_id IS NULL AND t.otu_hash LIKE 'mxa_%' "
+                # (an incremental import may already have them)
+                f"AND NOT EXISTS (SELECT 1 FROM {SCHEMA}.otu AS o WHERE o.code = t.otu_hash)"
+            ))
 
-                null_count = conn.execute(text(
-                    "SELECT COUNT(*) FROM tmp_taxonomy_load WHERE otu_id IS NULL"
-                )).scalar()
-                if null_count:
-                    raise DataImportError(
-                        f"Unknown OTU hashes in taxonomy data: {null_count} rows could not be resolved")
-
-                # Build Taxonomy() from unique taxonomies + amplicon + traits in
-                # tmp_taxonomy_load
-                sel = select(
-                    [func.min(temp_table.c.id), temp_table.c.amplicon_id, temp_table.c.traits] +
-                    [getattr(temp_table.c, name) for name in taxonomy_key_id_names]
-                ).group_by('amplicon_id', 'traits', *taxonomy_key_id_names)
-                logger.info("Creating taxonomies")
-                conn.execute(
-                    insert(Taxonomy).from_select(
-                        ['id', 'amplicon_id','traits'] + taxonomy_key_id_names,
-                        sel)
-                )
-                # Build the association table that links Taxonomy() to OTU()
-                join_clauses = [getattr(temp_table.c, name) == getattr(Taxonomy.__table__.c, name)
-                                for name in (taxonomy_key_id_names + ['amplicon_id'])]
-                traits_clause = ((Taxonomy.__table__.c.traits == temp_table.c.traits) |
-                                 ((Taxonomy.__table__.c.traits == None) &
-                                  (temp_table.c.traits == None)))
-                logger.info("Connecting OTUs to taxonomies")
-                conn.execute(
-                    insert(taxonomy_otu).from_select(
-                        ['taxonomy_id', 'otu_id'],
-                        select([Taxonomy.id, temp_table.c.otu_id]).select_from(
-                            temp_table.join(Taxonomy, and_(traits_clause, *join_clauses)))
-                    ))
+            conn.execute(text(
+                "UPDATE tmp_taxonomy_load AS t "
+                f"SET otu_id = o.id "
+                f"FROM {SCHEMA}.otu AS o "
+                f"WHERE t.otu_id IS NULL AND t.otu_hash = o.code"
+            ))
 
+            null_count = conn.execute(text(
+                "SELECT COUNT(*) FROM tmp_taxonomy_load WHERE otu_id IS NULL"
+            )).scalar()
+            if null_count:
+                raise DataImportError(
+                    f"Unknown OTU hashes in taxonomy data: {null_count} rows could not be resolved")
+
+            # Build Taxonomy() from unique taxonomies + amplicon + traits in
+            # tmp_taxonomy_load
+            sel = select(
+                [func.min(temp_table.c.id), temp_table.c.amplicon_id, temp_table.c.traits] +
+                [getattr(temp_table.c, name) for name in taxonomy_key_id_names]
+            ).group_by('amplicon_id', 'traits', *taxonomy_key_id_names)
+            logger.info("Creating taxonomies")
+            conn.execute(
+                insert(Taxonomy).from_select(
+                    ['id', 'amplicon_id','traits'] + taxonomy_key_id_names,
+                    sel)
+            )
+            # Build the association table that links Taxonomy() to OTU()
+            join_clauses = [getattr(temp_table.c, name) == getattr(Taxonomy.__table__.c, name)
+                            for name in (taxonomy_key_id_names + ['amplicon_id'])]
+            traits_clause = ((Taxonomy.__table__.c.traits == temp_table.c.traits) |
+                             ((Taxonomy.__table__.c.traits == None) &
+                              (temp_table.c.traits == None)))
+            logger.info("Connecting OTUs to taxonomies")
+            conn.execute(
+                insert(taxonomy_otu).from_select(
+                    ['taxonomy_id', 'otu_id'],
+                    select([Taxonomy.id, temp_table.c.otu_id]).select_from(
+                        temp_table.join(Taxonomy, and_(traits_clause, *join_clauses)))
+                ))
+
+        amplicon_id_by_name = ontology_ids.mappings['amplicon']
         for fname, info in taxonomy_rows_iter.taxonomy_file_info.items():
-            self.make_file_log(fname, **info)
+            amplicon_id = amplicon_id_by_name.get(taxonomy_rows_iter.amplicon_by_file[fname])
+            self._loaded_amplicon_ids.add(amplicon_id)
+            self.make_file_log(fname, amplicon_id=amplicon_id, **info)
 
     def save_ontology_errors(self, environment_ontology_errors):
         if environment_ontology_errors is None:
@@ -736,24 +1164,29 @@ class DataImporter:
         # check whether or not we are using all the fields to assist us when
         # updating the code for new versions of the source spreadsheet
         utilised_fields = set()
+        if self._incremental:
+            # (saved again as the metadata is read)
+            self._session.query(OntologyErrors).delete()
+            self._session.commit()
         logger.info("loading contextual metadata from bpa-ingest")
         metadata = self.contextual_rows(AccessAMDContextualMetadata, name='amd-metadata')
         logger.info("loading sample context ontologies")
         mappings = self._load_ontology(DataImporter.amd_ontologies, metadata)
 
         column_names = [t.name for t in SampleContext.__table__.columns]
-        with tmp_csv_file() as (w, fd):
-            logger.info("writing sample context metadata to {}".format(fd.name))
-            for row in self.contextual_row_context(metadata, DataImporter.amd_ontologies, mappings, utilised_fields):
-                # Note: column order here must match table field order for COPY table FROM STDIN to work
-                w.writerow(row.get(k) for k in column_names)
-            logger.info("loading sample context metadata from {}".format(fd.name))
-            self.load_from_csv("COPY otu.sample_context FROM STDIN CSV", fd)
-            unused = set(column_names) - utilised_fields
-            if unused:
-                logger.info("Unutilised fields:")
-                for field in sorted(unused):
-                    logger.info(field)
+        logger.info("loading sample context metadata")
+        # Note: column order here must match table field order for COPY table FROM STDIN to work
+        rows = ([row.get(k) for k in column_names]
+                for row in self.contextual_row_context(metadata, DataImporter.amd_ontologies, mappings, utilised_fields))
+        if self._incremental:
+            self._update_sample_context(rows, column_names)
+        else:
+            self.load_from_rows("COPY otu.sample_context FROM STDIN CSV", rows)
+        unused = set(column_names) - utilised_fields
+        if unused:
+            logger.info("Unutilised fields:")
+            for field in sorted(unused):
+                logger.info(field)
 
         # set methodology to store version of code and contextual DB in this format (<packagename>_<version>_<SQLite DB>)
         db_file = ""
@@ -773,101 +1206,135 @@ class DataImporter:
             logger.error(f'Missing "{version_file}" file. Analysis Version and URL will not be added.')
         self._methodology = f"{__package__}_{__version__}__analysis_{analysis_version}__{db_file}__{source_tar}"
 
-    def _otu_abundance_rows(self, fd, amplicon_code):
-        reader = csv.reader(fd, dialect='excel-tab')
-        header = [name.lower() for name in next(reader)]
-        expected = ["#otu id", "sample_only", "abundance", "abundance_20k"]
-        if header != expected:
-            raise DataImportError(
-                "Expected tab-separated \"{}\" header in {}".format(' '.join(expected), fd.name))
-
-        integer_re = re.compile(r'^[0-9]+$')
-        samn_id_re = re.compile(r"^SAMN(\d+)$")
-
-        for row in reader:
-            otu_hash, sample_id, count, count_20k = ([f.strip() for f in row] + [""])[:4]
-            count_20k = re.sub(r'[.]0*$', '', count_20k) # Should be integer but we can cope with .0
-            float_count = float(count)
-            int_count = int(float_count)
-            # make sure that fractional values don't creep in on a future ingest
-            assert(int_count - float_count == 0)
-            assert(count_20k == "" or integer_re.match(count_20k))
-            if not integer_re.match(sample_id):
-                if not samn_id_re.match(sample_id):
-                    if sample_id not in self.sample_non_integer:
-                        logger.warning('[{}] skipped non-integer sample ID: {}'.format(amplicon_code, sample_id))
-                        self.sample_non_integer.add(sample_id)
-                    continue
+    def _update_sample_context(self, rows, column_names):
+        """
+        updates otu.sample_context to the `rows`: samples no longer in the
+        metadata are removed, along with their abundances. new samples mean
+        the abundances of every amplicon are reloaded, as their rows would have
+        been skipped by the previous import.
+        """
+        quoted = ['"{}"'.format(name) for name in column_names]
+        with self._engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TEMPORARY TABLE tmp_sample_context "
+                f"(LIKE {SCHEMA}.sample_context) ON COMMIT DROP"))
+            self.load_from_rows("COPY tmp_sample_context FROM STDIN CSV", rows, conn=conn)
+
+            new_sample_ids = [sample_id for (sample_id,) in conn.execute(text(
+                "SELECT id FROM tmp_sample_context "
+                f"EXCEPT SELECT id FROM {SCHEMA}.sample_context"))]
+
+            removed = (
+                f"SELECT id FROM {SCHEMA}.sample_context "
+                "EXCEPT SELECT id FROM tmp_sample_context")
+            conn.execute(text(f"DELETE FROM {SCHEMA}.sample_otu WHERE sample_id IN ({removed})"))
+            conn.execute(text(f"DELETE FROM {SCHEMA}.sample_meta WHERE sample_id IN ({removed})"))
+            result = conn.execute(text(f"DELETE FROM {SCHEMA}.sample_context WHERE id IN ({removed})"))
+            logger.info("Removed {} samples no longer in the contextual metadata".format(result.rowcount))
 
-            # Note that an unquoted empty string means NULL to psql COPY. See below
-            yield otu_hash, sample_id, int_count, count_20k
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.sample_context ({', '.join(quoted)}) "
+                f"SELECT {', '.join(quoted)} FROM tmp_sample_context "
+                "ON CONFLICT (id) DO UPDATE SET " +
+                ", ".join("{0} = EXCLUDED.{0}".format(name) for name in quoted if name != '"id"')))
+
+        if new_sample_ids:
+            logger.info("{} new samples: reloading all abundances".format(len(new_sample_ids)))
+            self._reload_abundance |= set(
+                amplicon_code for amplicon_code, _ in self.amplicon_files('*.txt.gz')) - self._reload_amplicons
+
+    def _keep_excluded_samples(self, present_sample_ids, amplicon_codes):
+        """
+        an incremental import only reads the abundance files of `amplicon_codes`,
+        so the samples excluded from the other abundance files by the previous
+        import are carried over (bar those which are now in the metadata)
+        """
+        if all(amplicon_code in amplicon_codes for amplicon_code, _ in self.amplicon_files('*.txt.gz')):
+            return
+        for excluded in self._session.query(ExcludedSamples):
+            if excluded.reason == 'sample_non_integer':
+                self.sample_non_integer |= set(excluded.samples)
+            elif excluded.reason == 'sample_not_in_metadata':
+                self.sample_not_in_metadata |= set(excluded.samples) - present_sample_ids
 
     def load_otu_abundance(self):
-        def _make_sample_otus(fname, amplicon_code, present_sample_ids):
-            with gzip.open(fname, 'rt') as fd:
-                tuple_rows = self._otu_abundance_rows(fd, amplicon_code)
-                rows_skipped = 0
-                for entry, (otu_hash, sample_id, count, count_20k) in enumerate(tuple_rows):
-                    if sample_id not in present_sample_ids:
-                        if sample_id not in self.sample_metadata_incomplete \
-                                and sample_id not in self.sample_non_integer:
-                            self.sample_not_in_metadata.add(sample_id)
-                        rows_skipped += 1
-                        continue
-                    yield (sample_id, otu_hash, amplicon_code, count, count_20k)
-                self.make_file_log(
-                    fname, file_type='Abundance', rows_imported=(entry + 1), rows_skipped=rows_skipped)
-
+        """
+        the abundance files are validated and staged in parallel, one per worker
+        process, each into its own staging table. the OTU ids are then resolved from
+        the staging tables in the order of the files, as each becomes ready.
+        """
         present_sample_ids = set([t[0] for t in self._session.query(SampleContext.id)])
+        amplicon_codes = None
+        if self._reload_amplicons is not None:
+            amplicon_codes = self._reload_amplicons | self._reload_abundance
+        abundance_files = list(self.amplicon_files('*.txt.gz', amplicon_codes))
+        if amplicon_codes is not None:
+            self._keep_excluded_samples(present_sample_ids, amplicon_codes)
+
+        staging_tables = []
+        with self._engine.begin() as conn:
+            for i in range(len(abundance_files)):
+                # unlogged, rather than temporary, so that it is visible to the workers
+                staging_table = Table(
+                    "tmp_sample_otu_load_{}".format(i), MetaData(),
+                    Column("sample_id", String, nullable=False),
+                    Column("otu_hash", String, nullable=False),
+                    Column("amplicon_code", String, nullable=False),
+                    Column("count", Integer, nullable=False),
+                    Column("count_20k", String),
+                    schema=SCHEMA,
+                    prefixes=['UNLOGGED']
+                )
+                staging_table.drop(conn, checkfirst=True)
+                staging_table.create(conn)
+                staging_tables.append(staging_table)
 
-        for amplicon_code, sampleotu_fname in self.amplicon_files('*.txt.gz'):
-            def log_amplicon(msg):
-                logger.info('[{}] {}'.format(amplicon_code, msg))
-
-            log_amplicon("reading from: {}".format(sampleotu_fname))
-            with tmp_csv_file() as (w, fd):
-                log_amplicon("writing out OTU abundance data to CSV tempfile: {}".format(fd.name))
-                w.writerows(_make_sample_otus(sampleotu_fname, amplicon_code, present_sample_ids))
-                log_amplicon("loading OTU abundance data into database")
+        # the workers are forked, so mustn't inherit any open connections
+        self._session.close()
+        self._engine.dispose()
+
+        n_workers = settings.BPAOTU_INGEST_WORKERS or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = []
+            for (amplicon_code, sampleotu_fname), staging_table in zip(abundance_files, staging_tables):
+                logger.info('[{}] reading from: {}'.format(amplicon_code, sampleotu_fname))
+                futures.append(executor.submit(
+                    stage_otu_abundance, sampleotu_fname, amplicon_code,
+                    '{}.{}'.format(SCHEMA, staging_table.name), present_sample_ids,
+                    self.sample_metadata_incomplete, self.sample_non_integer))
+
+            for (amplicon_code, sampleotu_fname), staging_table, future in zip(
+                    abundance_files, staging_tables, futures):
+                rows_imported, rows_skipped, sample_non_integer, sample_not_in_metadata = future.result()
+                self.sample_non_integer |= sample_non_integer
+                self.sample_not_in_metadata |= sample_not_in_metadata
+
+                logger.info('[{}] resolving OTU IDs for abundance data'.format(amplicon_code))
                 with self._engine.begin() as conn:
-                    conn.execute(text("DROP TABLE IF EXISTS tmp_sample_otu_load"))
-                    tmp_metadata = MetaData()
-                    temp_table = Table(
-                        "tmp_sample_otu_load", tmp_metadata,
-                        Column("sample_id", String, nullable=False),
-                        Column("otu_hash", String, nullable=False),
-                        Column("amplicon_code", String, nullable=False),
-                        Column("count", Integer, nullable=False),
-                        Column("count_20k", String),
-                        prefixes=['TEMPORARY']
-                    )
-                    temp_table.create(conn)
-                    logger.info("Loading OTU abundance staging data from {}".format(fd.name))
-                    self.load_from_csv(
-                        "COPY tmp_sample_otu_load (sample_id, otu_hash, amplicon_code, count, count_20k) FROM STDIN CSV",
-                        fd, conn)
-                    logger.info("Resolving OTU IDs for abundance data")
                     conn.execute(text(
                         f"INSERT INTO {SCHEMA}.sample_otu (sample_id, otu_id, count, count_20k) "
                         "SELECT s.sample_id, l.id, s.count, NULLIF(s.count_20k, '')::integer "
-                        "FROM tmp_sample_otu_load AS s "
+                        f"FROM {SCHEMA}.{staging_table.name} AS s "
                         f"JOIN {SCHEMA}.otu_hash_lookup AS l "
                         "ON s.otu_hash = l.code AND s.amplicon_code = l.amplicon_code"
                     ))
-
-        with self._engine.begin() as conn:
-            conn.execute(text(f"DROP TABLE IF EXISTS {SCHEMA}.otu_hash_lookup"))
+                    staging_table.drop(conn)
+                self.make_file_log(
+                    sampleotu_fname, file_type='Abundance', amplicon_code=amplicon_code,
+                    rows_imported=rows_imported, rows_skipped=rows_skipped)
 
     def load_taxonomy_otu(self):
+        q = select(
+            [OTU.id, Taxonomy.amplicon_id, Taxonomy.traits] +
+            [getattr(Taxonomy, name) for name in taxonomy_key_id_names]
+        ).select_from(
+            Taxonomy.__table__.join(taxonomy_otu).join(OTU))
+        if self._incremental:
+            q = q.where(Taxonomy.amplicon_id.in_(self._loaded_amplicon_ids))
         with self._engine.begin() as conn:
             conn.execute(
                 insert(taxonomy_otu_export).from_select(
-                    ['otu_id', 'amplicon_id', 'traits'] + taxonomy_key_id_names,
-                    select(
-                        [OTU.id, Taxonomy.amplicon_id, Taxonomy.traits] +
-                        [getattr(Taxonomy, name) for name in taxonomy_key_id_names]
-                    ).select_from(
-                        Taxonomy.__table__.join(taxonomy_otu).join(OTU))))
+                    ['otu_id', 'amplicon_id', 'traits'] + taxonomy_key_id_names, q))
 
     def load_mags_bintable(self):
         logger.info('Building mags bintable')
@@ -1012,6 +1479,21 @@ class DataImporter:
     def refresh_otu_sample_otu(self):
         refresh_materialized_view(self._session, str(OTUSampleOTU.__table__))
 
+    def build_blast_databases(self):
+        reuse = None
+        if self._incremental:
+            # the databases of unchanged amplicons are still valid, as their OTU ids are unchanged
+            changed = self._loaded_amplicon_ids | self._removed_amplicon_ids
+            reuse = dict(
+                (amplicon_id, path)
+                for amplicon_id, path in (blast_databases(self._previous_uuid) or {}).items()
+                if amplicon_id not in changed)
+        try:
+            build_blast_databases(self._session, self._import_uuid, reuse=reuse)
+        except FileNotFoundError as e:
+            # BLAST searches fall back to making their own database
+            logger.warning(f"Could not build BLAST databases (is ncbi-blast+ installed?): {e}")
+
     def update_from_ckan(self):
         update_from_ckan()
 
@@ -0,0 +1,210 @@
+"""
+A minimizer index over the OTU sequences: used to shortlist the OTUs a BLAST
+search could match, and for a fast approximate search.
+
+The minimizers of a sequence are the k-mers with the smallest hash in each window
+of W consecutive k-mers; similar sequences share many of their minimizers. The
+index maps each minimizer (by its hash) to the OTUs containing it, and is saved
+as NumPy arrays which are memory mapped to search.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+K = 15
+W = 10
+
+# the index is only used to shortlist BLAST candidates if a match would be expected
+# to share at least this many minimizers with the query
+MIN_EXPECTED_SHARED = 4
+# and candidates must share at least this fraction of the expected number
+MIN_SHARED_FRACTION = 0.25
+
+_NO_MINIMIZER = np.iinfo(np.uint64).max
+
+_ENCODE = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate((b'Aa', b'Cc', b'Gg', b'Tt')):
+    for _base in _bases:
+        _ENCODE[_base] = _code
+
+
+def _hash(kmers):
+    # invertible 64 bit mix (splitmix64's finaliser), so that the minimizers
+    # aren't biased towards low complexity k-mers like poly-A
+    x = kmers.copy()
+    with np.errstate(over='ignore'):
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xbf58476d1ce4e5b9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94d049bb133111eb)
+        x ^= x >> np.uint64(31)
+    return x
+
+
+def minimizers(sequences, k=K, w=W):
+    """
+    returns (keys, sequence_index): the minimizers (hashed) of each of the
+    `sequences`, and the index of the sequence each is from. sorted by sequence
+    then key, without duplicates. sequences shorter than k + w - 1 have none.
+    """
+    empty = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    codes = _ENCODE[np.frombuffer(''.join(sequences).encode('ascii', 'replace'), dtype=np.uint8)]
+    seq_index = np.repeat(np.arange(len(sequences)), lengths)
+
+    n_kmers = len(codes) - k + 1
+    n_windows = n_kmers - w + 1
+    if n_windows <= 0:
+        return empty
+
+    # 2 bits per base; k-mers with an ambiguous base, or crossing into the next
+    # sequence, are never chosen
+    kmers = np.zeros(n_kmers, dtype=np.uint64)
+    invalid = seq_index[:n_kmers] != seq_index[k - 1:]
+    for i in range(k):
+        c = codes[i:i + n_kmers]
+        kmers = (kmers << np.uint64(2)) | (c & 3).astype(np.uint64)
+        invalid |= c == 4
+    hashes = _hash(kmers)
+    hashes[invalid] = _NO_MINIMIZER
+
+    positions = sliding_window_view(hashes, w).argmin(axis=1) + np.arange(n_windows)
+    keys = hashes[positions]
+    # windows crossing into the next sequence
+    valid = (keys != _NO_MINIMIZER) & (seq_index[:n_windows] == seq_index[w + k - 2:])
+    keys, seq_index = keys[valid], seq_index[:n_windows][valid]
+
+    order = np.lexsort((keys, seq_index))
+    keys, seq_index = keys[order], seq_index[order]
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = (keys[1:] != keys[:-1]) | (seq_index[1:] != seq_index[:-1])
+    return keys[distinct], seq_index[distinct]
+
+
+class KmerIndexBuilder:
+    """
+    collects the minimizers of OTU sequences, added a batch at a time, and
+    saves them as an index for KmerIndex
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._postings = []
+        self._otu_ids = []
+        self._lengths = []
+        self._counts = []
+
+    def add(self, otu_ids, sequences):
+        otu_ids = np.asarray(otu_ids, dtype=np.int32)
+        keys, seq_index = minimizers(sequences)
+        self._keys.append(keys)
+        self._postings.append(otu_ids[seq_index])
+        self._otu_ids.append(otu_ids)
+        self._lengths.append(np.fromiter((len(s) for s in sequences), dtype=np.int32, count=len(sequences)))
+        self._counts.append(np.bincount(seq_index, minlength=len(sequences)).astype(np.int32))
+
+    def save(self, path):
+        keys = np.concatenate(self._keys) if self._keys else np.zeros(0, dtype=np.uint64)
+        postings = np.concatenate(self._postings) if self._postings else np.zeros(0, dtype=np.int32)
+        order = np.lexsort((postings, keys))
+        keys, postings = keys[order], postings[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+
+        otu_ids = np.concatenate(self._otu_ids) if self._otu_ids else np.zeros(0, dtype=np.int32)
+        by_otu = np.argsort(otu_ids)
+
+        np.save(path + '.keys.npy', unique_keys)
+        np.save(path + '.offsets.npy', offsets)
+        np.save(path + '.postings.npy', postings)
+        np.save(path + '.otu_ids.npy', otu_ids[by_otu])
+        np.save(path + '.lengths.npy', np.concatenate(self._lengths)[by_otu] if self._lengths else otu_ids)
+        np.save(path + '.counts.npy', np.concatenate(self._counts)[by_otu] if self._counts else otu_ids)
+
+
+class KmerIndex:
+    def __init__(self, path):
+        def load(name):
+            return np.load(path + name, mmap_mode='r')
+
+        self._keys = load('.keys.npy')
+        self._offsets = load('.offsets.npy')
+        self._postings = load('.postings.npy')
+        self._otu_ids = load('.otu_ids.npy')
+        self._lengths = load('.lengths.npy')
+        self._counts = load('.counts.npy')
+
+    def search(self, sequence):
+        """
+        returns (otu_ids, shared, n_minimizers): the OTUs sharing any minimizers
+        with `sequence`, how many each shares, and the number of minimizers of
+        the sequence
+        """
+        keys, _ = minimizers([sequence])
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        positions = positions[found]
+
+        postings = [self._postings[self._offsets[p]:self._offsets[p + 1]] for p in positions]
+        if not postings:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), len(keys)
+        otu_ids, shared = np.unique(np.concatenate(postings), return_counts=True)
+        return otu_ids, shared, len(keys)
+
+    def otu_attributes(self, otu_ids):
+        """
+        returns (lengths, counts): the sequence length and number of minimizers
+        of each of the `otu_ids`, which must be in the index
+        """
+        positions = np.searchsorted(self._otu_ids, otu_ids)
+        return np.asarray(self._lengths[positions]), np.asarray(self._counts[positions])
+
+
+def shortlist(indexes, sequence, perc_identity, qcov_hsp_perc):
+    """
+    the ids of the OTUs, from the KmerIndex `indexes`, which a BLAST search for
+    `sequence` could match; or None if the sequence is too short or the
+    parameters too permissive for the shortlist to be reliable.
+
+    a k-mer is unchanged at identity p with probability p^k, so a match covering
+    qcov_hsp_perc of the query is expected to share about n * qcov * p^k of the
+    query's n minimizers.
+    """
+    results = [index.search(sequence) for index in indexes]
+    n_minimizers = max((n for _, _, n in results), default=0)
+    expected = n_minimizers * (float(qcov_hsp_perc) / 100) * (float(perc_identity) / 100) ** K
+    if expected < MIN_EXPECTED_SHARED:
+        return None
+
+    min_shared = max(1, int(expected * MIN_SHARED_FRACTION))
+    return np.concatenate(
+        [otu_ids[shared >= min_shared] for otu_ids, shared, _ in results] or [np.zeros(0, dtype=np.int32)])
+
+
+def approximate_search(index, sequence, perc_identity, qcov_hsp_perc, otu_ids=None):
+    """
+    an approximate search without alignment: returns (otu_ids, qlen, slen, length,
+    pident) of the OTUs (from `otu_ids` if given) estimated to match `sequence`.
+
+    the fraction of minimizers shared, out of those of the shorter sequence, is
+    about p^k at identity p; and the shorter sequence is taken to be aligned in full.
+    """
+    candidates, shared, n_minimizers = index.search(sequence)
+    if otu_ids is not None:
+        keep = np.isin(candidates, otu_ids)
+        candidates, shared = candidates[keep], shared[keep]
+
+    qlen = len(sequence)
+    slen, counts = index.otu_attributes(candidates)
+    n_compared = np.minimum(n_minimizers, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pident = 100 * np.minimum(shared / n_compared, 1) ** (1 / K)
+    length = np.minimum(qlen, slen)
+
+    keep = (n_compared > 0) & (pident >= float(perc_identity)) & (100 * length / qlen >= float(qcov_hsp_perc))
+    order = np.argsort(-pident[keep], kind='stable')
+    return (
+        candidates[keep][order], qlen, slen[keep][order],
+        length[keep][order], pident[keep][order])
@@ -11,10 +11,13 @@ class Command(BaseCommand):
         parser.add_argument('--no-force-fetch', action='store_false')
         parser.add_argument('--notify-email', type=str, default = None, 
                             help = 'Email address to notify upon completion or failure')
+        parser.add_argument('--incremental', action='store_true',
+                            help = 'Only reload the amplicons whose files have changed since the previous import')
 
     def handle(self, *args, **kwargs):
         importer = DataImporter(kwargs['base_dir'],
                                  kwargs['revision_date'], 
                                  kwargs['use_sql_context'], 
-                                 kwargs['no_force_fetch'])
+                                 kwargs['no_force_fetch'],
+                                 incremental=kwargs['incremental'])
         importer.run()
@@ -995,6 +995,12 @@ class ImportedFile(SchemaMixin, Base):
     file_size = Column(postgresql.BIGINT)
     rows_imported = Column(postgresql.BIGINT)
     rows_skipped = Column(postgresql.BIGINT)
+    # the amplicon directory the file is from (and for taxonomy files, the amplicon
+    # loaded from it), and a fingerprint of the file for incremental imports
+    amplicon_code = Column(String)
+    amplicon_id = Column(Integer)
+    file_mtime = Column(postgresql.DOUBLE_PRECISION)
+    file_hash = Column(String)
 
 
 
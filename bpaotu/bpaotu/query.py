@@ -1,20 +1,29 @@
 import datetime
+import io
+from bisect import bisect_left
 from functools import partial
 from itertools import chain
 import logging
 import inspect
+import queue
+import threading
+import time
+from types import MappingProxyType
 
+import numpy as np
 import sqlalchemy
 from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker, aliased
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql import operators
 
+from django.conf import settings
 from django.core.cache import caches
 from hashlib import sha256
 
 from .otu import (
     Environment,
+    OntologyMixin,
     OTU,
     Sequence,
     OTUAmplicon,
@@ -45,8 +54,54 @@ Session = sessionmaker(bind=engine)
 CACHE_FOREVER = None
 CACHE_7DAYS = (60 * 60 * 24 * 7)
 
+IMPORT_UUID_TTL = 60  # seconds between checks for a new import
+
 
 __METADATA_UUID = None  # cache
+__METADATA_UUID_CHECKED = 0
+
+
+def import_uuid():
+    """
+    the UUID of the current import. re-read from the database at most every
+    IMPORT_UUID_TTL seconds, so that long running processes notice a re-import
+    """
+    global __METADATA_UUID, __METADATA_UUID_CHECKED
+    now = time.monotonic()
+    if __METADATA_UUID is None or now - __METADATA_UUID_CHECKED > IMPORT_UUID_TTL:
+        try:
+            with MetadataInfo() as info:
+                __METADATA_UUID = info.import_metadata().uuid
+        except sqlalchemy.exc.SQLAlchemyError:
+            # e.g. mid-way through an ingest; keep using what we had
+            if __METADATA_UUID is None:
+                raise
+            logger.warning("Could not re-read import metadata", exc_info=True)
+        __METADATA_UUID_CHECKED = now
+    return __METADATA_UUID
+
+
+class PerImportCache:
+    """
+    holds a single `factory(uuid, session)` instance per process, which is
+    rebuilt when the import UUID changes
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        uuid = import_uuid()
+        with self._lock:
+            if self._instance is None or self._instance.uuid != uuid:
+                session = Session()
+                try:
+                    self._instance = self._factory(uuid, session)
+                finally:
+                    session.close()
+            return self._instance
 
 
 def make_cache_key(*args):
@@ -58,11 +113,7 @@ def make_cache_key(*args):
     something that is stable, and which completely represents the state of the
     object for the cache
     """
-    global __METADATA_UUID
-    if __METADATA_UUID is None:
-        with MetadataInfo() as info:
-            __METADATA_UUID = info.import_metadata().uuid
-    key = __METADATA_UUID + ':' + ':'.join(repr(t) for t in args)
+    key = import_uuid() + ':' + ':'.join(repr(t) for t in args)
     return sha256(key.encode('utf8')).hexdigest()
 
 
@@ -190,121 +241,253 @@ class TaxonomyOptions:
     def __exit__(self, exec_type, exc_value, traceback):
         self._session.close()
 
-    def search(self, selected_amplicon, search_string):
-        # search for the string in each ontology class
-        # and return all taxonomies where it is present
+    def search(self, selected_amplicon, search_string, limit=1000):
+        """
+        search for the string in each taxonomic rank, and return up to `limit`
+        taxonomies (as Taxonomy.to_dict() style dicts) where it is present,
+        best matches first
+        """
+        return taxonomy_trie().search(selected_amplicon, search_string, limit)
 
-        results = []
-        taxonomy_ids = []
+    def possibilities(self, taxonomy_filter):
+        """
+        state should be a list of integer IDs for the relevant model, in the order of
+        TaxonomyOptions.hierarchy. a value of None indicates there is no selection.
+        """
+        return taxonomy_trie().possibilities(taxonomy_filter)
 
-        for (OntologyClass) in taxonomy_ontology_classes[1:]:
-            q1 = (
-                self._session
-                    .query(OntologyClass.id)
-                    .filter(func.lower(OntologyClass.value).like(f"%{search_string.lower()}%"))
-            )
-            # log_query(q1)
 
-            ids = [result[0] for result in q1.all()]
+class TaxonomyTrie:
+    """
+    In-memory index of the taxonomy table, used to answer
+    TaxonomyOptions.possibilities() without any database round trips.
+
+    Each taxonomy is a row of (amplicon_id, taxonomy_source_id, r1_id, ..., r8_id)
+    in an int32 array sorted lexicographically, so that the rows below any
+    prefix of 'is' selections form a contiguous range: walking down the
+    hierarchy is a binary search per rank. 'isnot' selections (and ranks
+    below an unselected amplicon) fall back to a boolean mask over the range.
+    """
+    levels = ['amplicon_id'] + taxonomy_key_id_names
+    level_keys = ['amplicon'] + taxonomy_keys
+    level_classes = [OTUAmplicon] + taxonomy_ontology_classes
+
+    def __init__(self, uuid, session):
+        self.uuid = uuid
+
+        traits_codes = {}
+        ids = []
+        rows = []
+        codes = []
+        q = session.query(Taxonomy.id, *[getattr(Taxonomy, attr) for attr in self.levels], Taxonomy.traits)
+        for row in q.yield_per(10000):
+            traits = None if row[-1] is None else frozenset(row[-1])
+            ids.append(row[0])
+            rows.append(row[1:-1])
+            codes.append(traits_codes.setdefault(traits, len(traits_codes)))
+
+        rows = np.array(rows, dtype=np.int32).reshape(-1, len(self.levels))
+        order = np.lexsort(rows.T[::-1])
+        self._rows = rows[order]
+        self._ids = np.array(ids, dtype=np.int32)[order]
+        self._traits_codes = np.array(codes, dtype=np.int32)[order]
+        self._traits = list(traits_codes)
+
+        ontologies = ontology_cache()
+        self._values = [ontologies.id_to_value[ontology_class] for ontology_class in self.level_classes]
+
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+
+        logger.info("Built taxonomy trie: {} taxonomies".format(len(self._rows)))
+
+    def _narrow(self, view, level, op_and_val):
+        """
+        apply `op_and_val` to the rows in `view` at `level`, returning a new view.
 
-            q2 = (
-                self._session
-                    .query(Taxonomy.id, OntologyClass.id, OntologyClass.value)
-                    .join(OntologyClass)
-                    .filter(OntologyClass.id.in_(ids))
-                    .filter(Taxonomy.amplicon_id == selected_amplicon)
-            )
-            # log_query(q2)
+        a view is (lo, hi, mask, depth): the rows in [lo, hi), optionally
+        restricted by a boolean mask over that range. the first `depth` levels
+        have been fixed by 'is' selections, so column `depth` is sorted within
+        the range.
+        """
+        lo, hi, mask, depth = view
+        if op_and_val is None or op_and_val.get('value') is None:
+            return view
+        value = op_and_val.get('value')
+        column = self._rows[lo:hi, level]
+        if op_and_val.get('operator', 'is') == 'isnot':
+            match = column != value
+        elif depth == level:
+            start, end = np.searchsorted(column, [value, value + 1])
+            if mask is not None:
+                mask = mask[start:end]
+            return lo + start, lo + end, mask, depth + 1
+        else:
+            match = column == value
+        return lo, hi, (match if mask is None else mask & match), depth
 
-            # find the highest independent order (i.e. to prevent duplicates)
-            taxonomy_ids.extend([result[0] for result in q2.all()])
-            taxonomies = [result for result in q2.all()]
+    @staticmethod
+    def _is_empty(view):
+        lo, hi, mask, _ = view
+        return hi <= lo or (mask is not None and not mask.any())
 
-            results.extend(taxonomy_ids)
+    def _traits_mask(self, view, op_and_array):
+        """
+        per-row mask for the traits filter, mirroring apply_op_and_array_filter:
+        rows with no traits never match
+        """
+        lo, hi, _, _ = view
+        value = op_and_array.get('value')
+        if op_and_array.get('operator', 'is') == 'isnot':
+            matches = [traits is not None and value not in traits for traits in self._traits]
+        else:
+            matches = [traits is not None and value in traits for traits in self._traits]
+        return np.array(matches, dtype=bool)[self._traits_codes[lo:hi]]
 
-        if taxonomy_ids:
-            order_by_fields = [Taxonomy.amplicon_id] + [cls.id for cls in taxonomy_ontology_classes]
+    def determine_target(self, taxonomy_filter):
+        """
+        scan through the hierarchy in order and find our target, by finding the
+        first invalid (or missing) selection. returns (target_idx, view), where
+        view holds the rows matching the valid selections above the target.
+        """
+        view = self._narrow((0, len(self._rows), None, 0), 0, taxonomy_filter.amplicon_filter)
+        for idx, taxonomy in enumerate(taxonomy_filter.state_vector):
+            if taxonomy is None or taxonomy.get('value') is None:
+                return idx, view
+            narrowed = self._narrow(view, idx + 1, taxonomy)
+            if self._is_empty(narrowed):
+                return idx, view
+            view = narrowed
+        return None, view
 
-            qtax = (
-                self._session
-                    .query(Taxonomy, *taxonomy_ontology_classes)
-                    .join(*taxonomy_ontology_classes)
-                    .filter(Taxonomy.id.in_(taxonomy_ids))
-                    .order_by(*order_by_fields)
-            )
-            # log_query(qtax)
+    def possibilities(self, taxonomy_filter):
+        target_idx, view = self.determine_target(taxonomy_filter)
 
-            taxonomy_records = [result for result in qtax.all()]
-            taxonomy_records_lcd = [result[0] for result in qtax.all()]
+        # no completion: we have a complete hierarchy
+        if target_idx is None:
+            return {}
 
-            results = taxonomy_records
+        lo, hi, mask, _ = view
+        if taxonomy_filter.trait_filter is not None and taxonomy_filter.trait_filter.get('value') is not None:
+            traits_mask = self._traits_mask(view, taxonomy_filter.trait_filter)
+            mask = traits_mask if mask is None else mask & traits_mask
+        ids = self._rows[lo:hi, target_idx + 1]
+        if mask is not None:
+            ids = ids[mask]
 
-        return results
+        values = self._values[target_idx + 1]
+        possibilities = sorted(
+            ((int(_id), values[_id]) for _id in np.unique(ids).tolist()),
+            key=lambda v: v[1])
 
-    def possibilities(self, taxonomy_filter, force_cache=False):
-        cache = caches['search_results']
-        key = make_cache_key(
-            'TaxonomyOptions.possibilities',
-            taxonomy_filter)
-        result = None
-        if not force_cache:
-            result = cache.get(key)
-        if result is None:
-            result = self._possibilities(taxonomy_filter)
-            cache.set(key, result, CACHE_FOREVER)
-        return result
+        return {
+            'new_options': {
+                'possibilities': possibilities,
+            },
+            # the targets to be reset as a result of this choice
+            'clear': taxonomy_keys[target_idx:]
+        }
 
-    def _possibilities(self, taxonomy_filter):
+    def _to_dict(self, idx):
+        # same shape as Taxonomy.to_dict()
+        d = {'id': int(self._ids[idx])}
+        for level, (key, _id) in enumerate(zip(self.level_keys, self._rows[idx].tolist())):
+            d[key] = {
+                'id': _id,
+                'value': self._values[level][_id],
+            }
+        return d
+
+    def search(self, amplicon_id, search_string, limit):
+        with self._search_index_lock:
+            if self._search_index is None:
+                # only the taxonomic ranks (r1 .. r8) are searched
+                self._search_index = TaxonomySearchIndex(
+                    (level, self._values[level]) for level in range(2, len(self.levels)))
+        matches = self._search_index.match(search_string)
+
+        lo, hi, _, _ = self._narrow(
+            (0, len(self._rows), None, 0), 0,
+            {'value': int(amplicon_id)} if amplicon_id not in (None, '') else None)
+
+        no_match = len(TaxonomySearchIndex.tiers)
+        scores = np.full(hi - lo, no_match, dtype=np.int8)
+        for level, level_matches in matches.items():
+            lookup = np.full(max(self._values[level]) + 1, no_match, dtype=np.int8)
+            lookup[list(level_matches)] = list(level_matches.values())
+            np.minimum(scores, lookup[self._rows[lo:hi, level]], out=scores)
+
+        # a stable sort keeps the rows within each tier in hierarchy order
+        order = np.argsort(scores, kind='stable')
+        order = order[scores[order] < no_match][:limit]
+        return [self._to_dict(lo + idx) for idx in order.tolist()]
+
+
+class TaxonomySearchIndex:
+    """
+    Trigram index over the values of taxonomy ontologies, for case-insensitive
+    substring search. Matches are ranked by tier: exact, then prefix, then
+    substring. Prefix matches come straight from a bisect of the sorted values;
+    substring candidates are the intersection of the postings for each trigram
+    in the search string (or every value, for strings shorter than a trigram).
+    """
+    tiers = ('exact', 'prefix', 'substring')
+    n = 3
+
+    def __init__(self, values_by_level):
+        entries = sorted(
+            (value.lower(), level, _id)
+            for level, values in values_by_level
+            for _id, value in values.items()
+            if value)
+        self._values = [value for value, _, _ in entries]
+        self._keys = [(level, _id) for _, level, _id in entries]
+
+        postings = {}
+        for idx, value in enumerate(self._values):
+            for gram in self._grams(value):
+                postings.setdefault(gram, []).append(idx)
+        self._postings = {gram: np.array(idxs, dtype=np.int32) for gram, idxs in postings.items()}
+
+    @classmethod
+    def _grams(cls, s):
+        return set(s[i:i + cls.n] for i in range(len(s) - cls.n + 1))
+
+    def _candidates(self, term):
+        grams = self._grams(term)
+        if not grams:
+            return range(len(self._values))
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        candidates = postings[0]
+        for other in postings[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, other, assume_unique=True)
+        return np.asarray(candidates, dtype=np.int32).tolist()
+
+    def match(self, search_string):
         """
-        state should be a list of integer IDs for the relevant model, in the order of
-        TaxonomyOptions.hierarchy. a value of None indicates there is no selection.
+        returns {level: {id: tier_index}} for every value containing `search_string`
         """
+        term = search_string.lower()
+        tiers = {}
+        for idx in range(bisect_left(self._values, term), len(self._values)):
+            value = self._values[idx]
+            if not value.startswith(term):
+                break
+            tiers[idx] = 0 if value == term else 1
+        for idx in self._candidates(term):
+            if idx not in tiers and term in self._values[idx]:
+                tiers[idx] = 2
 
-        def determine_target(state):
-            # this query is built up over time, and validates the hierarchy provided to us
-            q = self._session.query(Taxonomy.id)
-            q = apply_amplicon_filter(q, taxonomy_filter.amplicon_filter)
-            for idx, ((taxonomy_attr, ontology_class), taxonomy) in enumerate(zip(TaxonomyOptions.hierarchy, state)):
-                valid = True
-                if taxonomy is None or taxonomy.get('value') is None:
-                    valid = False
-                else:
-                    q = apply_taxonomy_filter(taxonomy_attr, q, taxonomy)
-                    valid = q.first() is not None
-                if not valid:
-                    return taxonomy_attr, ontology_class, idx
-            return None, None, None
+        matches = {}
+        for idx, tier in tiers.items():
+            level, _id = self._keys[idx]
+            matches.setdefault(level, {})[_id] = tier
+        return matches
 
-        # scan through in order and find our target, by finding the first invalid selection
-        target_attr, target_class, target_idx = determine_target(taxonomy_filter.state_vector)
-        # the targets to be reset as a result of this choice
-        clear = taxonomy_keys[target_idx:]
 
-        # no completion: we have a complete hierarchy
-        if target_attr is None:
-            return {}
-        else:
-            # clear invalidated part of the state
-            state = taxonomy_filter.state_vector[:target_idx] + [None] * (
-                len(TaxonomyOptions.hierarchy) - target_idx)
-            # build up a query for our target attribute
-            q = self._session.query(
-                getattr(Taxonomy, target_attr), target_class.value).group_by(
-                    getattr(Taxonomy, target_attr), target_class.value).order_by(target_class.value)
-            q = apply_amplicon_filter(q, taxonomy_filter.amplicon_filter)
-            for (taxonomy_attr, ontology_class), taxonomy in zip(TaxonomyOptions.hierarchy, state):
-                q = apply_taxonomy_filter(taxonomy_attr, q, taxonomy)
-            q = apply_trait_filter(q, taxonomy_filter.trait_filter)
-            q = q.join(target_class)
-            possibilities = q.all()
-
-        result = {
-            'new_options': {
-                'possibilities': possibilities,
-            },
-            'clear': clear
-        }
-        return result
+taxonomy_trie = PerImportCache(TaxonomyTrie)
 
 
 class MetadataInfo:
@@ -330,39 +513,72 @@ class MetadataInfo:
         return self._session.query(OntologyErrors).all()
 
 
+class OntologyCache:
+    """
+    Immutable id <-> value maps for every ontology, loaded once per import,
+    so that ontology lookups don't need to go to the database.
+    """
+
+    def __init__(self, uuid, session):
+        self.uuid = uuid
+        self.id_to_value = {}
+        self.value_to_id = {}
+        self.sorted_values = {}
+        for ontology_class in OntologyMixin.__subclasses__():
+            vals = session.query(ontology_class.id, ontology_class.value).all()
+            self.id_to_value[ontology_class] = MappingProxyType({_id: value for _id, value in vals})
+            self.value_to_id[ontology_class] = MappingProxyType({value: _id for _id, value in vals})
+            self.sorted_values[ontology_class] = tuple(
+                sorted(((_id, value) for _id, value in vals), key=lambda v: v[1]))
+
+        # the ontology values actually used by each SampleContext column
+        self.used_ids = {}
+        for column in SampleContext.__table__.columns:
+            if hasattr(column, "ontology_class"):
+                self.used_ids[column.name] = frozenset(
+                    t[0] for t in session.query(column).filter(column != None).distinct())
+
+        self.taxonomy_labels = MappingProxyType({
+            obj.id: rank_labels_lookup[obj.hierarchy_type]
+            for obj in session.query(TaxonomySource).all()})
+
+
+ontology_cache = PerImportCache(OntologyCache)
+
+
 class OntologyInfo:
     def __init__(self):
-        self._session = Session()
+        self._ontologies = ontology_cache()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exec_type, exc_value, traceback):
-        self._session.close()
+        pass
 
     def get_values(self, ontology_class):
-        vals = self._session.query(ontology_class.id, ontology_class.value).all()
-        vals.sort(key=lambda v: v[1])
-        return vals
+        return self._ontologies.sorted_values[ontology_class]
 
     def get_values_filtered(self, ontology_class, field_id):
-        vals = self._session.query(ontology_class.id, ontology_class.value).filter(ontology_class.id == getattr(SampleContext, field_id)).distinct().all()
-        vals.sort(key=lambda v: v[1])
-        return vals
+        used_ids = self._ontologies.used_ids[field_id]
+        return tuple(v for v in self._ontologies.sorted_values[ontology_class] if v[0] in used_ids)
+
+    def id_to_value_map(self, ontology_class):
+        return self._ontologies.id_to_value[ontology_class]
 
     def id_to_value(self, ontology_class, _id):
         if _id is None:
             return None
-        return self._session.query(ontology_class.value).filter(ontology_class.id == _id).one()[0]
+        return self._ontologies.id_to_value[ontology_class][_id]
 
     def value_to_id(self, ontology_class, value):
         if value is None:
             return None
-        return self._session.query(ontology_class.id).filter(ontology_class.value == value).one()[0]
+        return self._ontologies.value_to_id[ontology_class][value]
 
     def get_taxonomy_labels(self):
-        return {obj.id: rank_labels_lookup[obj.hierarchy_type]
-                for obj in self._session.query(TaxonomySource).all()}
+        # a copy, as it is returned in JSON responses
+        return dict(self._ontologies.taxonomy_labels)
 
 
 class SampleQuery:
@@ -379,6 +595,7 @@ class SampleQuery:
         self._taxonomy_filter = params.taxonomy_filter
         self._contextual_filter = params.contextual_filter
         self._sample_integrity_warnings_filter = params.sample_integrity_warnings_filter
+        self._otu_id_tables = 0
 
     def __enter__(self):
         return self
@@ -450,7 +667,7 @@ class SampleQuery:
         # log_query(q)
         return self._q_all_cached('matching_sample_graph', q)
 
-    def matching_sample_headers(self, required_headers=None, sorting=()):
+    def _sample_headers_query(self, required_headers, sorting):
         query_headers = [SampleContext.id, SampleContext.am_environment_id]
         joins = []  # Keep track of any foreign ontology classes which may be needed to be joined to.
 
@@ -485,9 +702,55 @@ class SampleQuery:
                 q = q.order_by(query_headers[int(sort_col)].desc())
             else:
                 q = q.order_by(query_headers[int(sort_col)])
+        return q
+
+    def matching_sample_headers(self, required_headers=None, sorting=()):
+        q = self._sample_headers_query(required_headers, sorting)
         # log_query(q)
         return self._q_all_cached('matching_sample_headers', q)
 
+    def matching_sample_headers_page(self, required_headers=None, sorting=(), start=0, length=None):
+        """
+        as matching_sample_headers, but only the page of rows [start, start + length)
+        is fetched from the database.
+
+        returns (count, rows), where count is the total number of matching samples. if
+        start is past the end of the results, the last page is returned instead.
+        """
+        # the sample ID is unique, so ordering by it last makes the pages stable
+        q = self._sample_headers_query(required_headers, sorting).order_by(SampleContext.id)
+        rows, count = self._page(q, start, length)
+        if not rows and start > 0 and length:
+            # off the end: we don't get the window count without a row, so count separately
+            count = self._count_cached('matching_sample_headers', q)
+            rows, count = self._page(q, (max(count - 1, 0) // length) * length, length)
+        return count, rows
+
+    def _page(self, q, start, length):
+        # we use a window function here, to get count() over the whole query without having to
+        # run it twice. the count is split off from the returned rows.
+        q = q.add_columns(func.count().over()).offset(start)
+        if length is not None:
+            q = q.limit(length)
+
+        def split_count(result):
+            if not result:
+                return [], 0
+            return [tuple(row[:-1]) for row in result], result[0][-1]
+
+        # log_query(q)
+        return self._q_all_cached('_page', q, mutate_result=split_count)
+
+    def _count_cached(self, topic, q):
+        q = self._session.query(func.count()).select_from(q.order_by(None).subquery(with_labels=True))
+        # log_query(q)
+        return self._q_all_cached(topic + '_count', q, mutate_result=lambda result: result[0][0])
+
+    def matching_sample_count(self):
+        q = self._session.query(SampleContext.id)
+        q = self._assemble_sample_query(q, self._build_taxonomy_subquery())
+        return self._count_cached('matching_sample_count', q)
+
     def matching_selected_samples(self, subq, *query_entities):
         q = self._session.query(*query_entities)
         q = self._assemble_sample_query(q, subq).order_by(SampleContext.id)
@@ -517,11 +780,63 @@ class SampleQuery:
         # log_query(q)
         return q
 
-    def matching_otus(self, otu_ids):
+    def otu_id_set(self, otu_ids=None):
+        """
+        materialise a set of OTU ids into a temporary table, and return the table
+        so that it can be joined against. if `otu_ids` is None the set is the OTUs
+        matching the query filters, built entirely within the database; otherwise
+        the given ids are copied in.
+
+        the table is created within the session's transaction, so it is dropped
+        when this SampleQuery's session is closed (which rolls back).
+        """
+        self._otu_id_tables += 1
+        table = sqlalchemy.Table(
+            'otu_id_set_{}'.format(self._otu_id_tables), sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            prefixes=['TEMPORARY'])
+        conn = self._session.connection()
+        table.create(conn)
+        if otu_ids is None:
+            conn.execute(table.insert().from_select(['id'], self.matching_otu_ids().statement))
+        else:
+            buf = io.StringIO(''.join('{}\n'.format(int(t)) for t in otu_ids))
+            with conn.connection.cursor() as cursor:
+                cursor.copy_expert('COPY {} (id) FROM STDIN'.format(table.name), buf)
+        # the planner has no statistics for a new temporary table
+        conn.execute('ANALYZE {}'.format(table.name))
+        return table
+
+    def otu_id_set_amplicon_ids(self, otu_id_set):
+        """
+        the ids of the amplicons of the OTUs in `otu_id_set`
+        """
+        q = self._session\
+                .query(Taxonomy.amplicon_id)\
+                .join(taxonomy_otu, taxonomy_otu.c.taxonomy_id == Taxonomy.id)\
+                .join(otu_id_set, otu_id_set.c.id == taxonomy_otu.c.otu_id)\
+                .distinct()
+
+        # log_query(q)
+        return [amplicon_id for (amplicon_id,) in q]
+
+    def copy_otu_id_set(self, otu_id_set, fd, prefix='', within=None):
+        """
+        write the ids in `otu_id_set` (and also in the otu_id_set `within`, if
+        given) to the file `fd`, one per line after `prefix`
+        """
+        select = 'SELECT %s || id FROM {}'.format(otu_id_set.name)
+        if within is not None:
+            select += ' JOIN {} USING (id)'.format(within.name)
+        with self._session.connection().connection.cursor() as cursor:
+            sql = cursor.mogrify('COPY ({}) TO STDOUT'.format(select), (prefix,))
+            cursor.copy_expert(sql.decode(), fd)
+
+    def matching_otus(self, otu_id_set):
         q = self._session\
                 .query(OTU.id, OTU.code, Sequence.seq)\
-                .join(Sequence, Sequence.id == OTU.id)\
-                .filter(OTU.id.in_(otu_ids))
+                .join(otu_id_set, otu_id_set.c.id == OTU.id)\
+                .join(Sequence, Sequence.id == OTU.id)
 
         # log_query(q)
         return q
@@ -569,14 +884,14 @@ class SampleQuery:
         # log_query(q)
         return q
 
-    def matching_sample_otus_blast(self, otu_ids):
+    def matching_sample_otus_blast(self, otu_id_set):
         q = self._session\
                 .query(OTU.id, OTU.code, Sequence.seq, SampleOTU.count, SampleContext.id, SampleContext.latitude, SampleContext.longitude)\
                 .join(Taxonomy.otus)\
+                .join(otu_id_set, otu_id_set.c.id == OTU.id)\
                 .join(SampleOTU, SampleOTU.otu_id == OTU.id)\
                 .join(SampleContext, SampleContext.id == SampleOTU.sample_id)\
-                .join(Sequence, Sequence.id == OTU.id)\
-                .filter(OTU.id.in_(otu_ids))
+                .join(Sequence, Sequence.id == OTU.id)
 
         q = self.apply_sample_otu_filters(q)
 
@@ -622,6 +937,20 @@ class SampleQuery:
         # log_query(q)
         return q
 
+    def matching_sample_distance_matrix_size(self):
+        """
+        (samples, OTUs, non-zero abundances) in matching_sample_distance_matrix,
+        counted in the database so that the size of a comparison can be checked
+        before the abundances are fetched
+        """
+        sq = self.matching_sample_distance_matrix().order_by(None).subquery()
+        q = self._session.query(
+            func.count(sqlalchemy.distinct(sq.c.sample_id)),
+            func.count(sqlalchemy.distinct(sq.c.otu_id)),
+            func.count())
+        return self._q_all_cached(
+            'matching_sample_distance_matrix_size', q, mutate_result=lambda result: tuple(result[0]))
+
     def matching_sample_otus_groupby_lat_lng_id_20k(self):
         # Richness and abundance sums will be meaningless if we aren't
         # filtering on taxonomy_source_id, so use NULL in these cases.
@@ -687,10 +1016,8 @@ class SampleQuery:
         """
         applies the passed taxonomy_subquery to apply taxonomy filters.
 
-        paging support: applies limit and offset, and returns (count, [sample_id, ...])
+        paging (with the count of all matching samples) is done by the caller, see _page()
         """
-        # we use a window function here, to get count() over the whole query without having to
-        # run it twice
         q = sample_query
         if taxonomy_subquery is not None:
             q = q.filter(SampleContext.id.in_(taxonomy_subquery))
@@ -1102,6 +1429,134 @@ apply_amplicon_filter = partial(apply_op_and_val_filter, Taxonomy.amplicon_id)
 apply_trait_filter = partial(apply_op_and_array_filter, Taxonomy.traits)
 
 
+def stream_row_batches(q, description, fetch_size=None):
+    """
+    execute `q` with a server-side (named) cursor, yielding lists of plain row
+    tuples. rows are fetched `fetch_size` at a time (default: settings.EXPORT_FETCH_SIZE),
+    and the throughput is logged once the query is exhausted.
+
+    the session's connection is used, so temporary tables etc. are visible.
+    """
+    if fetch_size is None:
+        fetch_size = settings.EXPORT_FETCH_SIZE
+    conn = q.session.connection().execution_options(stream_results=True)
+    result = conn.execute(q.statement)
+    # go straight to the DBAPI cursor to avoid per-row result processing
+    cursor = result.cursor
+    time_start = time.time()
+    row_count = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            row_count += len(rows)
+            yield rows
+    finally:
+        result.close()
+        elapsed = time.time() - time_start
+        logger.info("%s: streamed %d rows in %.1fs (%d rows/sec)",
+                    description, row_count, elapsed, row_count / elapsed if elapsed > 0 else 0)
+
+
+def stream_rows(q, description, fetch_size=None):
+    """
+    as stream_row_batches, but yielding one row tuple at a time
+    """
+    return chain.from_iterable(stream_row_batches(q, description, fetch_size))
+
+
+class _QueueWriter:
+    """
+    file-like object handed to copy_expert, passing the output on to a queue in
+    chunks of about `chunk_size` bytes. gives up if `cancelled` is set.
+    """
+
+    def __init__(self, chunks, cancelled, chunk_size):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self.bytes_written = 0
+
+    def put(self, item):
+        while True:
+            if self._cancelled.is_set():
+                raise IOError("COPY output abandoned by reader")
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        self._buf += data
+        self.bytes_written += len(data)
+        if len(self._buf) >= self._chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buf:
+            self.put(bytes(self._buf))
+            self._buf = bytearray()
+
+
+__COPY_DONE = object()
+
+
+def copy_csv_chunks(q, description, chunk_size=1 << 16, max_chunks=64):
+    """
+    run `q` as `COPY (...) TO STDOUT WITH CSV`, yielding the CSV output as bytes,
+    as the database produces it.
+
+    copy_expert only writes to a file object, so the COPY is run in a thread which
+    hands chunks over through a bounded queue.
+    """
+    conn = q.session.connection()
+    compiled = q.statement.compile(dialect=conn.dialect)
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cursor:
+        # let psycopg2 interpolate the bound parameters, so they are escaped properly
+        copy_sql = 'COPY ({}) TO STDOUT WITH CSV'.format(
+            cursor.mogrify(str(compiled), compiled.params).decode('utf8'))
+
+    chunks = queue.Queue(max_chunks)
+    cancelled = threading.Event()
+    writer = _QueueWriter(chunks, cancelled, chunk_size)
+
+    def run_copy():
+        try:
+            with dbapi_conn.cursor() as cursor:
+                cursor.copy_expert(copy_sql, writer)
+            writer.flush()
+            writer.put(__COPY_DONE)
+        except Exception as e:
+            if not cancelled.is_set():
+                writer.put(e)
+
+    time_start = time.time()
+    thread = threading.Thread(target=run_copy, name='copy_csv_chunks', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is __COPY_DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        thread.join()
+        elapsed = time.time() - time_start
+        logger.info("%s: copied %d bytes in %.1fs (%d bytes/sec)",
+                    description, writer.bytes_written, elapsed,
+                    writer.bytes_written / elapsed if elapsed > 0 else 0)
+
+
 def log_query(q):
     try:
         s = q.statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
@@ -1,6 +1,9 @@
 import io
 import os
+import gzip
+import hashlib
 import json
+import shutil
 import zipstream
 
 from django.conf import settings
@@ -18,6 +21,88 @@ import numpy as np
 import pandas as pd
 
 
+def save_distance_matrix(path, dist_matrix):
+    # float32 halves the size, and is plenty for the CSV export and UMAP
+    if len(dist_matrix) == 0:
+        return
+    np.save(path, np.asarray(dist_matrix, dtype=np.float32))
+
+
+def load_distance_matrix(path, optional=False):
+    """
+    memory map a distance matrix saved by save_distance_matrix, so it's not read
+    until it is used. if the matrix is `optional`, an empty list stands in for one
+    which wasn't calculated; otherwise a missing matrix raises FileNotFoundError.
+    """
+    if optional and not os.path.exists(path):
+        return []
+    return np.load(path, mmap_mode='r')
+
+
+def save_nearest_neighbours(path, nearest_neighbours):
+    indices, distances = nearest_neighbours
+    np.savez(path, indices=indices, distances=distances)
+
+
+def load_nearest_neighbours(path):
+    """
+    the (indices, distances) saved by save_nearest_neighbours, or None if the
+    comparison was small enough to use full distance matrices
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return f['indices'], f['distances']
+
+
+def save_results_payload(path, ordination_path, contextual_path):
+    """
+    combines the ordination and contextual results into the gzipped JSON payload
+    which is served to the browser as is, returning its ETag. the files are copied
+    rather than parsed and re-serialised.
+    """
+    digest = hashlib.sha1()
+
+    class DigestWriter:
+        def __init__(self, out):
+            self._out = out
+
+        def write(self, data):
+            digest.update(data)
+            return self._out.write(data)
+
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=6) as out:
+        writer = DigestWriter(out)
+        writer.write(b'{"ordination":')
+        with open(ordination_path, 'rb') as f:
+            shutil.copyfileobj(f, writer)
+        writer.write(b',"contextual":')
+        with open(contextual_path, 'rb') as f:
+            shutil.copyfileobj(f, writer)
+        writer.write(b'}')
+    os.replace(tmp_path, path)
+
+    # weak, as the same ETag is served with and without the gzip content encoding
+    return 'W/"{}"'.format(digest.hexdigest())
+
+
+def distance_matrix_csv_rows(dist_matrix, sample_ids, block_size=1000):
+    """
+    the distance matrix as CSV, with sample ids as the row and column headers,
+    generated a block of rows at a time
+    """
+    for start in range(0, len(sample_ids), block_size):
+        end = start + block_size
+        buf = io.StringIO()
+        pd.DataFrame(
+            dist_matrix[start:end],
+            index=sample_ids[start:end],
+            columns=sample_ids,
+        ).to_csv(buf, header=(start == 0), float_format="%.6g")
+        yield buf.getvalue().encode('utf8')
+
+
 class SampleComparisonWrapper(BaseTaskWrapper):
     def __init__(self, submission_id, query, status, umap_params_string):
         super().__init__(submission_id, status, "comparison")
@@ -42,19 +127,50 @@ class SampleComparisonWrapper(BaseTaskWrapper):
     def run_params_changed(self):
         self._run_params_changed()
 
+    def _use_nearest_neighbours(self, n_samples):
+        # the full distance matrices are O(n^2) in both memory and time, so large
+        # comparisons only find the nearest neighbours of each sample for UMAP
+        return n_samples >= settings.COMPARISON_UMAP_KNN_MIN_SAMPLES
+
+    def _setup(self):
+        super()._setup()
+
+        # reject comparisons which are too large before fetching any abundances
+        # (the same check is made in _run against the fetched abundances)
+        with SampleQuery(self._params) as query:
+            nunique_sample_id, nunique_otu_id, n_nonzero = query.matching_sample_distance_matrix_size()
+
+        estimated_mb = self._estimate_size(nunique_sample_id, nunique_otu_id, n_nonzero)
+        check = self._check_result_size_ok(estimated_mb)
+
+        if not check['valid']:
+            self._reject_result_size(nunique_sample_id, nunique_otu_id, estimated_mb, check)
+
     def _estimate_pivot_size(self, df):
         nunique_sample_id = df["sample_id"].nunique()
         nunique_otu_id = df["otu_id"].nunique()
-        dtype_size = np.dtype(np.int64).itemsize
-        self._log('info', f"Pivot dimensions: {nunique_sample_id} x {nunique_otu_id} (sample_id x otu_id )")
+        estimated_mb = self._estimate_size(nunique_sample_id, nunique_otu_id, len(df))
 
+        return nunique_sample_id, nunique_otu_id, estimated_mb
+
+    def _estimate_size(self, nunique_sample_id, nunique_otu_id, n_nonzero):
+        self._log('info', f"Matrix dimensions: {nunique_sample_id} x {nunique_otu_id} (sample_id x otu_id ), {n_nonzero} non-zero")
+
+        # the abundance matrix is sparse (CSR: data, column indices and row pointers),
+        # so the dense sample x sample distance matrix is usually the larger part
         estimated_index_bytes = nunique_sample_id * 50 # size per sample is an estimate
-        estimated_data_bytes = nunique_sample_id * nunique_otu_id * dtype_size
-        estimated_bytes = estimated_index_bytes + estimated_data_bytes
+        estimated_sparse_bytes = n_nonzero * (np.dtype(np.int64).itemsize + np.dtype(np.int32).itemsize)
+        # (Bray-Curtis and Jaccard, both float32, or just the nearest neighbours of each sample)
+        if self._use_nearest_neighbours(nunique_sample_id):
+            estimated_distance_bytes = 2 * nunique_sample_id * settings.COMPARISON_UMAP_KNN_NEIGHBORS * (
+                np.dtype(np.int64).itemsize + np.dtype(np.float32).itemsize)
+        else:
+            estimated_distance_bytes = 2 * nunique_sample_id * nunique_sample_id * np.dtype(np.float32).itemsize
+        estimated_bytes = estimated_index_bytes + estimated_sparse_bytes + estimated_distance_bytes
         estimated_mb = estimated_bytes / (1024 ** 2)
-        self._log('info', f"Estimated pivot memory usage: {estimated_mb:.2f} MB")
+        self._log('info', f"Estimated matrix memory usage: {estimated_mb:.2f} MB")
 
-        return nunique_sample_id, nunique_otu_id, estimated_mb
+        return estimated_mb
 
 
     def _check_result_size_ok(self, estimated_mb):
@@ -71,6 +187,17 @@ class SampleComparisonWrapper(BaseTaskWrapper):
 
         return result
 
+    def _reject_result_size(self, nunique_sample_id, nunique_otu_id, estimated_mb, check):
+        submission = Submission(self._submission_id)
+
+        self._status_update(submission, 'error')
+        submission.error = (
+            f'Search has too many elements: {nunique_sample_id} samples and {nunique_otu_id} '
+            f'OTUs for a matrix size of {estimated_mb:.2f} MB.<br />The maximum supported size '
+            f'is {check["size_max"]} MB.<br />Please choose a smaller search space or download '
+            f'OTU data and perform analysis locally.'
+        )
+
 
     def _build_abundance_dataframe(self):
         self._log('info', "Building abundance dataframe in memory")
@@ -107,9 +234,28 @@ class SampleComparisonWrapper(BaseTaskWrapper):
         return pd.read_csv(buff, header=None, names=column_names, dtype=column_dtypes)
 
 
+    def _build_abundance_matrix(self, df):
+        """
+        returns (sample_ids, matrix): the abundances as a sparse CSR matrix with one
+        row per sample (ordered by sample id) and one column per OTU
+        """
+        import scipy.sparse
+
+        samples = pd.Categorical(df['sample_id'])
+        otus = pd.Categorical(df['otu_id'])
+        matrix = scipy.sparse.csr_matrix(
+            (df['abundance'].to_numpy(), (samples.codes, otus.codes)),
+            shape=(len(samples.categories), len(otus.categories)))
+
+        return samples.categories.tolist(), matrix
+
     def _run(self):
         submission = Submission(self._submission_id)
 
+        if submission.status == 'error':
+            # rejected in setup
+            return False
+
         _params, _errors = param_to_filters(self._query)
 
         df = self._build_abundance_dataframe()
@@ -118,45 +264,33 @@ class SampleComparisonWrapper(BaseTaskWrapper):
         check = self._check_result_size_ok(estimated_mb)
 
         if not check['valid']:
-            self._status_update(submission, 'error')
-            submission.error = (
-                f'Search has too many elements: {nunique_sample_id} samples and {nunique_otu_id} '
-                f'OTUs for a matrix size of {estimated_mb:.2f} MB.<br />The maximum supported size '
-                f'is {check["size_max"]} MB.<br />Please choose a smaller search space or download '
-                f'OTU data and perform analysis locally.'
-            )
+            self._reject_result_size(nunique_sample_id, nunique_otu_id, estimated_mb, check)
 
             return False
 
-        self._status_update(submission, 'sort')
-        df = df.sort_values(by=['sample_id', 'otu_id'], ascending=[True, True])
+        self._status_update(submission, 'build_matrix')
+        sample_ids, abundance_matrix = self._build_abundance_matrix(df)
+        del df
 
-        self._status_update(submission, 'pivot')
-        rect_df = (
-            df.pivot(
-                index='sample_id',
-                columns='otu_id',
-                values='abundance'
-            )
-            .fillna(0)
-        )
-
-        actual_bytes = rect_df.memory_usage(deep=True).sum()
+        actual_bytes = sum(a.nbytes for a in (abundance_matrix.data, abundance_matrix.indices, abundance_matrix.indptr))
         actual_mb = actual_bytes / (1024 ** 2)
-        self._log('info', f"Actual pivot memory_usage: {actual_mb:.2f} MB")
-
-        sample_ids = rect_df.index.tolist()
-
-        dist_matrix_braycurtis, dist_matrix_jaccard = self._calc_distance_matrices(rect_df)
-        results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(sample_ids, dist_matrix_braycurtis, dist_matrix_jaccard)
+        self._log('info', f"Actual sparse matrix memory_usage: {actual_mb:.2f} MB")
+
+        if self._use_nearest_neighbours(len(sample_ids)):
+            # (no PCoA without the full distance matrices)
+            results_pcoa = {}
+            distances_braycurtis, distances_jaccard = self._calc_nearest_neighbours(abundance_matrix)
+            results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(
+                sample_ids, distances_braycurtis, distances_jaccard, abundance_matrix)
+        else:
+            dist_matrix_braycurtis, dist_matrix_jaccard = self._calc_distance_matrices(sample_ids, abundance_matrix)
+            results_pcoa = self._calc_pcoa(dist_matrix_braycurtis, dist_matrix_jaccard)
+            results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(sample_ids, dist_matrix_braycurtis, dist_matrix_jaccard)
 
-        ordination_path = self._save_ordination_results(sample_ids, results_braycurtis_umap, results_jaccard_umap)
+        ordination_path = self._save_ordination_results(sample_ids, results_braycurtis_umap, results_jaccard_umap, results_pcoa)
         contextual_path = self._attach_contextual()
 
-        submission.results_files = json.dumps({
-            "ordination_file": ordination_path,
-            "contextual_file": contextual_path
-        })
+        self._save_results_payload(submission, ordination_path, contextual_path)
 
         # since cleapnup/cancel are defined in base_task_wrapper this uses the generically named flag defined in that
         submission.skip_cleanup_on_cancel = 1
@@ -177,24 +311,33 @@ class SampleComparisonWrapper(BaseTaskWrapper):
         with open(self._in("ordination.json"), "r") as f:
             ordination = json.load(f)
 
-        with open(self._in("dist_matrix_braycurtis.json"), "r") as f:
-            dist_matrix_braycurtis = json.load(f)
-
-        with open(self._in("dist_matrix_jaccard.json"), "r") as f:
-            dist_matrix_jaccard= json.load(f)
-
         sample_ids = ordination["sample_ids"]
 
+        # the PCoA doesn't depend on the umap params, so is kept from the prior run
+        results_pcoa = {
+            metric: (np.array(ordination["points"][metric + "_pcoa"]), ordination["pcoa_explained"][metric])
+            for metric in ordination.get("pcoa_explained", {})
+        }
+
         # calculate umap with new params
-        results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(sample_ids, dist_matrix_braycurtis, dist_matrix_jaccard)
+        knn_braycurtis = load_nearest_neighbours(self._in("knn_braycurtis.npz"))
+        if knn_braycurtis is not None:
+            import scipy.sparse
+
+            knn_jaccard = load_nearest_neighbours(self._in("knn_jaccard.npz"))
+            abundance_matrix = scipy.sparse.load_npz(self._in("abundance_matrix.npz"))
+            results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(
+                sample_ids, knn_braycurtis, knn_jaccard, abundance_matrix)
+        else:
+            dist_matrix_braycurtis = load_distance_matrix(self._in("dist_matrix_braycurtis.npy"))
+            # (comparisons from before Jaccard was re-enabled don't have one)
+            dist_matrix_jaccard = load_distance_matrix(self._in("dist_matrix_jaccard.npy"), optional=True)
+            results_braycurtis_umap, results_jaccard_umap = self._calc_umap_embeddings(sample_ids, dist_matrix_braycurtis, dist_matrix_jaccard)
 
-        ordination_path = self._save_ordination_results(sample_ids, results_braycurtis_umap, results_jaccard_umap)
+        ordination_path = self._save_ordination_results(sample_ids, results_braycurtis_umap, results_jaccard_umap, results_pcoa)
         contextual_path = self._attach_contextual()
 
-        submission.results_files = json.dumps({
-            "ordination_file": ordination_path,
-            "contextual_file": contextual_path
-        })
+        self._save_results_payload(submission, ordination_path, contextual_path)
 
         # since cleapnup/cancel are defined in base_task_wrapper this uses the generically named flag defined in that
         submission.skip_cleanup_on_cancel = 1
@@ -203,22 +346,41 @@ class SampleComparisonWrapper(BaseTaskWrapper):
 
         return True
 
+    def _save_results_payload(self, submission, ordination_path, contextual_path):
+        payload_path = self._in("results.json.gz")
+        submission.results_etag = save_results_payload(payload_path, ordination_path, contextual_path)
+        submission.results_files = json.dumps({
+            "ordination_file": ordination_path,
+            "contextual_file": contextual_path,
+            "payload_file": payload_path,
+        })
+
     def _run_contextual_only(self):
         contextual_path = self._attach_contextual()
 
         return True
 
-    def _save_ordination_results(self, sample_ids, results_braycurtis_umap, results_jaccard_umap):
+    def _save_ordination_results(self, sample_ids, results_braycurtis_umap, results_jaccard_umap, results_pcoa=None):
+        """
+        `results_pcoa` maps each metric to its (coordinates, proportion_explained), and
+        is empty if the PCoA wasn't calculated
+        """
         submission = Submission(self._submission_id)
 
+        results_pcoa = results_pcoa or {}
+
         # json
         ordination = {
             'sample_ids': sample_ids,
             'points': {
                 'braycurtis': results_braycurtis_umap.tolist(),
                 'jaccard': results_jaccard_umap.tolist(),
-            }
+            },
+            'pcoa_explained': {},
         }
+        for metric, (coordinates, proportion_explained) in results_pcoa.items():
+            ordination['points'][metric + '_pcoa'] = np.asarray(coordinates).tolist()
+            ordination['pcoa_explained'][metric] = np.asarray(proportion_explained).tolist()
 
         ordination_path = self._in("ordination.json")
         with open(ordination_path, "w") as f:
@@ -229,9 +391,12 @@ class SampleComparisonWrapper(BaseTaskWrapper):
             "sample_id": sample_ids,
             "braycurtis_x": results_braycurtis_umap[:, 0],
             "braycurtis_y": results_braycurtis_umap[:, 1],
-            # "jaccard_x": results_jaccard_umap.values[:, 0],
-            # "jaccard_y": results_jaccard_umap.values[:, 1],
+            "jaccard_x": results_jaccard_umap[:, 0],
+            "jaccard_y": results_jaccard_umap[:, 1],
         })
+        for metric, (coordinates, _) in results_pcoa.items():
+            df[metric + "_pcoa1"] = coordinates[:, 0]
+            df[metric + "_pcoa2"] = coordinates[:, 1]
 
         ordination_path_csv = self._in("ordination.csv")
         df.to_csv(ordination_path_csv, index=False, float_format="%.6g")
@@ -239,53 +404,100 @@ class SampleComparisonWrapper(BaseTaskWrapper):
         return ordination_path
 
 
-    def _calc_distance_matrices(self, rect_df):
-        from fastdist import fastdist
+    def _calc_distance_matrices(self, sample_ids, abundance_matrix):
+        from .distances import pairwise_distances
 
         submission = Submission(self._submission_id)
 
-        self._status_update(submission, 'calc_distances_bc')
-        dist_matrix_braycurtis = fastdist.matrix_pairwise_distance(rect_df.values, fastdist.braycurtis, "braycurtis", return_matrix=True)
+        def calc_distances(metric, status):
+            self._status_update(submission, status)
 
-        # self._status_update(submission, 'calc_distances_j')
-        # dist_matrix_jaccard = fastdist.matrix_pairwise_distance(rect_df.values, fastdist.jaccard, "jaccard", return_matrix=True)
-        dist_matrix_jaccard = []
+            def progress(done, total):
+                self._status_update(submission, status, progress=int(100 * done / total))
 
-        # save the distance matrices for any future resubmissions
-        with open(self._in("dist_matrix_braycurtis.json"), "w") as f:
-            json.dump(dist_matrix_braycurtis, f, cls=NumpyEncoder)
+            return pairwise_distances(
+                abundance_matrix, metric,
+                n_workers=settings.COMPARISON_DISTANCE_WORKERS, progress=progress)
 
-        with open(self._in("dist_matrix_jaccard.json"), "w") as f:
-            json.dump(dist_matrix_jaccard, f, cls=NumpyEncoder)
+        dist_matrix_braycurtis = calc_distances('braycurtis', 'calc_distances_bc')
+        dist_matrix_jaccard = calc_distances('jaccard', 'calc_distances_j')
 
-        df_bc = pd.DataFrame(
-            dist_matrix_braycurtis,
-            index=rect_df.index,
-            columns=rect_df.index,
-        )
-        df_bc.to_csv(
-            self._in("dist_matrix_braycurtis.csv"),
-            float_format="%.6g"
-        )
-        df_jd = pd.DataFrame(
-            dist_matrix_jaccard,
-            index=rect_df.index,
-            columns=rect_df.index,
-        )
-        df_jd.to_csv(
-            self._in("dist_matrix_jaccard.csv"),
-            float_format="%.6g"
-        )
+        # save the distance matrices for any future resubmissions
+        # (the CSV versions are only generated if they are downloaded)
+        save_distance_matrix(self._in("dist_matrix_braycurtis.npy"), dist_matrix_braycurtis)
+        save_distance_matrix(self._in("dist_matrix_jaccard.npy"), dist_matrix_jaccard)
 
         return dist_matrix_braycurtis, dist_matrix_jaccard
 
 
-    def _calc_umap_embeddings(self, rect_index, dist_matrix_braycurtis, dist_matrix_jaccard):
+    def _calc_pcoa(self, dist_matrix_braycurtis, dist_matrix_jaccard):
+        from .distances import pcoa
+
+        submission = Submission(self._submission_id)
+
+        self._status_update(submission, 'calc_pcoa')
+
+        results_pcoa = {}
+        for metric, dist_matrix in (('braycurtis', dist_matrix_braycurtis), ('jaccard', dist_matrix_jaccard)):
+            if len(dist_matrix) > 0:
+                results_pcoa[metric] = pcoa(dist_matrix)
+
+        return results_pcoa
+
+
+    def _calc_nearest_neighbours(self, abundance_matrix):
+        from .distances import nearest_neighbours
+        import scipy.sparse
+
+        submission = Submission(self._submission_id)
+
+        def calc_nearest_neighbours(metric, status):
+            self._status_update(submission, status)
+
+            return nearest_neighbours(
+                abundance_matrix, metric, settings.COMPARISON_UMAP_KNN_NEIGHBORS,
+                n_workers=settings.COMPARISON_DISTANCE_WORKERS)
+
+        knn_braycurtis = calc_nearest_neighbours('braycurtis', 'calc_knn_bc')
+        knn_jaccard = calc_nearest_neighbours('jaccard', 'calc_knn_j')
+
+        # UMAP needs the abundances as well as the neighbours, so keep both for any
+        # future resubmissions
+        save_nearest_neighbours(self._in("knn_braycurtis.npz"), knn_braycurtis)
+        save_nearest_neighbours(self._in("knn_jaccard.npz"), knn_jaccard)
+        scipy.sparse.save_npz(self._in("abundance_matrix.npz"), abundance_matrix)
+
+        return knn_braycurtis, knn_jaccard
+
+
+    def _calc_umap_embeddings(self, rect_index, distances_braycurtis, distances_jaccard, abundance_matrix=None):
+        """
+        the distances are either full distance matrices, or (indices, distances) of the
+        nearest neighbours of each sample, in which case `abundance_matrix` is required
+        """
         import umap.umap_ as umap # this takes a few seconds
 
         submission = Submission(self._submission_id)
 
-        def calc_umap(dist_matrix):
+        def calc_umap(distances, metric):
+            if isinstance(distances, tuple):
+                # only the neighbours of each sample are known; if the UMAP n_neighbors is more
+                # than were found, UMAP falls back to finding them itself from the abundances
+                knn_indices, knn_dists = distances
+                reducer = umap.UMAP(
+                    n_components=2,
+                    n_neighbors=self._param_n_neighbors,
+                    spread=self._param_spread,
+                    min_dist=self._param_min_dist,
+                    metric=metric,
+                    precomputed_knn=(
+                        np.ascontiguousarray(knn_indices[:, :self._param_n_neighbors]),
+                        np.ascontiguousarray(knn_dists[:, :self._param_n_neighbors])),
+                    force_approximation_algorithm=True,
+                )
+
+                return reducer.fit_transform(abundance_matrix)
+
             reducer = umap.UMAP(
                 n_components=2,
                 n_neighbors=self._param_n_neighbors,
@@ -294,16 +506,19 @@ class SampleComparisonWrapper(BaseTaskWrapper):
                 metric='precomputed'
             )
 
-            embeddings = reducer.fit_transform(dist_matrix)
+            embeddings = reducer.fit_transform(distances)
 
             return embeddings
 
         self._status_update(submission, 'calc_umap_bc')
-        results_braycurtis_umap = calc_umap(dist_matrix_braycurtis)
+        results_braycurtis_umap = calc_umap(distances_braycurtis, 'braycurtis')
 
-        # self._status_update(submission, 'calc_umap_j')
-        # results_jaccard_umap = calc_umap(dist_matrix_jaccard)
-        results_jaccard_umap = np.zeros((len(rect_index), 2))
+        if distances_jaccard is not None and len(distances_jaccard) > 0:
+            self._status_update(submission, 'calc_umap_j')
+            results_jaccard_umap = calc_umap(distances_jaccard, 'jaccard')
+        else:
+            # e.g. re-running a comparison made before Jaccard was calculated
+            results_jaccard_umap = np.zeros((len(rect_index), 2))
 
         return results_braycurtis_umap, results_jaccard_umap
 
@@ -433,9 +648,23 @@ def comparison_zip_file_generator(submission_id):
     zf = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
     zf.writestr('info.txt', info_text(params))
 
+    # distance matrices are stored in binary, and converted to CSV here on demand
+    distance_matrices_to_include = [
+        'dist_matrix_braycurtis',
+        'dist_matrix_jaccard',
+    ]
+
+    sample_ids = None
+    for name in distance_matrices_to_include:
+        npy_path = os.path.join(submission.submission_directory, name + '.npy')
+        if not os.path.exists(npy_path):
+            continue
+        if sample_ids is None:
+            with open(os.path.join(submission.submission_directory, 'ordination.json')) as f:
+                sample_ids = json.load(f)['sample_ids']
+        zf.write_iter(name + '.csv', distance_matrix_csv_rows(load_distance_matrix(npy_path), sample_ids))
+
     export_files_to_include = [
-        'dist_matrix_braycurtis.csv',
-        # 'dist_matrix_jaccard.csv',
         'ordination.csv',
         'contextual.csv',
         'definitions.csv',
@@ -474,11 +703,24 @@ Files included:
    Represented as an array of arrays that can be
    reconstructed into a matrix.
 
+-  dist_matrix_jaccard.csv
+
+   The Jaccard distance matrix in CSV format, calculated
+   on the presence or absence of each OTU in each sample.
+
+   The distance matrices are not included for very large
+   comparisons, where the ordination is calculated from the
+   nearest neighbours of each sample instead.
+
 -  ordination.csv
 
    The calculated ordination for the distance matricesin CSV format.
    - "sample_id" has the sample IDs from the search
    - "braycurtis_x" and "braycurtis_y" has the respective umap embeddings for each sample
+   - "jaccard_x" and "jaccard_y" likewise for the Jaccard distances
+   - "braycurtis_pcoa1", "braycurtis_pcoa2", "jaccard_pcoa1" and "jaccard_pcoa2"
+     have the first two principal coordinates (classical PCoA) of each
+     distance matrix (not included for very large comparisons)
 
 -  contextual.csv
 
@@ -222,8 +222,12 @@ DOWNLOADS_CHECKER_USER = env.get('downloads_checker_user', 'downloads_checker')
 DOWNLOADS_CHECKER_PASS = env.get('downloads_checker_pass', 'ch3ck3r')
 DOWNLOADS_CHECKER_SLEEP = env.get('downloads_checker_sleep', 0.0)
 
+# seconds for which the active celery tasks are shared between submission status polls
+ACTIVE_CELERY_TASKS_CACHE_SECONDS = int(env.get('active_celery_tasks_cache_seconds', 5))
+
 # Ingest
-BPAOTU_TMP_DIR = '/var/tmp' # For large temporary files
+# processes used to read the abundance files in parallel (0: one per CPU)
+BPAOTU_INGEST_WORKERS = int(env.get('bpaotu_ingest_workers', 0))
 
 BPAOTU_MISSING_VALUE_SENTINEL = -9999  # Missing values in sample contextual data.
 # See "Confirmed missing value" in
@@ -13,3 +13,17 @@ ROOT_URLCONF = None
 
 # comparison task settings
 COMPARISON_PIVOT_MAX_SIZE_MB = env.get('COMPARISON_PIVOT_MAX_SIZE_MB', 8192)
+# threads used to calculate each distance matrix (0: one per CPU)
+COMPARISON_DISTANCE_WORKERS = int(env.get('COMPARISON_DISTANCE_WORKERS', 0))
+# comparisons with at least this many samples build an approximate nearest neighbour
+# graph for UMAP, rather than the full sample x sample distance matrices
+COMPARISON_UMAP_KNN_MIN_SAMPLES = int(env.get('COMPARISON_UMAP_KNN_MIN_SAMPLES', 10000))
+# neighbours kept per sample in that graph (the upper limit for the UMAP n_neighbors parameter)
+COMPARISON_UMAP_KNN_NEIGHBORS = int(env.get('COMPARISON_UMAP_KNN_NEIGHBORS', 30))
+
+# BLAST task settings
+# searches are split into this many shards, each run by blastn in its own task
+# (so on any free worker) and merged afterwards
+BLAST_SHARDS = int(env.get('BLAST_SHARDS', 1))
+# threads used by each blastn
+BLAST_NUM_THREADS = int(env.get('BLAST_NUM_THREADS', 32))
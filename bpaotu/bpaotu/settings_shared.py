@@ -77,10 +77,18 @@ METAGENOME_REQUEST_EMAIL = env.get('metagenome_request_email', 'am-data-requests
 
 BLAST_RESULTS_PATH = env.get('blast_results_path', '/data/blast-output/')
 BLAST_RESULTS_URL = env.get('blast_results_url', STATIC_URL)
+# per-amplicon BLAST databases, built at ingest (shared between the app and the workers)
+BLAST_DATABASE_PATH = env.get('blast_database_path', '/data/blast-db/')
+# results of BLAST searches, reused by identical searches
+BLAST_CACHE_PATH = env.get('blast_cache_path', '/data/blast-cache/')
+BLAST_CACHE_MAX_SIZE_MB = int(env.get('blast_cache_max_size_mb', 1024)) # (0 to disable)
 
 OTU_EXPORT_PATH = env.get('otu_export_path', '/data/otu-export/')
 OTU_EXPORT_URL = env.get('otu_export_url', STATIC_URL)
 
+# rows fetched per round trip when streaming large export queries
+EXPORT_FETCH_SIZE = int(env.get('export_fetch_size', 10000))
+
 
 ## CKAN CONFIG
 
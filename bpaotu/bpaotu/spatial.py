@@ -32,7 +32,7 @@ def _spatial_query(params):
     """
     with OntologyInfo() as info:
         def make_ontology_export(ontology_cls):
-            values = dict(info.get_values(ontology_cls))
+            values = info.id_to_value_map(ontology_cls)
 
             def _ontology_lookup(x):
                 if x is None:
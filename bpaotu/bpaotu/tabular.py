@@ -11,18 +11,21 @@ from .otu import (
     SampleContext)
 from .util import (
     format_sample_id,
-    str_none_blank,
-    array_or_empty)
+    str_none_blank)
 from .query import (
     log_query,
     OntologyInfo,
     SampleQuery,
-    TaxonomyOptions)
+    TaxonomyOptions,
+    copy_csv_chunks,
+    stream_rows)
 import io
 import os
 import csv
 import logging
 import time
+from sqlalchemy import case, func
+from sqlalchemy.orm import aliased
 from bpaingest.projects.amdb.contextual import AustralianMicrobiomeSampleContextual
 
 from Bio.SeqRecord import SeqRecord
@@ -34,7 +37,7 @@ logger = logging.getLogger('bpaotu')
 def _csv_write_function(column):
     def make_ontology_export(ontology_cls):
         with OntologyInfo() as info:
-            values = dict(info.get_values(ontology_cls))
+            values = info.id_to_value_map(ontology_cls)
 
             def _ontology_lookup(x):
                 if x is None:
@@ -94,9 +97,37 @@ def contextual_csv(samples):
         w.writerow(get_context_value(sample, field) for field in fields)
         yield csv_fd.getvalue().encode('utf_8')
 
-def sample_otu_csv_rows(taxonomy_labels, ids_to_names, q):
+def sample_otu_csv_query(query, ontology_attrs):
+    """
+    the sample OTU rows for the CSV export, with each field formatted in the
+    database (ontology values are resolved by joins) so that the query can be
+    passed straight to COPY
+    """
+    def blank_to_null(expr):
+        # COPY writes NULL as an empty field, but quotes an empty string
+        return func.nullif(expr, '')
+
+    sample_id = case(
+        [(SampleOTU.sample_id.startswith('SAMN'), SampleOTU.sample_id)],
+        else_='102.100.100/' + SampleOTU.sample_id)
+    traits = func.replace(func.array_to_string(Taxonomy.traits, ','), ',', ';')
+
+    ontology_tables = [aliased(getattr(Taxonomy, name).ontology_class) for name in ontology_attrs]
+    q = query.matching_sample_otus(
+        sample_id,
+        OTU.code,
+        SampleOTU.count,
+        *(blank_to_null(table.value) for table in ontology_tables),
+        blank_to_null(traits))
+    for name, table in zip(ontology_attrs, ontology_tables):
+        q = q.outerjoin(table, table.id == getattr(Taxonomy, name))
+    return q
+
+
+def sample_otu_csv_rows(taxonomy_labels, q):
     fd = io.StringIO()
-    w = csv.writer(fd)
+    # match the line endings of the COPY output
+    w = csv.writer(fd, lineterminator='\n')
     w.writerow((
         'Sample ID',
         'OTU',
@@ -105,19 +136,8 @@ def sample_otu_csv_rows(taxonomy_labels, ids_to_names, q):
         taxonomy_labels + (
         'Traits',))
     yield fd.getvalue().encode('utf8')
-    fd.seek(0)
-    fd.truncate(0)
 
-    for row in q.yield_per(50):
-        w.writerow([
-            format_sample_id(row.SampleOTU.sample_id),
-            row.OTU.code,
-            row.SampleOTU.count] +
-            ids_to_names(row.Taxonomy) +
-            [array_or_empty(row.Taxonomy.traits).replace(",", ";")])
-        yield fd.getvalue().encode('utf8')
-        fd.seek(0)
-        fd.truncate(0)
+    yield from copy_csv_chunks(q, 'CSV sample OTU rows')
 
 # different requirements to the otu csv export:
 # - does not need the OTU code (so it is not included in the query)
@@ -131,8 +151,8 @@ def sample_otu_tsv_rows_krona(taxonomy_labels, ids_to_names, q):
     fd.seek(0)
     fd.truncate(0)
 
-    for row in q.yield_per(50):
-        w.writerow([row.SampleOTU.count] + ids_to_names(row.Taxonomy))
+    for count, *taxonomy_ids in stream_rows(q, 'Krona sample OTU rows'):
+        w.writerow([count] + ids_to_names(taxonomy_ids))
         yield fd.getvalue().encode('utf8')
         fd.seek(0)
         fd.truncate(0)
@@ -142,14 +162,10 @@ def sanitise(filename):
 
 def fasta_rows(query):
     logger.debug('Finding all needed otu ids')
+    otu_id_set = query.otu_id_set()
+    logger.debug('Found all needed otu ids')
 
-    otu_ids = []
-    for row in query.matching_otu_ids().yield_per(1000):
-        otu_ids.append(row[0])
-
-    logger.debug(f'Found all needed otu ids: {len(otu_ids)}')
-
-    for otu_id, otu_code, seq in query.matching_otus(otu_ids).yield_per(1000):
+    for otu_id, otu_code, seq in query.matching_otus(otu_id_set).yield_per(1000):
         yield SeqRecord(
                 Seq(seq),
                 id=otu_code,
@@ -175,12 +191,7 @@ def tabular_zip_file_generator(params, onlyContextual):
             taxonomy_labels = taxonomy_labels_by_source[taxonomy_source_id]
 
             ontology_attrs = ['amplicon_id'] + taxonomy_key_id_names[1:len(taxonomy_labels) +1]
-            ontology_lookup_fns = {name: _csv_write_function(getattr(Taxonomy, name)) for name in ontology_attrs}
-
-            q = query.matching_sample_otus(Taxonomy, OTU, SampleOTU)
-
-            def ids_to_names(taxonomy):
-                return [ontology_lookup_fns[name](getattr(taxonomy, name)) for name in ontology_attrs]
+            q = sample_otu_csv_query(query, ontology_attrs)
 
             if rank1_id_is_value is None: # not selecting a specific kingdom
                 # get the rank1 possibilities (domain/kingdom) for the amplicon in this query
@@ -196,13 +207,13 @@ def tabular_zip_file_generator(params, onlyContextual):
                     filename = "{}.csv".format(sanitise(rank1_name))
                     zf.write_iter(
                         filename,
-                        sample_otu_csv_rows(taxonomy_labels, ids_to_names, rank1_query)
+                        sample_otu_csv_rows(taxonomy_labels, rank1_query)
                     )
             else:
                 filename = "{}.csv".format(sanitise(info.id_to_value(rank1_ontology_class, rank1_id_is_value)))
                 zf.write_iter(
                     filename,
-                    sample_otu_csv_rows(taxonomy_labels, ids_to_names, q)
+                    sample_otu_csv_rows(taxonomy_labels, q)
                 )
         return zf
 
@@ -220,12 +231,14 @@ def krona_source_file_generator(tmpdir, params, krona_params_hash):
         taxonomy_labels = taxonomy_labels_by_source[taxonomy_source_id]
 
         ontology_attrs = taxonomy_key_id_names[1:len(taxonomy_labels) +1]
-        ontology_lookup_fns = {name: _csv_write_function(getattr(Taxonomy, name)) for name in ontology_attrs}
+        ontology_columns = [getattr(Taxonomy, name) for name in ontology_attrs]
+        ontology_lookup_fns = [_csv_write_function(column) for column in ontology_columns]
 
-        q = query.matching_sample_otus_krona(sample_id, amplicon_id, taxonomy_source_id)
+        q = query.matching_sample_otus_krona(sample_id, amplicon_id, taxonomy_source_id)\
+                 .with_entities(SampleOTU.count, *ontology_columns)
 
-        def ids_to_names(taxonomy):
-            return [ontology_lookup_fns[name](getattr(taxonomy, name)) for name in ontology_attrs]
+        def ids_to_names(ids):
+            return [fn(_id) for fn, _id in zip(ontology_lookup_fns, ids)]
 
         with open(krona_source_data_filename, 'wb') as file:
             for chunk in sample_otu_tsv_rows_krona(taxonomy_labels, ids_to_names, q):
@@ -1,4 +1,4 @@
-from celery import shared_task
+from celery import chord, shared_task
 
 import os
 import time
@@ -34,6 +34,12 @@ FILE_UPLOAD_STATUS_POLL_FREQUENCY = 5
 # maximum length of a Galaxy history name
 GALAXY_HISTORY_NAME_MAX = 255
 
+# Galaxy datatype for each of the BIOM formats we export
+GALAXY_BIOM_FILE_TYPES = {
+    'json': 'biom1',
+    'hdf5': 'biom2',
+}
+
 
 ##
 ## Periodic Tasks
@@ -162,7 +168,37 @@ def setup_blast(submission_id):
 def run_blast(submission_id):
     submission = Submission(submission_id)
     wrapper = _make_blast_wrapper(submission)
-    wrapper.run()
+
+    # a sharded search fans out over the workers, and is merged once all the shards are done
+    shards = wrapper.start_shards()
+    if shards:
+        # the task ids are kept so that cancelling can revoke every shard
+        header = [run_blast_shard.si(submission_id, shard).set(task_id=str(uuid.uuid4())) for shard in shards]
+        callback = finish_blast.si(submission_id).set(task_id=str(uuid.uuid4()))
+        submission.shard_task_ids = json.dumps([sig.id for sig in header] + [callback.id])
+        chord(header)(callback)
+    else:
+        wrapper.run()
+
+    return submission_id
+
+@shared_task()
+def run_blast_shard(submission_id, shard):
+    submission = Submission(submission_id)
+    if submission.status == 'cancelled':
+        return submission_id
+    wrapper = _make_blast_wrapper(submission)
+    wrapper.run_shard(shard)
+
+    return submission_id
+
+@shared_task()
+def finish_blast(submission_id):
+    submission = Submission(submission_id)
+    if submission.status == 'cancelled':
+        return submission_id
+    wrapper = _make_blast_wrapper(submission)
+    wrapper.finish_shards()
 
     return submission_id
 
@@ -331,8 +367,8 @@ def _make_sample_comparison_wrapper(submission):
 ##
 
 @shared_task
-def submit_to_galaxy(email, query):
-    submission_id = create_galaxy_submission_object(email, query)
+def submit_to_galaxy(email, query, biom_format='json'):
+    submission_id = create_galaxy_submission_object(email, query, biom_format)
     upload_biom_to_history_chain(submission_id)
 
     return submission_id
@@ -353,7 +389,7 @@ def save_biom_file(submission_id):
     # submitted by the user which is a string and we parse it into a query again here.
     # At this point the params were already validated by the submit_to_galaxy view.
     params, _ = param_to_filters(submission.query)
-    biom_zip_file_name = save_biom_zip_file(params, tempfile.mkdtemp())
+    biom_zip_file_name = save_biom_zip_file(params, tempfile.mkdtemp(), submission.biom_format or 'json')
     submission.biom_zip_file_name = biom_zip_file_name
 
     return submission_id
@@ -370,7 +406,8 @@ def create_history_with_file(submission_id):
     submission.history_id = history.get('id')
 
     filename = os.path.split(full_file_name)[1]
-    file_id = galaxy.histories.upload_file(history.get('id'), full_file_name, filename, file_type='biom1')
+    file_type = GALAXY_BIOM_FILE_TYPES[submission.biom_format or 'json']
+    file_id = galaxy.histories.upload_file(history.get('id'), full_file_name, filename, file_type=file_type)
 
     submission.file_id = file_id
 
@@ -419,12 +456,13 @@ def execute_workflow(submission_id, workflow_id):
 
     return submission_id
 
-def create_galaxy_submission_object(email, query):
+def create_galaxy_submission_object(email, query, biom_format='json'):
     submission_id = str(uuid.uuid4())
 
     submission = Submission.create(submission_id)
     submission.query = query
     submission.email = email
+    submission.biom_format = biom_format
 
     params, _ = param_to_filters(query)
     summary = params.summary()
@@ -0,0 +1,50 @@
+from unittest import mock
+
+import sqlalchemy
+from django.test import SimpleTestCase
+from sqlalchemy.dialects import postgresql
+
+from ..otu import SCHEMA
+from ..query import (ContextualFilter, OTUQueryParams, SampleQuery,
+                     TaxonomyFilter, engine)
+
+
+def empty_params():
+    return OTUQueryParams(
+        contextual_filter=ContextualFilter('and', None),
+        taxonomy_filter=TaxonomyFilter(None, [], None),
+        sample_integrity_warnings_filter=ContextualFilter('and', None))
+
+
+def otu_database_available():
+    try:
+        return engine.has_table('otu', schema=SCHEMA)
+    except sqlalchemy.exc.OperationalError:
+        return False
+
+
+@mock.patch('bpaotu.query.import_uuid', lambda: 'test')
+class MatchingSampleOTUsBlastTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # (checked here rather than at import, so the module loads without a database)
+        cls.otu_database_available = otu_database_available()
+
+    def test_compiles(self):
+        otu_id_set = sqlalchemy.Table(
+            'otu_id_set_1', sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True))
+        with SampleQuery(empty_params()) as query:
+            q = query.matching_sample_otus_blast(otu_id_set)
+            sql = str(q.statement.compile(dialect=postgresql.dialect()))
+        # a single FROM: the id set is joined onto the OTUs of the taxonomies
+        self.assertEqual(sql.count('FROM'), 1)
+        self.assertIn('JOIN otu_id_set_1 ON otu_id_set_1.id = otu.otu.id', sql)
+
+    def test_runs(self):
+        if not self.otu_database_available:
+            self.skipTest("no database with an OTU import")
+        with SampleQuery(empty_params()) as query:
+            rows = query.matching_sample_otus_blast(query.otu_id_set([])).all()
+        self.assertEqual(rows, [])
@@ -40,6 +40,7 @@ urlpatterns = [
     url(r'^private/api/v1/cancel_comparison$', views.cancel_comparison, name="cancel_comparison"),
     url(r'^private/api/v1/clear_comparison$', views.clear_comparison, name="clear_comparison"),
     url(r'^private/api/v1/comparison_submission$', views.comparison_submission, name="comparison_submission"),
+    url(r'^private/api/v1/comparison_results$', views.comparison_results, name="comparison_results"),
     url(r'^private/api/v1/comparison_download_distance_matrices$', views.comparison_download_distance_matrices, name="comparison_download_distance_matrices"),
     url(r'^private/api/v1/submit_otuexport$', views.submit_otuexport, name="submit_otuexport"),
     url(r'^private/api/v1/cancel_otuexport$', views.cancel_otuexport, name="cancel_otuexport"),
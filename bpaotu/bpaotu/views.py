@@ -1,4 +1,5 @@
 import csv
+import gzip
 import math
 import numpy as np
 import pandas as pd
@@ -14,23 +15,26 @@ import uuid
 from functools import wraps
 from operator import itemgetter
 from io import BytesIO
+from wsgiref.util import FileWrapper
 from xhtml2pdf import pisa
 
 from sqlalchemy import Float, Integer
 
 from django.conf import settings
-from django.http import (HttpResponse, JsonResponse, HttpResponseServerError, StreamingHttpResponse)
+from django.core.cache import caches
+from django.http import (Http404, HttpResponse, JsonResponse, HttpResponseServerError, StreamingHttpResponse)
 from django.template import loader
 from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.http import condition, require_GET, require_POST
 from bpaotu.auth_app.decorators import require_oauth
 
 from celery import current_app
 
 from . import tasks
-from .biom import biom_zip_file_generator
+from .biom import BIOM_FORMATS, biom_zip_file_generator
 from .contextual import contextual_definitions, get_contextual_schema_definition, make_environment_lookup
 from .galaxy_client import galaxy_ensure_user, get_krona_workflow
 from .krona import KronaPlot
@@ -45,7 +49,7 @@ from .query import (ContextualFilter, ContextualFilterTermDate, ContextualFilter
                     MetadataInfo, OntologyInfo, OTUQueryParams, SampleQuery,
                     TaxonomyFilter, TaxonomyOptions)
 from .site_images import fetch_image, get_site_image_lookup_table, make_ckan_remote
-from .sample_comparison import comparison_zip_file_generator
+from .sample_comparison import comparison_zip_file_generator, save_results_payload
 from .spatial import spatial_query
 from .submission import Submission
 from .tabular import tabular_zip_file_generator
@@ -117,6 +121,7 @@ def api_config(request):
         'cancel_comparison_endpoint': reverse('cancel_comparison'),
         'clear_comparison_endpoint': reverse('clear_comparison'),
         'comparison_submission_endpoint': reverse('comparison_submission'),
+        'comparison_results_endpoint': reverse('comparison_results'),
         'comparison_download_distance_matrices_endpoint': reverse('comparison_download_distance_matrices'),
         'submit_otuexport_endpoint': reverse('submit_otuexport'),
         'cancel_otuexport_endpoint': reverse('cancel_otuexport'),
@@ -290,13 +295,8 @@ def otu_search(request, contextual_filtering=True):
         })
 
     with SampleQuery(params) as query:
-        results = query.matching_sample_headers(additional_headers, sorting)
-
-    result_count = len(results)
-
-    if start >= result_count:
-        start = (result_count // length) * length
-    results = results[start:start + length]
+        result_count, results = query.matching_sample_headers_page(
+            additional_headers, sorting, start or 0, length)
 
     def get_environment(environment_id):
         if environment_id is None:
@@ -363,10 +363,14 @@ def otu_export(request):
 def otu_biom_export(request):
     timestamp = make_timestamp()
     params, errors = param_to_filters(request.GET['q'])
+    # 'json' (BIOM 1.0) or 'hdf5' (BIOM 2.1)
+    biom_format = request.GET.get('format', 'json')
+    if biom_format not in BIOM_FORMATS:
+        return JsonResponse({ "error": "format must be one of: {}".format(", ".join(BIOM_FORMATS)) }, status=400)
 
     track(request, 'otu_export_BIOM', search_params_track_args(params))
 
-    zf = biom_zip_file_generator(params, timestamp)
+    zf = biom_zip_file_generator(params, timestamp, biom_format)
     response = StreamingHttpResponse(zf, content_type='application/zip')
     filename = params.filename(timestamp, '.biom.zip')
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
@@ -420,7 +424,7 @@ def taxonomy_search(request):
 
 def serialise_taxa_search_result(result):
     return {
-        'taxonomy': result[0].to_dict(),
+        'taxonomy': result,
     }
 
 
@@ -643,8 +647,11 @@ def do_on_galaxy(galaxy_action):
 @do_on_galaxy
 def submit_to_galaxy(request, email):
     '''Submits the search results as a biom file into a new history in Galaxy.'''
+    biom_format = request.POST.get('biom_format', 'json')
+    if biom_format not in BIOM_FORMATS:
+        raise OTUError("Unknown BIOM format: {}".format(biom_format))
     user_created = galaxy_ensure_user(email)
-    submission_id = tasks.submit_to_galaxy.delay(email, request.POST['query'])
+    submission_id = tasks.submit_to_galaxy.delay(email, request.POST['query'], biom_format)
 
     track(request, "otu_submit_to_galaxy", submission_id)
 
@@ -883,6 +890,7 @@ def blast_submission(request):
         'submission': {
             'id': submission_id,
             'state': state,
+            'progress': submission.progress,
             'duration': None,
             'timestamps': timestamps,
             'row_count': submission.row_count,
@@ -1033,26 +1041,23 @@ def clear_comparison(request):
 @require_oauth
 @require_GET
 def comparison_submission(request):
+    """
+    the state of a comparison, which is polled by the frontend; once it is complete,
+    the results themselves are fetched from comparison_results
+    """
     submission_id = request.GET['submission_id']
     submission = Submission(submission_id)
     state = submission.status
     timestamps = timestamps_relative(submission.timestamps)
 
-    # look for an active task with the submission_id in the task args
-    active_tasks = get_active_celery_tasks()
-    task_found = any(submission_id in task["args"] for task in active_tasks)
-
-    results = { 'ordination': {}, 'contextual': {} }
     response = {
         'success': True,
-        'mem_usage': mem_usage_obj(),
         'submission': {
             'id': submission_id,
             'state': state,
-            'task_found': task_found,
             'timestamps': timestamps,
             'duration': None,
-            'results': results,
+            'progress': submission.progress,
         }
     }
 
@@ -1066,16 +1071,7 @@ def comparison_submission(request):
         except Exception as e:
             logger.warning("Could not calculate duration of sample comparison; %s" % getattr(e, 'message', repr(e)))
 
-        try:
-            results_files = json.loads(submission.results_files)
-            results = {
-                'ordination': json.load(open(results_files['ordination_file'])),
-                'contextual': json.load(open(results_files['contextual_file'])),
-            }
-
-            response['submission']['results'] = results
-        except Exception as e:
-            logger.error(f"Could not load result files for submission {submission_id}: {e}")
+        response['submission']['results_etag'] = submission.results_etag
 
         ## dont clean up here, move to an endpoint triggered by clicking the X
         # tasks.cleanup_sample_comparison(submission_id)
@@ -1086,7 +1082,7 @@ def comparison_submission(request):
         response['submission']['error'] = submission.error
         tasks.cleanup_sample_comparison(submission_id)
 
-    elif not task_found:
+    elif not celery_task_active(submission_id):
         error = submission.error or (
             'Server-side error. It is possible that the result set is too large! Please run a search with fewer samples.'
         )
@@ -1103,6 +1099,50 @@ def comparison_submission(request):
     return JsonResponse(response)
 
 
+def comparison_results_etag(request):
+    submission = Submission(request.GET['submission_id'])
+    if submission.status != 'complete':
+        return None
+    return submission.results_etag
+
+
+@require_oauth
+@require_GET
+@condition(etag_func=comparison_results_etag)
+def comparison_results(request):
+    """
+    the ordination and contextual results of a complete comparison, as one JSON
+    object. this is written once (gzipped) by the worker, and served as is.
+    """
+    submission_id = request.GET['submission_id']
+    submission = Submission(submission_id)
+    if submission.status != 'complete':
+        raise Http404("Comparison is not complete")
+
+    results_files = json.loads(submission.results_files)
+    payload_file = results_files.get('payload_file')
+    if payload_file is None:
+        # completed before the payload was saved by the worker
+        payload_file = os.path.join(os.path.dirname(results_files['ordination_file']), 'results.json.gz')
+        submission.results_etag = save_results_payload(
+            payload_file, results_files['ordination_file'], results_files['contextual_file'])
+        results_files['payload_file'] = payload_file
+        submission.results_files = json.dumps(results_files)
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = StreamingHttpResponse(FileWrapper(open(payload_file, 'rb')), content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = os.path.getsize(payload_file)
+    else:
+        response = StreamingHttpResponse(FileWrapper(gzip.open(payload_file, 'rb')), content_type='application/json')
+    response['ETag'] = submission.results_etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    # the browser keeps the results, but checks the ETag in case they've been recalculated
+    patch_cache_control(response, private=True, no_cache=True)
+
+    return response
+
+
 ## Misc endpoints for background tasks ##
 
 @require_oauth
@@ -1116,9 +1156,7 @@ def otu_search_blast_otus(request):
         })
 
     with SampleQuery(params) as query:
-        results = query.matching_sample_headers()
-
-    result_count = len(results)
+        result_count = query.matching_sample_count()
 
     return JsonResponse({
         'rowsCount': result_count,
@@ -1470,6 +1508,25 @@ def get_active_celery_tasks():
     active_tasks = inspector.active()
     return [task for tasks in active_tasks.values() for task in tasks]
 
+ACTIVE_CELERY_TASK_ARGS_CACHE_KEY = 'active_celery_task_args'
+
+def celery_task_active(submission_id):
+    """
+    whether there is an active task with the submission_id in its args.
+
+    inspecting the workers is a broadcast and wait, so the active tasks are shared
+    between polls for a few seconds; a submission missing from that list is checked
+    again against the workers before it is treated as failed.
+    """
+    cache = caches['default']
+    task_args = cache.get(ACTIVE_CELERY_TASK_ARGS_CACHE_KEY)
+    if task_args is not None and any(submission_id in args for args in task_args):
+        return True
+
+    task_args = [task["args"] for task in get_active_celery_tasks()]
+    cache.set(ACTIVE_CELERY_TASK_ARGS_CACHE_KEY, task_args, settings.ACTIVE_CELERY_TASKS_CACHE_SECONDS)
+    return any(submission_id in args for args in task_args)
+
 def track(request, event, args=None):
     """Tracks an event in Mixpanel if enabled."""
     if mp:
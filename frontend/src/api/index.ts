@@ -303,6 +303,14 @@ export function getComparisonSubmission(submissionId) {
   })
 }
 
+export function getComparisonResults(submissionId) {
+  return axios.get(window.otu_search_config.comparison_results_endpoint, {
+    params: {
+      submission_id: submissionId,
+    },
+  })
+}
+
 export function getComparisonDistanceMatrices(submissionId) {
   const params = new URLSearchParams()
   params.set('submission_id', submissionId)
@@ -31,9 +31,11 @@ const blastStatusMapping = {
   init: 'Initialising',
   fetch: 'Fetching samples',
   making_db_fasta: 'Making db.fasta of OTUs',
+  making_db_seqidlist: 'Listing OTUs to search',
   makeblastdb: 'Running makeblastdb',
   write_query: 'Building query',
   execute_blast: 'Executing BLAST Search',
+  execute_approximate_search: 'Executing approximate search',
   write_output_raw: 'Writing raw output',
   write_output_sample: 'Writing sample output',
   write_output_map: 'Drawing map',
@@ -46,6 +48,7 @@ const BlastSearchCard = (props) => {
   const {
     alerts,
     blastParams,
+    blastProgress,
     blastStatus,
     imageSrc,
     isAmpliconSelected,
@@ -161,6 +164,34 @@ const BlastSearchCard = (props) => {
             </Input>
           </Col>
         </FormGroup>
+        <FormGroup row={true}>
+          <Label sm={3}>
+            mode{' '}
+            <span id="blastTipMode">
+              <Octicon name="info" />
+            </span>
+            <UncontrolledTooltip target="blastTipMode" placement="auto">
+              Approximate mode estimates matches from shared k-mers without alignment, and is much
+              faster for broad searches
+            </UncontrolledTooltip>
+          </Label>
+          <Col sm={3}>
+            <Input
+              type="select"
+              name="mode"
+              value={blastParams['mode']}
+              onChange={(evt) =>
+                handleBlastParameters({
+                  param: 'mode',
+                  value: evt.target.value,
+                })
+              }
+            >
+              <option value="blast">BLAST</option>
+              <option value="approximate">Approximate (k-mer)</option>
+            </Input>
+          </Col>
+        </FormGroup>
         <Input
           type="textarea"
           name="sequence"
@@ -196,7 +227,15 @@ const BlastSearchCard = (props) => {
         {isSubmitting && (
           <div className="text-center">
             <AnimateHelix scale={0.2} />
-            <p style={fetchingSamplesStyle}>{blastStatusMapping[blastStatus]}</p>
+            <p style={fetchingSamplesStyle}>
+              {blastStatusMapping[blastStatus]}
+              {blastProgress !== '' && (
+                <>
+                  <br />
+                  <small>{blastProgress}%</small>
+                </>
+              )}
+            </p>
           </div>
         )}
       </CardBody>
@@ -233,6 +272,7 @@ const mapStateToProps = (state, props) => {
   return {
     alerts: state.searchPage.blastSearchModal.alerts,
     blastParams: state.searchPage.blastSearchModal.blastParams,
+    blastProgress: state.searchPage.blastSearchModal.progress,
     blastStatus: state.searchPage.blastSearchModal.status,
     imageSrc: state.searchPage.blastSearchModal.imageSrc,
     isAmpliconSelected: selectedAmplicon.value,
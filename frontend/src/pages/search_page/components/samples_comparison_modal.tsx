@@ -46,7 +46,7 @@ import SearchFilters from './search_filters'
 
 import Plot from 'react-plotly.js'
 
-const LoadingSpinnerOverlay = ({ status }) => {
+const LoadingSpinnerOverlay = ({ status, progress }) => {
   const loadingstyle = {
     display: 'flex',
     height: '100%',
@@ -77,6 +77,12 @@ const LoadingSpinnerOverlay = ({ status }) => {
           }}
         >
           {inner}
+          {progress !== '' && (
+            <>
+              <br />
+              <small>{progress}%</small>
+            </>
+          )}
         </div>
       </div>
     </div>
@@ -207,6 +213,7 @@ const SamplesComparisonModal = (props) => {
     clearPlotData,
 
     comparisonStatus,
+    comparisonProgress,
     // mem_usage,
     // timestamps,
     errors,
@@ -426,7 +433,9 @@ const SamplesComparisonModal = (props) => {
       </ModalHeader>
       <ModalBody>
         {isError && !isCancelled && <ErrorOverlay errors={errors} />}
-        {isLoading && <LoadingSpinnerOverlay status={comparisonStatus} />}
+        {isLoading && (
+          <LoadingSpinnerOverlay status={comparisonStatus} progress={comparisonProgress} />
+        )}
         {/* controls layout is 2 rows, each in their own container, divided into 12 parts (set by xs prop) */}
         <Container>
           {/* 1st row of controls */}
@@ -441,7 +450,9 @@ const SamplesComparisonModal = (props) => {
                 }}
               >
                 <option value="braycurtis">Bray-Curtis</option>
-                {/*<option value="jaccard">Jaccard</option>*/}
+                <option value="jaccard">Jaccard</option>
+                <option value="braycurtis_pcoa">Bray-Curtis (PCoA)</option>
+                <option value="jaccard_pcoa">Jaccard (PCoA)</option>
               </select>
             </Col>
             <Col xs="3"></Col>
@@ -661,6 +672,7 @@ const mapStateToProps = (state) => {
     umapParams,
 
     status,
+    progress,
     alerts,
     errors,
     submissions,
@@ -690,6 +702,7 @@ const mapStateToProps = (state) => {
     plotData,
 
     comparisonStatus: status,
+    comparisonProgress: progress,
     alerts,
     errors,
     submissions,
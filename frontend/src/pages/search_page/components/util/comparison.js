@@ -6,12 +6,14 @@ export const comparisonStatusMapping = {
   init: 'Initialising',
   fetch: 'Fetching samples',
   fetched_to_df: 'Loading samples into dataframe',
-  sort: 'Sorting samples',
-  pivot: 'Pivoting data',
+  build_matrix: 'Building abundance matrix',
   reload: 'Retrieving distance matrices',
   // single-threaded:
   calc_distances_bc: 'Calculating distance matrix (Bray-Curtis)',
   calc_distances_j: 'Calculating distance matrix (Jaccard)',
+  calc_knn_bc: 'Finding nearest neighbours (Bray-Curtis)',
+  calc_knn_j: 'Finding nearest neighbours (Jaccard)',
+  calc_pcoa: 'Calculating principal coordinates',
   calc_umap_bc: 'Calculating umap points (Bray-Curtis)',
   calc_umap_j: 'Calculating umap points (Jaccard)',
   // multi-threaded:
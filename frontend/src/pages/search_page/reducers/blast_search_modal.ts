@@ -195,6 +195,7 @@ export default handleActions(
       isFinished: false,
       imageSrc: '',
       status: 'init',
+      progress: '',
     }),
     [runBlastEnded as any]: {
       next: (state, action: any) => {
@@ -292,6 +293,7 @@ export default handleActions(
           isFinished: isFinished,
           isCancelled: !!actionSubmission.cancelled,
           status: actionSubmissionState,
+          progress: actionSubmission.progress || '',
           imageSrc: imageSrc,
           resultUrl: resultUrl,
         }
@@ -4,6 +4,7 @@ import {
   executeCancelComparison,
   executeClearComparison,
   getComparisonSubmission,
+  getComparisonResults,
   getComparisonDistanceMatrices,
 } from 'api'
 import { changeElementAtIndex, removeElementAtIndex } from 'reducers/utils'
@@ -150,6 +151,17 @@ export const autoUpdateComparisonSubmission = () => (dispatch, getState) => {
   const lastSubmission = getLastSubmission()
 
   getComparisonSubmission(lastSubmission.submissionId)
+    .then((data) => {
+      // the results are only fetched once the comparison is complete
+      // (the browser revalidates them by ETag, so they are only downloaded once)
+      if (data.data.submission.state !== 'complete') {
+        return data
+      }
+      return getComparisonResults(lastSubmission.submissionId).then((results) => ({
+        ...data,
+        data: { ...data.data, submission: { ...data.data.submission, results: results.data } },
+      }))
+    })
     .then((data) => {
       dispatch(comparisonSubmissionUpdateEnded(data))
 
@@ -302,37 +314,31 @@ export default handleActions(
 
           const { ordination, contextual } = results
           const sample_ids = ordination.sample_ids
-          const pointsBC = ordination.points['braycurtis']
-          const pointsJ = ordination.points['jaccard']
 
           contextualData = contextual.samples
 
           // apply a jitter so that points aren't put on the same place (makes graph misleading)
           // need to retain the original value to put in the tooltip though
           const jitterAmount = 0.005
+          // (the PCoA points aren't calculated for very large comparisons)
+          const toPlotData = (points) =>
+            points
+              ? sample_ids.map((s, i) => {
+                  return {
+                    text: s,
+                    x: points[i][0],
+                    xj: points[i][0] + (Math.random() * 2 - 1) * jitterAmount,
+                    y: points[i][1],
+                    yj: points[i][1] + (Math.random() * 2 - 1) * jitterAmount,
+                    ...contextualData[s],
+                  }
+                })
+              : []
           plotData = {
-            braycurtis: sample_ids.map((s, i) => {
-              return {
-                text: s,
-                x: pointsBC[i][0],
-                xj: pointsBC[i][0] + (Math.random() * 2 - 1) * jitterAmount,
-                y: pointsBC[i][1],
-                yj: pointsBC[i][1] + (Math.random() * 2 - 1) * jitterAmount,
-                ...contextualData[s],
-              }
-            }),
-            jaccard: [],
-            //// jaccard currently disabled
-            // jaccard: sample_ids.map((s, i) => {
-            //   return {
-            //     text: s,
-            //     x: pointsJ[i][0],
-            //     xj: pointsJ[i][0] + (Math.random() * 2 - 1) * jitterAmount,
-            //     y: pointsJ[i][1],
-            //     yj: pointsJ[i][1] + (Math.random() * 2 - 1) * jitterAmount,
-            //     ...contextualData[s],
-            //   }
-            // }),
+            braycurtis: toPlotData(ordination.points['braycurtis']),
+            jaccard: toPlotData(ordination.points['jaccard']),
+            braycurtis_pcoa: toPlotData(ordination.points['braycurtis_pcoa']),
+            jaccard_pcoa: toPlotData(ordination.points['jaccard_pcoa']),
           }
         }
 
@@ -355,10 +361,10 @@ export default handleActions(
           isLoading: isLoading,
           isFinished: isFinished,
           isCancelled: !!actionSubmission.cancelled,
-          mem_usage: action.payload.data.mem_usage,
           timestamps: action.payload.data.submission.timestamps,
           errors: errors,
           status: actionSubmissionState,
+          progress: actionSubmission.progress || '',
           results: results,
           // only change xData if the submission was finished
           ...(isFinished && { contextualData: contextualData }),
@@ -68,10 +68,12 @@ export interface PageState {
     isSubmitting: boolean
     isFinished: boolean
     status: string
+    progress: string
     sequenceValue: string
     blastParams: {
       qcov_hsp_perc: string
       perc_identity: string
+      mode: string
     }
     rowsCount: number
     submissions: any[]
@@ -108,6 +110,7 @@ export interface PageState {
     selectedFilter: string
     selectedFilterExtra: string
     status: string
+    progress: string
     alerts: any[]
     errors: any[]
     submissions: any[]
@@ -124,6 +127,8 @@ export interface PageState {
     plotData: {
       jaccard: any[]
       braycurtis: any[]
+      jaccard_pcoa: any[]
+      braycurtis_pcoa: any[]
       // jaccard: Array<{ x: number; y: number }>;
       // braycurtis: Array<{ x: number; y: number }>;
     }
@@ -211,10 +216,12 @@ export const searchPageInitialState: PageState = {
     isSubmitting: false,
     isFinished: false,
     status: 'init',
+    progress: '',
     sequenceValue: '',
     blastParams: {
       qcov_hsp_perc: '60',
       perc_identity: '95',
+      mode: 'blast',
     },
     submissions: [],
     alerts: [],
@@ -248,6 +255,7 @@ export const searchPageInitialState: PageState = {
     isCancelled: false,
     hasDirectory: false,
     status: 'init',
+    progress: '',
     selectedMethod: 'braycurtis',
     selectedFilter: '',
     selectedFilterExtra: 'year',
@@ -261,7 +269,7 @@ export const searchPageInitialState: PageState = {
     submissions: [],
     results: { ordination: {}, contextual: {} },
     contextualData: {},
-    plotData: { jaccard: [], braycurtis: [] },
+    plotData: { jaccard: [], braycurtis: [], jaccard_pcoa: [], braycurtis_pcoa: [] },
     mem_usage: { mem: '', swap: '', cpu: '' },
     timestamps: [],
   },
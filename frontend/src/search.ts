@@ -39,6 +39,7 @@ export interface SearchConfig {
   cancel_comparison_endpoint: string
   clear_comparison_endpoint: string
   comparison_submission_endpoint: string
+  comparison_results_endpoint: string
   submit_otuexport_endpoint: string
   cancel_otuexport_endpoint: string
   comparison_download_distance_matrices_endpoint: string